@@ -1,6 +1,11 @@
 import os
 import fnmatch
 import time
+import tempfile
+import hashlib
+import threading
+import functools
+from collections import Counter
 import numpy as np
 from sloth.core.exceptions import \
     ImproperlyConfigured, NotImplementedException, InvalidArgumentException
@@ -20,6 +25,10 @@ try:
     import yaml
 except ImportError:
     pass
+try:
+    import sqlite3
+except ImportError:
+    pass
 try:
     import okapy
     import okapy.videoio as okv
@@ -77,6 +86,14 @@ class AnnotationContainer:
     Annotation Container base class.
     """
 
+    # Whether serializeToFile() accepts any iterable of file entries (such
+    # as a generator), instead of only lists.
+    streaming = False
+
+    # Images with more pixels than this are decoded into a memory-mapped
+    # temporary file instead of memory, see loadImage().
+    mmap_image_size = 8192 * 8192
+
     def __init__(self):
         self.clear()
 
@@ -88,6 +105,8 @@ class AnnotationContainer:
         self._annotations = []  # TODO Why isn't this used? Annotations are passed as parameters instead. Let's have encapsulation.
         self._filename = None
         self._video_cache = {}
+        # frames may be loaded from several threads when prefetching
+        self._video_lock = threading.Lock()
 
     def load(self, filename):
         """
@@ -112,15 +131,48 @@ class AnnotationContainer:
             "AnnotationContainer.load()"
         )
 
-    def save(self, annotations, filename=""):
+    def save(self, annotations, filename="", changed=None):
         """
         Save the annotations.
+
+        ``changed`` optionally is the list of positions of the file items
+        that have been modified since the annotations were loaded from (or
+        last saved to) the current file.  If it is None, any file item
+        may have changed, or file items have been added or removed.
         """
         if not filename:
             filename = self.filename()
-        self.serializeToFile(filename, annotations)
+        if changed is not None and filename == self.filename():
+            self.serializeChangesToFile(filename, annotations, changed)
+        else:
+            self.serializeToFile(filename, annotations)
         self._filename = filename
 
+    def serializeChangesToFile(self, filename, annotations, changed):
+        """
+        Serialize the annotations to disk, when only the file items at the
+        positions in ``changed`` have been modified.  Containers which can
+        update their files in place should overwrite this.  The default
+        implementation rewrites the whole file using serializeToFile().
+        """
+        self.serializeToFile(filename, annotations)
+
+    def attachModel(self, model):
+        """
+        Called with the annotation model created from the loaded (or saved)
+        annotations.  Containers which record the modifications of the model
+        as they happen can overwrite this.  The default does nothing.
+        """
+        pass
+
+    def detachModel(self, model):
+        """
+        Called when the annotation model attached with :meth:`attachModel`
+        is closed.  Its modifications since it was last saved are discarded.
+        The default does nothing.
+        """
+        pass
+
     def serializeToFile(self, filename, annotations):
         """
         Serialize the annotations to disk. Must be implemented in the subclass.
@@ -155,8 +207,13 @@ class AnnotationContainer:
             LOG.warn("Image file %s does not exist." % fullpath)
             return None
 
+        if fullpath.endswith('.npy'):
+            # memory-mapped, so that large images are only read where needed
+            return np.load(fullpath, mmap_mode='r')
         if _use_pil:
             im = Image.open(fullpath)
+            if im.size[0] * im.size[1] > self.mmap_image_size:
+                return _decodeToMemmap(im)
             return np.asarray(im)
         else:
             return okapy.loadImage(fullpath)
@@ -172,20 +229,21 @@ class AnnotationContainer:
             LOG.warn("Video file %s does not exist." % fullpath)
             return None
 
-        # get video source from cache or load from file
-        if fullpath in self._video_cache:
-            vidsrc = self._video_cache[fullpath]
-        else:
-            vidsrc = okv.createVideoSourceFromString(fullpath)
-            vidsrc = okv.toRandomAccessVideoSource(vidsrc)
-            self._video_cache[fullpath] = vidsrc
+        with self._video_lock:
+            # get video source from cache or load from file
+            if fullpath in self._video_cache:
+                vidsrc = self._video_cache[fullpath]
+            else:
+                vidsrc = okv.createVideoSourceFromString(fullpath)
+                vidsrc = okv.toRandomAccessVideoSource(vidsrc)
+                self._video_cache[fullpath] = vidsrc
 
-        # get requested frame
-        if not vidsrc.getFrame(frame_number):
-            LOG.warn("Frame %d could not be loaded from video source %s" % (frame_number, fullpath))
-            return None
+            # get requested frame
+            if not vidsrc.getFrame(frame_number):
+                LOG.warn("Frame %d could not be loaded from video source %s" % (frame_number, fullpath))
+                return None
 
-        return vidsrc.getImage()
+            return vidsrc.getImage()
 
 
 class PickleContainer(AnnotationContainer):
@@ -205,7 +263,7 @@ class PickleContainer(AnnotationContainer):
         Overwritten to write pickle files.
         """
         f = open(fname, "wb")
-        pickle.dump(annotations, f)
+        pickle.dump(plainEntries(annotations), f)
 
 
 class OkapiAnnotationContainer(AnnotationContainer):
@@ -268,6 +326,8 @@ class OkapiAnnotationContainer(AnnotationContainer):
         container = okapy.AnnotationContainer()
 
         for f in annotations:
+            # do not modify the caller's annotations
+            f = dict(f)
             fileitem = okapy.AnnotationFileItem()
             if f.has_key('class'):
                 f['type'] = f['class']
@@ -312,10 +372,133 @@ class JsonContainer(AnnotationContainer):
         Overwritten to write JSON files.
         """
         f = open(fname, "w")
-        json.dump(annotations, f, indent=4, separators=(',', ': '), sort_keys=True)
+        json.dump(plainEntries(annotations), f, indent=4, separators=(',', ': '), sort_keys=True)
         f.write("\n")
 
 
+class StreamingJsonContainer(JsonContainer):
+    """
+    Container which reads and writes the same JSON format as the
+    JsonContainer, but parses the label file incrementally.
+
+    ``parseFromFile()`` returns a generator which yields one top-level
+    file entry at a time, so that the memory needed for parsing scales with
+    the size of the largest file entry instead of the size of the whole
+    label file.  The annotation model consumes the generator on demand.
+    """
+
+    streaming = True
+
+    # number of characters read from disk at once
+    chunk_size = 1 << 16
+
+    def parseFromFile(self, fname):
+        """
+        Overwritten to return a generator over the file entries.
+        """
+        return self._iterEntries(fname)
+
+    def _iterEntries(self, fname):
+        decoder = json.JSONDecoder()
+        with open(fname, "r") as f:
+            reader = _ChunkReader(f, self.chunk_size)
+            pos = reader.skipWhitespace(0)
+            if reader.char(pos) != '[':
+                raise ValueError("%s: expected a JSON list of file entries" % fname)
+            pos = reader.skipWhitespace(pos + 1)
+            if reader.char(pos) == ']':
+                return
+
+            while True:
+                entry, pos = reader.decode(decoder, pos)
+                yield entry
+
+                pos = reader.skipWhitespace(pos)
+                c = reader.char(pos)
+                if c == ']':
+                    return
+                if c != ',':
+                    raise ValueError("%s: expected ',' or ']' at offset %d" %
+                                     (fname, reader.offset(pos)))
+                pos = reader.skipWhitespace(pos + 1)
+                reader.discard(pos)
+                pos = 0
+
+    def serializeToFile(self, fname, annotations):
+        """
+        Overwritten to write the file entries one at a time.  The output is
+        identical to the one of the JsonContainer, but ``annotations`` can
+        be any iterable, e.g. a generator.
+        """
+        f = open(fname, "w")
+        first = True
+        for entry in annotations:
+            text = json.dumps(plainEntry(entry), indent=4, separators=(',', ': '), sort_keys=True)
+            f.write("[\n    " if first else ",\n    ")
+            f.write(text.replace("\n", "\n    "))
+            first = False
+        f.write("[]\n" if first else "\n]\n")
+        f.close()
+
+
+class _ChunkReader:
+    """
+    Read-ahead buffer used by the StreamingJsonContainer.  Positions are
+    relative to the start of the current buffer.
+    """
+
+    def __init__(self, f, chunk_size):
+        self._file = f
+        self._chunk_size = chunk_size
+        self._buf = ""
+        self._offset = 0
+        self._eof = False
+
+    def offset(self, pos):
+        return self._offset + pos
+
+    def _readMore(self, size=None):
+        if self._eof:
+            return False
+        data = self._file.read(size or self._chunk_size)
+        if not data:
+            self._eof = True
+            return False
+        self._buf += data
+        return True
+
+    def char(self, pos):
+        while pos >= len(self._buf):
+            if not self._readMore():
+                raise ValueError("unexpected end of JSON data at offset %d" % self.offset(pos))
+        return self._buf[pos]
+
+    def skipWhitespace(self, pos):
+        while self.char(pos) in " \t\r\n":
+            pos += 1
+        return pos
+
+    def discard(self, pos):
+        self._buf = self._buf[pos:]
+        self._offset += pos
+
+    def decode(self, decoder, pos):
+        # Retry with a growing read size until the value is complete.  A value
+        # that ends exactly at the end of the buffer may still be truncated
+        # (e.g. a number), so we also need to see at least one more character.
+        size = self._chunk_size
+        while True:
+            try:
+                value, end = decoder.raw_decode(self._buf, pos)
+                if end < len(self._buf) or self._eof:
+                    return value, end
+            except ValueError:
+                if self._eof:
+                    raise
+            self._readMore(size)
+            size *= 2
+
+
 class MsgpackContainer(AnnotationContainer):
     """
     Simple container which writes the annotations to disk in Msgpack format.
@@ -336,7 +519,7 @@ class MsgpackContainer(AnnotationContainer):
         # TODO make all image filenames relative to the label file
         import msgpack
         f = open(fname, "w")
-        msgpack.dump(annotations, f)
+        msgpack.dump(plainEntries(annotations), f)
 
 
 class YamlContainer(AnnotationContainer):
@@ -356,7 +539,625 @@ class YamlContainer(AnnotationContainer):
         Overwritten to write YAML files.
         """
         f = open(fname, "w")
-        yaml.dump(annotations, f)
+        yaml.dump(plainEntries(annotations), f)
+
+
+class SqliteContainer(AnnotationContainer):
+    """
+    Container which stores the annotations in an SQLite database.
+
+    File items, frames and annotations are stored in separate, indexed
+    tables.  Loading only reads the file items; the annotations (or frames)
+    of a file are read from the database when the file item is created by
+    the model.  Saving only writes the file items that differ from what is
+    stored in the database already.
+    """
+
+    streaming = True
+
+    schema = (
+        "CREATE TABLE IF NOT EXISTS files ("
+        "  id INTEGER PRIMARY KEY, position INTEGER NOT NULL,"
+        "  class TEXT, filename TEXT, digest TEXT, properties TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS files_position ON files (position)",
+        "CREATE TABLE IF NOT EXISTS frames ("
+        "  id INTEGER PRIMARY KEY, file_id INTEGER NOT NULL,"
+        "  position INTEGER NOT NULL, properties TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS frames_file ON frames (file_id, position)",
+        "CREATE TABLE IF NOT EXISTS annotations ("
+        "  id INTEGER PRIMARY KEY, file_id INTEGER NOT NULL, frame_id INTEGER,"
+        "  position INTEGER NOT NULL, properties TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS annotations_file ON annotations (file_id, frame_id, position)",
+    )
+
+    def clear(self):
+        AnnotationContainer.clear(self)
+        self._db = None
+        self._db_filename = None
+
+    def _connect(self, fname):
+        if self._db is None or self._db_filename != fname:
+            # the model may read lazily from another thread than the
+            # one which loaded the file
+            self._db = sqlite3.connect(fname, check_same_thread=False)
+            self._db_filename = fname
+            for statement in self.schema:
+                self._db.execute(statement)
+        return self._db
+
+    def parseFromFile(self, fname):
+        """
+        Overwritten to read the file items from the database.  The
+        annotations and frames are read lazily, see :class:`SqliteRows`.
+        """
+        db = self._connect(fname)
+        # the rows are read from this database, even if the container
+        # is connected to another one for saving in the meantime
+        counter = functools.partial(self._childCounts, db, {})
+        annotations = []
+        for file_id, properties in db.execute(
+                "SELECT id, properties FROM files ORDER BY position"):
+            fileitem = json.loads(properties)
+            if fileitem.get('class') == 'video':
+                fileitem['frames'] = SqliteRows(functools.partial(self._loadFrames, db),
+                                                file_id, counter, db)
+            else:
+                fileitem['annotations'] = SqliteRows(functools.partial(self._loadAnnotations, db),
+                                                     file_id, counter, db)
+            annotations.append(fileitem)
+        return annotations
+
+    def _childCounts(self, db, cache, file_id, flags, value_keys):
+        # The counts of the frames and annotations of all file items are
+        # queried at once, on the first request for the given keys
+        key = (flags, value_keys)
+        if key not in cache:
+            try:
+                cache[key] = self._queryChildCounts(db, flags, value_keys)
+            except sqlite3.OperationalError as e:
+                # e.g. SQLite without the JSON functions
+                LOG.debug("Could not count the rows in the database: %s" % e)
+                cache[key] = None
+        if cache[key] is None:
+            return None
+        return cache[key].get(file_id, Counter())
+
+    def _queryChildCounts(self, db, flags, value_keys):
+        counts = {}
+        for table in ('frames', 'annotations'):
+            for file_id, n in db.execute(
+                    "SELECT file_id, COUNT(*) FROM %s GROUP BY file_id" % table):
+                counts.setdefault(file_id, Counter())[table] += n
+
+            for key in set(flags) | set(value_keys):
+                path = '$."%s"' % key.replace('"', '\\"')
+                for file_id, json_type, value, n in db.execute(
+                        "SELECT file_id, json_type(properties, ?), json_extract(properties, ?), COUNT(*) "
+                        "FROM %s WHERE json_type(properties, ?) IS NOT NULL "
+                        "GROUP BY file_id, 2, 3" % table, (path, path, path)):
+                    value = _jsonValue(json_type, value)
+                    file_counts = counts.setdefault(file_id, Counter())
+                    if key in flags and value:
+                        file_counts[key] += n
+                    if key in value_keys:
+                        try:
+                            file_counts[(key, value)] += n
+                        except TypeError:
+                            # unhashable values are not counted
+                            pass
+        return counts
+
+    def _loadAnnotations(self, db, file_id):
+        return [json.loads(properties) for properties, in db.execute(
+            "SELECT properties FROM annotations "
+            "WHERE file_id = ? AND frame_id IS NULL ORDER BY position", (file_id, ))]
+
+    def _loadFrames(self, db, file_id):
+        frame_annotations = {}
+        for frame_id, properties in db.execute(
+                "SELECT frame_id, properties FROM annotations "
+                "WHERE file_id = ? AND frame_id IS NOT NULL ORDER BY frame_id, position", (file_id, )):
+            frame_annotations.setdefault(frame_id, []).append(json.loads(properties))
+
+        frames = []
+        for frame_id, properties in db.execute(
+                "SELECT id, properties FROM frames WHERE file_id = ? ORDER BY position", (file_id, )):
+            frame = json.loads(properties)
+            frame['annotations'] = frame_annotations.get(frame_id, [])
+            frames.append(frame)
+        return frames
+
+    def serializeToFile(self, fname, annotations):
+        """
+        Overwritten to write only the file items which have changed.  File
+        items are matched against the stored ones by their filename, and
+        compared by a digest of their content.  File items whose frames or
+        annotations are still the :class:`SqliteRows` of their row in this
+        database are matched to that row, and the stored digest of the rows
+        is used without reading them.
+        """
+        db = self._connect(fname)
+        stored = {}
+        by_id = {}
+        for row in db.execute("SELECT id, position, filename, digest FROM files ORDER BY position"):
+            stored.setdefault(row[2], []).append(row)
+            by_id[row[0]] = row
+
+        with db:
+            written = 0
+            for position, fileitem in enumerate(annotations):
+                rows = self._storedRows(db, fileitem)
+                row = by_id.get(rows._file_id) if rows is not None else None
+                if row is not None:
+                    stored[row[2]].remove(row)
+                    digest = self._digest(fileitem, self._childrenDigest(row[3]))
+                else:
+                    candidates = stored.get(fileitem.get('filename'))
+                    row = candidates.pop(0) if candidates else None
+                    digest = self._digest(fileitem)
+                if row is not None:
+                    del by_id[row[0]]
+                if row is not None and row[3] == digest:
+                    if row[1] != position:
+                        db.execute("UPDATE files SET position = ? WHERE id = ?", (position, row[0]))
+                    continue
+
+                self._writeFileItem(db, row[0] if row is not None else None,
+                                    position, fileitem, digest)
+                written += 1
+
+            # remove file items which are not present anymore
+            for rows in stored.values():
+                for row in rows:
+                    self._deleteChildren(db, row[0])
+                    db.execute("DELETE FROM files WHERE id = ?", (row[0], ))
+                    written += 1
+        LOG.debug("Wrote %d changed file items to %s" % (written, fname))
+
+    def serializeChangesToFile(self, fname, annotations, changed):
+        """
+        Overwritten to write only the file items at the positions in
+        ``changed``.
+        """
+        db = self._connect(fname)
+        with db:
+            for position in changed:
+                row = db.execute("SELECT id FROM files WHERE position = ?", (position, )).fetchone()
+                fileitem = annotations[position]
+                self._writeFileItem(db, row[0] if row is not None else None,
+                                    position, fileitem, self._digest(fileitem))
+        LOG.debug("Wrote %d changed file items to %s" % (len(changed), fname))
+
+    def _writeFileItem(self, db, file_id, position, fileitem, digest):
+        # read lazy rows before the stored ones are deleted, they may come
+        # from the same database
+        fileitem = plainEntry(fileitem)
+        if file_id is not None:
+            self._deleteChildren(db, file_id)
+            db.execute("UPDATE files SET position = ?, class = ?, filename = ?, "
+                       "digest = ?, properties = ? WHERE id = ?",
+                       (position, fileitem.get('class'), fileitem.get('filename'),
+                        digest, self._properties(fileitem), file_id))
+        else:
+            file_id = db.execute("INSERT INTO files (position, class, filename, digest, properties) "
+                                 "VALUES (?, ?, ?, ?, ?)",
+                                 (position, fileitem.get('class'), fileitem.get('filename'),
+                                  digest, self._properties(fileitem))).lastrowid
+        self._insertChildren(db, file_id, fileitem)
+
+    def _storedRows(self, db, fileitem):
+        # The SqliteRows of the file item, if they are read from db
+        for key in ('annotations', 'frames'):
+            rows = fileitem.get(key)
+            if isinstance(rows, SqliteRows) and rows._db is db:
+                return rows
+        return None
+
+    def _digest(self, fileitem, children_digest=None):
+        # The digest of the frames and annotations, followed by the one of
+        # the other properties of the file item
+        if children_digest is None:
+            plain = plainEntry(fileitem)
+            children = [plain.get('annotations'), plain.get('frames')]
+            children_digest = hashlib.sha1(json.dumps(children, sort_keys=True).encode('utf-8')).hexdigest()
+        properties = dict((key, value) for key, value in fileitem.items()
+                          if key not in ('annotations', 'frames'))
+        return children_digest + \
+            hashlib.sha1(json.dumps(properties, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _childrenDigest(self, digest):
+        # The digest of the frames and annotations in a stored digest, or
+        # None for digests of older versions
+        if digest is not None and len(digest) == 80:
+            return digest[:40]
+        return None
+
+    def _properties(self, item):
+        return json.dumps(dict((key, value) for key, value in item.items()
+                               if key not in ('annotations', 'frames')))
+
+    def _deleteChildren(self, db, file_id):
+        db.execute("DELETE FROM annotations WHERE file_id = ?", (file_id, ))
+        db.execute("DELETE FROM frames WHERE file_id = ?", (file_id, ))
+
+    def _insertChildren(self, db, file_id, fileitem):
+        db.executemany("INSERT INTO annotations (file_id, frame_id, position, properties) "
+                       "VALUES (?, NULL, ?, ?)",
+                       [(file_id, i, json.dumps(ann))
+                        for i, ann in enumerate(fileitem.get('annotations', []))])
+        for position, frame in enumerate(fileitem.get('frames', [])):
+            frame_id = db.execute("INSERT INTO frames (file_id, position, properties) VALUES (?, ?, ?)",
+                                  (file_id, position, self._properties(frame))).lastrowid
+            db.executemany("INSERT INTO annotations (file_id, frame_id, position, properties) "
+                           "VALUES (?, ?, ?, ?)",
+                           [(file_id, frame_id, i, json.dumps(ann))
+                            for i, ann in enumerate(frame.get('annotations', []))])
+
+
+def _jsonValue(json_type, value):
+    # Converts a value returned by json_extract() of SQLite to python
+    if json_type == 'true':
+        return True
+    elif json_type == 'false':
+        return False
+    elif json_type in ('array', 'object'):
+        return json.loads(value)
+    return value
+
+
+class SqliteRows:
+    """
+    Read-only sequence of the annotations or frames of a file item in an
+    SqliteContainer.  The rows are read from the database on first access.
+    """
+
+    def __init__(self, loader, file_id, counter=None, db=None):
+        self._loader = loader
+        self._file_id = file_id
+        self._counter = counter
+        # the database the rows are read from
+        self._db = db
+        self._rows = None
+
+    def entryCounts(self, flags, value_keys):
+        """
+        Returns a Counter with the number of ``'frames'`` and
+        ``'annotations'`` among the rows (including the annotations of the
+        frames), of the rows in which the keys in ``flags`` are true, and of
+        the ``(key, value)`` pairs of the keys in ``value_keys``.  The rows
+        are counted by the database without reading them.  Returns None if
+        they cannot be counted this way, or have been read already.
+        """
+        if self._rows is not None or self._counter is None:
+            return None
+        return self._counter(self._file_id, tuple(flags), tuple(value_keys))
+
+    def _fetch(self):
+        if self._rows is None:
+            self._rows = self._loader(self._file_id)
+        return self._rows
+
+    def __len__(self):
+        return len(self._fetch())
+
+    def __getitem__(self, index):
+        return self._fetch()[index]
+
+    def __iter__(self):
+        return iter(self._fetch())
+
+
+def plainEntry(entry):
+    """
+    Returns the file (or frame) entry with its frames and annotations as
+    lists, such that it can be written by any container.  Lazily read
+    sequences, such as :class:`SqliteRows`, are read and converted.  The
+    entry is only copied if it has to be converted.
+    """
+    for key in ('annotations', 'frames'):
+        children = entry.get(key)
+        if children is None:
+            continue
+        plain = [plainEntry(child) if key == 'frames' else child for child in children]
+        if not isinstance(children, list) or any(a is not b for a, b in zip(plain, children)):
+            entry = dict(entry)
+            entry[key] = plain
+    return entry
+
+
+def plainEntries(annotations):
+    """
+    Returns the list of file entries converted by :func:`plainEntry`.
+    """
+    return [plainEntry(entry) for entry in annotations]
+
+
+class JournalContainer(AnnotationContainer):
+    """
+    Container which writes the modifications of the annotations to an
+    append-only journal next to the label file, ``<filename>.journal``.
+
+    The label file itself is a snapshot written by the container class in
+    ``container_class``.  Every modification of the model is appended to
+    the journal as soon as it happens, so saving to the same file only has
+    to sync the journal to disk, and no edit is lost if sloth crashes.  On
+    loading, the journal is replayed on top of the snapshot.  Saving to
+    another file, or calling :meth:`compact`, writes a new snapshot and
+    starts an empty journal.  This happens automatically when the journal
+    has grown larger than ``compact_size`` bytes, after it has been
+    replayed on loading, and on saving.
+    """
+
+    container_class = JsonContainer
+    compact_size = 4 * 1024 * 1024
+
+    def clear(self):
+        AnnotationContainer.clear(self)
+        self._container = self.container_class()
+        self._journal = None
+
+    def journalFilename(self, fname):
+        return fname + ".journal"
+
+    def parseFromFile(self, fname):
+        """
+        Overwritten to read the snapshot with the inner container and to
+        replay the journal on it.
+        """
+        annotations = list(self._container.load(fname))
+        jname = self.journalFilename(fname)
+        if os.path.exists(jname):
+            if _replayJournal(annotations, jname, fname) is None:
+                # keep it, but don't append new records to it
+                _replaceFile(jname, jname + ".old")
+            elif os.path.getsize(jname) > self.compact_size:
+                self.serializeToFile(fname, annotations)
+        return annotations
+
+    def attachModel(self, model):
+        """
+        Overwritten to record all further modifications of the model to the
+        journal of the current file.
+        """
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = AnnotationJournal(self.journalFilename(self.filename()), self.filename())
+        model.setJournal(self._journal)
+
+    def detachModel(self, model):
+        """
+        Overwritten to remove the records of the unsaved modifications from
+        the journal, so they are not replayed when the file is loaded again.
+        """
+        if model.journal() is self._journal:
+            model.setJournal(None)
+        if self._journal is not None:
+            self._journal.discard()
+            self._journal = None
+
+    def save(self, annotations, filename="", changed=None):
+        """
+        Overwritten to only sync the journal to disk, if the annotations
+        are saved to the file whose journal the model is recording to.
+        """
+        if not filename:
+            filename = self.filename()
+        if self._journal is not None and filename == self.filename():
+            self._journal.sync()
+            if self._journal.size() > self.compact_size:
+                self.compact(annotations)
+        else:
+            AnnotationContainer.save(self, annotations, filename, changed)
+
+    def serializeToFile(self, fname, annotations):
+        """
+        Overwritten to write a new snapshot with the inner container and to
+        start an empty journal for it.  The snapshot is written to a
+        temporary file first, so the old snapshot stays intact on errors.
+        """
+        tmpname = fname + ".tmp"
+        self._container.serializeToFile(tmpname, annotations)
+        _replaceFile(tmpname, fname)
+
+        jname = self.journalFilename(fname)
+        if self._journal is not None and self._journal.filename() == jname:
+            self._journal.reset()
+        elif os.path.exists(jname):
+            os.remove(jname)
+
+    def compact(self, annotations):
+        """
+        Write the annotations as new snapshot of the current file, and
+        truncate its journal.
+        """
+        self.serializeToFile(self.filename(), annotations)
+
+
+class AnnotationJournal:
+    """
+    Append-only log of the modifications of an annotation model, one JSON
+    record per line.  Records address the modified entries by their data
+    path, see :meth:`sloth.annotations.model.ModelItem.dataPath`.
+
+    The first record holds the digest of the snapshot the journal applies
+    to.  A journal whose snapshot has been replaced is ignored on replay.
+    The records appended after the last :meth:`sync` are unsaved, and are
+    removed again by :meth:`discard`.
+    """
+
+    def __init__(self, filename, snapshot):
+        self._filename = filename
+        self._snapshot = snapshot
+        self._file = None
+        # size of the journal up to the last saved record
+        self._saved = os.path.getsize(filename) if os.path.exists(filename) else None
+
+    def filename(self):
+        return self._filename
+
+    def record(self, op, item, *args):
+        """
+        Append a modification of the model item ``item`` to the journal.
+        """
+        if op in ('insert', 'remove'):
+            child = args[0]
+            record = [op, item.dataPath(), child._dataIndex()]
+            if op == 'insert':
+                record.append(child.getAnnotations())
+        else:
+            record = [op, item.dataPath()] + list(args)
+
+        if self._file is None:
+            if not os.path.exists(self._filename):
+                self.reset()
+            self._file = open(self._filename, "a")
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def size(self):
+        """
+        The size of the journal file in bytes.
+        """
+        if os.path.exists(self._filename):
+            return os.path.getsize(self._filename)
+        return 0
+
+    def sync(self):
+        """
+        Make sure all records are written to disk.
+        """
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._saved = self._file.tell()
+
+    def discard(self):
+        """
+        Remove the records appended since the last :meth:`sync` (or
+        :meth:`reset`) and close the journal.
+        """
+        self.close()
+        if self._saved is not None and os.path.exists(self._filename) and \
+                os.path.getsize(self._filename) > self._saved:
+            f = open(self._filename, "r+")
+            f.truncate(self._saved)
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+
+    def reset(self):
+        """
+        Start a new, empty journal for the current content of the snapshot.
+        """
+        self.close()
+        tmpname = self._filename + ".tmp"
+        f = open(tmpname, "w")
+        f.write(json.dumps(['snapshot', _fileDigest(self._snapshot)]) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+        self._saved = f.tell()
+        f.close()
+        _replaceFile(tmpname, self._filename)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _decodeToMemmap(im, strip_height=256):
+    # Copies the pixels of a PIL image into a memory-mapped temporary file
+    # in strips of rows, so that only PIL's own buffer is held in memory
+    # while decoding, and the returned array is backed by the disk
+    width, height = im.size
+    image = None
+    try:
+        for y in range(0, height, strip_height):
+            strip = np.asarray(im.crop((0, y, width, min(y + strip_height, height))))
+            if image is None:
+                image = np.memmap(tempfile.TemporaryFile(), dtype=strip.dtype, mode='w+',
+                                  shape=(height, ) + strip.shape[1:])
+            image[y:y + strip.shape[0]] = strip
+    finally:
+        im.close()
+    return image
+
+
+def _replaceFile(src, dst):
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def _fileDigest(fname):
+    digest = hashlib.sha1()
+    with open(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _childEntries(entry):
+    # the list of frames or annotations of a raw entry, as mutable list
+    key = 'frames' if entry.get('class') == 'video' or 'frames' in entry else 'annotations'
+    if not isinstance(entry.get(key), list):
+        entry[key] = list(entry.get(key, []))
+    return entry[key]
+
+
+def _replayJournal(annotations, jname, snapshot):
+    """
+    Apply the records of the journal ``jname`` to the list of file entries.
+    Returns the number of records applied, or None if the journal does not
+    belong to the snapshot file.
+    """
+    f = open(jname, "r")
+    lines = f.read().split("\n")
+    f.close()
+
+    try:
+        header = json.loads(lines[0])
+    except ValueError:
+        header = None
+    if not header or header[0] != 'snapshot' or header[1] != _fileDigest(snapshot):
+        LOG.warning("Ignoring journal %s, it does not belong to %s" % (jname, snapshot))
+        return None
+
+    count = 0
+    for num, line in enumerate(lines[1:]):
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # the last record may be incomplete if sloth crashed while writing it
+            LOG.warning("Ignoring incomplete record in line %d of journal %s" % (num + 2, jname))
+            break
+
+        op, path = record[0], record[1]
+        entry = None
+        for depth, index in enumerate(path):
+            entry = (_childEntries(entry) if depth > 0 else annotations)[index]
+
+        if op == 'set':
+            entry[record[2]] = record[3]
+        elif op == 'delete':
+            entry.pop(record[2], None)
+        else:
+            entries = _childEntries(entry) if entry is not None else annotations
+            if op == 'insert':
+                entries.insert(record[2], record[3])
+            elif op == 'remove':
+                del entries[record[2]]
+            elif op == 'clear':
+                del entries[:]
+        count += 1
+
+    LOG.info("Replayed %d records from journal %s" % (count, jname))
+    return count
 
 
 class FileNameListContainer(AnnotationContainer):
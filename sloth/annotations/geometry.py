@@ -0,0 +1,462 @@
+"""
+Columnar storage for the geometric attributes of the annotations.
+
+The coordinates of the annotations in an AnnotationModel are not kept in
+the dicts of the annotation items, but in typed numpy arrays, one table
+per label class.  The AnnotationModelItems still provide the usual mapping
+interface on top of it, while bulk queries such as the bounding boxes of
+all annotations of a class can run vectorized.
+"""
+import math
+import numpy as np
+
+# attributes which are stored as one number per annotation
+SCALAR_KEYS = ('x', 'y', 'width', 'height')
+# attributes which are stored as a list of numbers per annotation, they are
+# ';'-separated strings in the annotations (see PolygonItem)
+VECTOR_KEYS = ('xn', 'yn')
+GEOMETRIC_KEYS = frozenset(SCALAR_KEYS + VECTOR_KEYS)
+
+# kinds of stored values, needed to return the values with their original type
+_MISSING, _FLOAT, _INT = 0, 1, 2
+
+
+def parseVertices(value):
+    """
+    Returns the numbers of a ';'-separated string (such as the ``xn`` and
+    ``yn`` attributes of polygons) as float array.
+    """
+    return np.array([float(v) for v in value.split(';')])
+
+
+def _encodeScalar(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, float):
+        return _FLOAT, value
+    if isinstance(value, int) and abs(value) <= 2 ** 53:
+        return _INT, float(value)
+    return None
+
+
+def _formatVector(kind, values):
+    if kind == _INT:
+        return ';'.join(str(int(v)) for v in values)
+    return ';'.join(str(v) for v in values)
+
+
+def _encodeVector(value):
+    # Only strings which are reproduced exactly when formatting the parsed
+    # numbers again are stored, anything else stays in the annotation dict
+    if not hasattr(value, 'split'):
+        return None
+    try:
+        values = [float(v) for v in value.split(';')]
+    except ValueError:
+        return None
+    for kind in (_FLOAT, _INT):
+        if _formatVector(kind, values) == value:
+            return kind, values
+    return None
+
+
+def _resized(a, n):
+    res = np.zeros(n, dtype=a.dtype)
+    res[:len(a)] = a[:n]
+    return res
+
+
+class _VertexColumn:
+    """
+    The values of one vector attribute, stored consecutively in a shared
+    buffer.  Changed values are appended to the buffer, the buffer is
+    compacted once more than half of it is unused.
+    """
+
+    def __init__(self, capacity):
+        self.start = np.zeros(capacity, dtype=np.int64)
+        self.count = np.zeros(capacity, dtype=np.int64)
+        self.kind = np.zeros(capacity, dtype=np.int8)
+        self.buffer = np.zeros(256)
+        self.used = 0
+        self.garbage = 0
+
+    def resize(self, capacity):
+        self.start = _resized(self.start, capacity)
+        self.count = _resized(self.count, capacity)
+        self.kind = _resized(self.kind, capacity)
+
+    def has(self, row):
+        return self.kind[row] != _MISSING
+
+    def get(self, row):
+        start = self.start[row]
+        return self.buffer[start:start + self.count[row]]
+
+    def set(self, row, kind, values):
+        self.clear(row)
+        n = len(values)
+        if self.used + n > len(self.buffer):
+            if self.garbage > self.used // 2:
+                self._compact()
+            if self.used + n > len(self.buffer):
+                self.buffer = _resized(self.buffer, max(2 * len(self.buffer), self.used + n))
+        self.buffer[self.used:self.used + n] = values
+        self.start[row] = self.used
+        self.count[row] = n
+        self.kind[row] = kind
+        self.used += n
+
+    def clear(self, row):
+        if self.kind[row] != _MISSING:
+            self.garbage += self.count[row]
+            self.kind[row] = _MISSING
+            self.count[row] = 0
+
+    def _compact(self):
+        rows = np.flatnonzero(self.kind != _MISSING)
+        counts = self.count[rows]
+        ends = np.cumsum(counts)
+        starts = ends - counts
+        # index of every used value in the old buffer
+        index = np.repeat(self.start[rows] - starts, counts) + np.arange(ends[-1] if len(ends) else 0)
+        self.buffer = _resized(self.buffer[index], len(self.buffer))
+        self.start[rows] = starts
+        self.used = len(index)
+        self.garbage = 0
+
+
+class GeometryTable:
+    """
+    The geometric attributes of the annotations of one label class.  Each
+    annotation item occupies one row of the table, the scalar attributes
+    are kept in one float column each, the vector attributes in a vertex
+    buffer per attribute.  Rows of removed items are reused.
+    """
+
+    def __init__(self, label_class, capacity=64):
+        self._label_class = label_class
+        self._capacity = capacity
+        self._size = 0
+        self._free = []
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._items = [None] * capacity
+        # key -> (values, kinds)
+        self._scalars = {}
+        # key -> _VertexColumn
+        self._vectors = {}
+
+    def labelClass(self):
+        return self._label_class
+
+    def __len__(self):
+        return self._size - len(self._free)
+
+    def allocate(self, item):
+        """Returns a new row for the annotation item ``item``."""
+        if self._free:
+            row = self._free.pop()
+        else:
+            if self._size == self._capacity:
+                self._resize(2 * self._capacity)
+            row = self._size
+            self._size += 1
+        self._alive[row] = True
+        self._items[row] = item
+        return row
+
+    def release(self, row):
+        """Removes all values of ``row`` and marks the row for reuse."""
+        for key in self.keys(row):
+            self.delete(row, key)
+        self._alive[row] = False
+        self._items[row] = None
+        self._free.append(row)
+
+    def _resize(self, capacity):
+        self._alive = _resized(self._alive, capacity)
+        self._items.extend([None] * (capacity - self._capacity))
+        for key, (values, kinds) in self._scalars.items():
+            self._scalars[key] = (_resized(values, capacity), _resized(kinds, capacity))
+        for column in self._vectors.values():
+            column.resize(capacity)
+        self._capacity = capacity
+
+    def has(self, row, key):
+        if key in self._scalars:
+            return self._scalars[key][1][row] != _MISSING
+        if key in self._vectors:
+            return self._vectors[key].has(row)
+        return False
+
+    def get(self, row, key):
+        """
+        Returns the value of ``key`` in ``row`` as it was set, raises
+        KeyError if the row has no such value.
+        """
+        if key in self._scalars:
+            values, kinds = self._scalars[key]
+            kind = kinds[row]
+            if kind == _FLOAT:
+                return float(values[row])
+            if kind == _INT:
+                return int(values[row])
+        elif key in self._vectors:
+            column = self._vectors[key]
+            if column.has(row):
+                return _formatVector(column.kind[row], column.get(row).tolist())
+        raise KeyError(key)
+
+    def set(self, row, key, value):
+        """
+        Stores ``value`` for ``key`` in ``row``.  Returns False (and removes
+        any previous value) if the value cannot be stored in the table,
+        the caller has to keep it then.
+        """
+        if key in SCALAR_KEYS:
+            encoded = _encodeScalar(value)
+            if encoded is not None:
+                if key not in self._scalars:
+                    self._scalars[key] = (np.zeros(self._capacity),
+                                          np.zeros(self._capacity, dtype=np.int8))
+                values, kinds = self._scalars[key]
+                kinds[row], values[row] = encoded
+                return True
+        elif key in VECTOR_KEYS:
+            encoded = _encodeVector(value)
+            if encoded is not None:
+                if key not in self._vectors:
+                    self._vectors[key] = _VertexColumn(self._capacity)
+                self._vectors[key].set(row, *encoded)
+                return True
+        self.delete(row, key)
+        return False
+
+    def delete(self, row, key):
+        """Removes the value of ``key`` in ``row``, returns whether it existed."""
+        if not self.has(row, key):
+            return False
+        if key in self._scalars:
+            self._scalars[key][1][row] = _MISSING
+        else:
+            self._vectors[key].clear(row)
+        return True
+
+    def keys(self, row):
+        return [key for key in SCALAR_KEYS + VECTOR_KEYS if self.has(row, key)]
+
+    def values(self, row):
+        return dict((key, self.get(row, key)) for key in self.keys(row))
+
+    def vertices(self, row, key):
+        """
+        Returns the numbers of the vector attribute ``key`` in ``row`` as
+        a read-only float array, without parsing them.
+        """
+        if key not in self._vectors or not self._vectors[key].has(row):
+            raise KeyError(key)
+        values = self._vectors[key].get(row)
+        values.flags.writeable = False
+        return values
+
+    def item(self, row):
+        return self._items[row]
+
+    def boundingBox(self, row):
+        """
+        Returns the bounding box of ``row`` as ``(x, y, width, height)``
+        following the rules of boundingBoxes(), or None.
+        """
+        xn, yn = [self._vectors.get(key) for key in VECTOR_KEYS]
+        if xn is not None and yn is not None and xn.count[row] > 0 and yn.count[row] > 0:
+            x, y = xn.get(row), yn.get(row)
+            return (float(x.min()), float(y.min()),
+                    float(x.max() - x.min()), float(y.max() - y.min()))
+        box = []
+        for key in SCALAR_KEYS:
+            values, kinds = self._scalars.get(key, (None, None))
+            box.append(float(values[row]) if kinds is not None and kinds[row] != _MISSING else None)
+        if box[0] is None or box[1] is None:
+            return None
+        return tuple(0. if v is None else v for v in box)
+
+    def rows(self):
+        """Returns the array of the rows in use."""
+        return np.flatnonzero(self._alive[:self._size])
+
+    def column(self, key):
+        """
+        Returns the rows which have a value for the scalar attribute ``key``
+        and the array of their values.
+        """
+        if key not in self._scalars:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        values, kinds = self._scalars[key]
+        rows = np.flatnonzero(kinds[:self._size] != _MISSING)
+        return rows, values[rows]
+
+    def boundingBoxes(self):
+        """
+        Returns the rows which have a geometry and an array of their
+        bounding boxes as ``(x, y, width, height)``.  Rectangles are taken
+        from ``x``, ``y``, ``width`` and ``height``, polygons from ``xn``
+        and ``yn`` and points (``x`` and ``y`` only) have an empty box.
+        """
+        n = self._size
+        boxes = np.zeros((n, 4))
+        present = {}
+        for i, key in enumerate(SCALAR_KEYS):
+            present[key] = np.zeros(n, dtype=bool)
+            if key in self._scalars:
+                values, kinds = self._scalars[key]
+                present[key] = kinds[:n] != _MISSING
+                boxes[present[key], i] = values[:n][present[key]]
+        valid = present['x'] & present['y']
+
+        if 'xn' in self._vectors and 'yn' in self._vectors:
+            xn, yn = self._vectors['xn'], self._vectors['yn']
+            polygon = np.flatnonzero((xn.count[:n] > 0) & (yn.count[:n] > 0))
+            if len(polygon) > 0:
+                for i, column in enumerate((xn, yn)):
+                    starts = column.start[polygon]
+                    # reduceat reduces over [start, end) for every pair
+                    # of indices, the results between the pairs are dropped
+                    index = np.stack((starts, starts + column.count[polygon]), axis=1).ravel()
+                    buffer = np.append(column.buffer[:column.used], 0.)
+                    lo = np.minimum.reduceat(buffer, index)[::2]
+                    hi = np.maximum.reduceat(buffer, index)[::2]
+                    boxes[polygon, i] = lo
+                    boxes[polygon, i + 2] = hi - lo
+                valid[polygon] = True
+
+        rows = np.flatnonzero(valid & self._alive[:n])
+        return rows, boxes[rows]
+
+
+class GeometryStore:
+    """
+    The GeometryTables of the label classes of an AnnotationModel.
+    """
+
+    def __init__(self):
+        self._tables = {}
+
+    def table(self, label_class):
+        """Returns the table of ``label_class``, which is created on first use."""
+        table = self._tables.get(label_class)
+        if table is None:
+            table = self._tables[label_class] = GeometryTable(label_class)
+        return table
+
+    def labelClasses(self):
+        return list(self._tables.keys())
+
+    def __iter__(self):
+        return iter(self._tables.values())
+
+
+class SpatialIndex:
+    """
+    Uniform grid over the bounding boxes ``(x, y, width, height)`` of a set
+    of items, such as the annotations of one image.  An item is registered
+    in every cell its box overlaps, items which would span more than
+    ``max_cells`` cells are kept in a separate list that is checked on
+    every query.  Items are compared by identity, so they do not need to
+    be hashable.
+    """
+
+    def __init__(self, cell_size=128., max_cells=64):
+        self._cell_size = float(cell_size)
+        self._max_cells = max_cells
+        # id(item) -> (item, box)
+        self._entries = {}
+        # (column, row) -> set of ids
+        self._cells = {}
+        self._large = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, item):
+        return id(item) in self._entries
+
+    def _cellRange(self, box):
+        x, y, width, height = box
+        size = self._cell_size
+        return (int(math.floor(x / size)), int(math.floor(y / size)),
+                int(math.floor((x + width) / size)), int(math.floor((y + height) / size)))
+
+    def _isLarge(self, cells):
+        i0, j0, i1, j1 = cells
+        return (i1 - i0 + 1) * (j1 - j0 + 1) > self._max_cells
+
+    def insert(self, item, box):
+        """
+        Adds ``item`` with the bounding box ``box``, or moves it there if it
+        is in the index already.  Items with an invalid box are removed.
+        """
+        self.remove(item)
+        box = tuple(float(v) for v in box)
+        if any(math.isnan(v) or math.isinf(v) for v in box):
+            return
+        key = id(item)
+        self._entries[key] = (item, box)
+        cells = self._cellRange(box)
+        if self._isLarge(cells):
+            self._large.add(key)
+            return
+        i0, j0, i1, j1 = cells
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                self._cells.setdefault((i, j), set()).add(key)
+
+    def remove(self, item):
+        """Removes ``item``, returns whether it was in the index."""
+        key = id(item)
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        cells = self._cellRange(entry[1])
+        if self._isLarge(cells):
+            self._large.discard(key)
+            return True
+        i0, j0, i1, j1 = cells
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                keys = self._cells[(i, j)]
+                keys.discard(key)
+                if not keys:
+                    del self._cells[(i, j)]
+        return True
+
+    def box(self, item):
+        return self._entries[id(item)][1]
+
+    def items(self):
+        return [item for item, box in self._entries.values()]
+
+    def intersecting(self, rect):
+        """
+        Returns the items whose boxes intersect (or touch) ``rect``, given
+        as ``(x, y, width, height)``.  The order of the items is undefined.
+        """
+        x, y, width, height = rect
+        i0, j0, i1, j1 = self._cellRange(rect)
+        candidates = set(self._large)
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > len(self._cells):
+            for (i, j), keys in self._cells.items():
+                if i0 <= i <= i1 and j0 <= j <= j1:
+                    candidates.update(keys)
+        else:
+            for i in range(i0, i1 + 1):
+                for j in range(j0, j1 + 1):
+                    keys = self._cells.get((i, j))
+                    if keys:
+                        candidates.update(keys)
+
+        result = []
+        for key in candidates:
+            item, (bx, by, bwidth, bheight) = self._entries[key]
+            if bx <= x + width and x <= bx + bwidth and by <= y + height and y <= by + bheight:
+                result.append(item)
+        return result
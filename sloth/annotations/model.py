@@ -5,54 +5,360 @@ import os.path
 import time
 import logging
 import copy
-from collections import MutableMapping
+from contextlib import contextmanager
+from collections import Counter
+import numpy as np
 from PyQt4.QtGui import QTreeView, QItemSelection, QItemSelectionModel, QSortFilterProxyModel, QBrush
 from PyQt4.QtCore import QModelIndex, QAbstractItemModel, Qt, pyqtSignal, QVariant, QObject
 
+from sloth.annotations.geometry import GeometryStore, GeometryTable, SpatialIndex, GEOMETRIC_KEYS, parseVertices
+
 LOG = logging.getLogger(__name__)
 
 ItemRole, DataRole, ImageRole = [Qt.UserRole + ur + 1 for ur in range(3)]
 
 
-class ModelItem:
+class _RowIndex(object):
+    """
+    Positions of the children of a model item.  Every child has a slot, the
+    slots are in the order of the children, and the slots of removed
+    children are left empty.  The position of a child is the number of
+    occupied slots in front of its slot, which is kept in a Fenwick tree.
+    Looking up the position or slot of a child, and appending or removing
+    one are O(log n).
+
+    A child inserted in front of another one takes an empty slot between
+    its neighbours.  If there is none, the slots of the smallest enclosing
+    block which is not too dense are spread evenly, like in a packed-memory
+    array: the blocks double in size, and the allowed density decreases
+    from 1 to ``max_density`` for the largest one.  This relabels
+    amortized O(log^2 n) slots per insertion.  Only if all slots are too
+    dense, they are relabeled with an empty slot in front of every child.
+    """
+    __slots__ = ('_tree', '_used', '_count')
+
+    # allowed density of the occupied slots of the whole index
+    max_density = 0.75
+
+    def __init__(self, occupied):
+        # occupied holds 1 for the occupied and 0 for the empty slots
+        self._used = bytearray(occupied)
+        self._count = sum(self._used)
+        self._tree = [0] * (len(self._used) + 1)
+        self._build(0, len(self._used))
+
+    def _build(self, lo, hi):
+        # Recompute the nodes of the Fenwick tree which only cover slots
+        # in [lo, hi), lo being a multiple of the block size
+        tree, used = self._tree, self._used
+        for i in range(lo + 1, hi + 1):
+            tree[i] = used[i - 1]
+        for i in range(lo + 1, hi + 1):
+            j = i + (i & -i)
+            if j <= hi:
+                tree[j] += tree[i]
+
+    def slotCount(self):
+        return len(self._tree) - 1
+
+    def sparse(self):
+        # Whether most slots are empty, and the index should be rebuilt
+        return self.slotCount() > 64 and self._count * 4 < self.slotCount()
+
+    def position(self, slot):
+        # Number of occupied slots in front of slot
+        tree = self._tree
+        pos = 0
+        while slot > 0:
+            pos += tree[slot]
+            slot -= slot & -slot
+        return pos
+
+    def slot(self, pos):
+        # Slot of the child at position pos
+        tree = self._tree
+        i, step = 0, 1
+        while step * 2 < len(tree):
+            step *= 2
+        while step > 0:
+            j = i + step
+            if j < len(tree) and tree[j] <= pos:
+                i = j
+                pos -= tree[j]
+            step //= 2
+        return i
+
+    def append(self):
+        # Appends an occupied slot and returns it
+        i = len(self._tree)
+        self._tree.append(1 + self.position(i - 1) - self.position(i - (i & -i)))
+        self._used.append(1)
+        self._count += 1
+        return i - 1
+
+    def _add(self, slot, delta):
+        tree = self._tree
+        i = slot + 1
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def release(self, slot):
+        self._add(slot, -1)
+        self._used[slot] = 0
+        self._count -= 1
+
+    def insert(self, pos):
+        """
+        Occupies a slot for a child inserted in front of the child at
+        position pos.  Returns the new slot, the position ``first`` of the
+        first child whose slot changed, and the list of the new slots of the
+        children from ``first`` on, up to the last one changed.
+        """
+        next_slot = self.slot(pos)
+        prev_slot = self.slot(pos - 1) if pos > 0 else -1
+        if next_slot - prev_slot >= 2:
+            slot = (prev_slot + next_slot) // 2
+            self._add(slot, 1)
+            self._used[slot] = 1
+            self._count += 1
+            return slot, pos, []
+
+        size = self.slotCount()
+        levels = size.bit_length()
+        block, level = 1, 0
+        while True:
+            block *= 2
+            level += 1
+            lo = next_slot - next_slot % block
+            hi = min(lo + block, size)
+            first = self.position(lo)
+            count = self.position(hi) - first
+            if count + 1 <= (1 - (1 - self.max_density) * level / float(levels)) * (hi - lo):
+                break
+            if lo == 0 and hi == size:
+                return self._rebuild(pos)
+
+        slots = [lo + (j * (hi - lo)) // (count + 1) for j in range(count + 1)]
+        used = self._used
+        used[lo:hi] = bytearray(hi - lo)
+        for slot in slots:
+            used[slot] = 1
+        # the nodes inside of the block are rebuilt, the ones covering the
+        # whole block only count the new child
+        self._build(lo, min(lo + block - 1, size))
+        if lo + block <= size:
+            self._add(lo + block - 1, 1)
+        self._count += 1
+        j = pos - first
+        return slots[j], first, slots[:j] + slots[j + 1:]
+
+    def _rebuild(self, pos):
+        # Leave an empty slot in front of every child
+        n = self._count + 1
+        self.__init__([0, 1] * n)
+        slots = [2 * j + 1 for j in range(n)]
+        return slots[pos], 0, slots[:pos] + slots[pos + 1:]
+
+
+class ModelItem(object):
+    # The model items use __slots__ to keep their memory footprint small,
+    # subclasses which add attributes should define __slots__ as well.
+    __slots__ = ('_unloaded', '_counts', '_model', '_parent', '_row',
+                 '_rows', '_children')
+
+    # key under which the item itself is counted in counts()
+    count_key = None
+
     def __init__(self):
-        self._loaded = True
+        # number of children which are still raw entries
+        self._unloaded = 0
+        # aggregate counts of the subtree, computed on first use
+        self._counts = None
         self._model = None
         self._parent = None
+        # slot of the item among the children of its parent, which is its
+        # position until the parent creates a _RowIndex for its children
         self._row = -1
+        self._rows = None
         if not hasattr(self, "_children"):
-            self._children = []
+            # replaced by a list when the first child is added
+            self._children = ()
 
     def _load(self, index):
         pass
 
     def _ensureLoaded(self, index):
-        if not self._loaded:
+        if self._unloaded > 0:
             if not isinstance(self._children[index], ModelItem):
                 # Need to set the before actually loading to avoid
                 # endless recursion...
+                self._unloaded -= 1
                 self._load(index)
                 return True
         return False
 
     def _ensureAllLoaded(self):
-        if not self._loaded:
+        if self._unloaded > 0:
             for i in range(len(self._children)):
+                if self._unloaded == 0:
+                    break
                 self._ensureLoaded(i)
             return True
         return False
 
+    def _appendUnloaded(self, entries):
+        # Append raw entries as children, which are turned into model
+        # items by _load() when they are accessed
+        if not self._children:
+            self._children = []
+        self._children.extend(entries)
+        self._unloaded += len(entries)
+        if self._rows is not None:
+            for entry in entries:
+                self._rows.append()
+        if self._countsComputed():
+            delta = Counter()
+            for entry in entries:
+                self._rawChildCounts(entry, delta)
+            self._updateCounts(delta)
+
+    def counts(self):
+        """
+        Returns a Counter with the number of ``'files'``, ``'frames'``,
+        ``'annotations'``, ``'unlabeled'`` and ``'unconfirmed'`` items in the
+        subtree of this item, including the item itself.  The values of the
+        keys in :meth:`AnnotationModel.countValues` are counted as
+        ``(key, value)`` pairs, e.g. ``counts()[('class', 'face')]``.
+        Children which have not been loaded yet are counted from their raw
+        entries, without creating model items for them.
+        """
+        return Counter(self._getCounts())
+
+    def _getCounts(self):
+        if self._counts is None:
+            counts = self._ownCounts()
+            if not self._children:
+                # not cached for leaves, such as the annotations, to save
+                # memory; the ancestors are updated without them
+                return counts
+            for child in self._children:
+                if isinstance(child, ModelItem):
+                    counts.update(child._getCounts())
+                else:
+                    self._rawChildCounts(child, counts)
+            self._counts = counts
+        return self._counts
+
+    def _ownCounts(self):
+        if self.count_key is not None:
+            return Counter({self.count_key: 1})
+        return Counter()
+
+    def _rawChildCounts(self, entry, counts=None):
+        return _entryCounts(entry, 'annotations', counts, self._countValues())
+
+    def _countValues(self):
+        # The keys whose values are counted, as configured for the model
+        # the item belongs to (or is being inserted into)
+        item = self
+        while item._model is None and item._parent is not None:
+            item = item._parent
+        if item._model is not None:
+            return item._model.countValues()
+        return KeyValueModelItem.count_values
+
+    def _countsComputed(self):
+        # Whether the counts of this item or one of its ancestors have been
+        # computed, and thus need to be updated on changes
+        item = self
+        while item is not None:
+            if item._counts is not None:
+                return True
+            item = item._parent
+        return False
+
+    def _updateCounts(self, delta, subtract=False):
+        # Add delta to the counts of this item and its ancestors, as far
+        # as they have been computed already
+        item = self
+        while item is not None:
+            if item._counts is not None:
+                if subtract:
+                    item._counts.subtract(delta)
+                else:
+                    item._counts.update(delta)
+            item = item._parent
+
     def hasChildren(self):
-        return len(self._children) > 0
+        return self.rowCount() > 0
 
     def childHasChildren(self, row):
         return self.childAt(row).hasChildren()
 
+    def keyRowCount(self):
+        """
+        The number of rows in front of the children which show the
+        key/value pairs of the item, see KeyValueModelItem.
+        """
+        return 0
+
     def row(self):
+        if self._parent is None:
+            return self._row
+        return self._position() + self._parent.keyRowCount()
+
+    def _position(self):
+        # Position of the item in the children list of its parent, i.e.
+        # the row without the key/value rows of the parent
+        parent = self._parent
+        if parent is not None and parent._rows is not None:
+            return parent._rows.position(self._row)
         return self._row
 
+    def _slot(self, pos):
+        # Slot of the child at position pos
+        if self._rows is None:
+            return pos
+        return self._rows.slot(pos)
+
+    def _newSlot(self, pos):
+        # Returns the slot for a child inserted at position pos.  As long as
+        # children are only appended, the slots are the positions.  The
+        # _RowIndex is created when a child is inserted in front of others
+        # or removed, so the positions of the following children need not
+        # be renumbered.
+        if pos == len(self._children):
+            if self._rows is None:
+                return pos
+            return self._rows.append()
+        if self._rows is None:
+            self._rows = _RowIndex([1] * len(self._children))
+        slot, first, slots = self._rows.insert(pos)
+        for i, child_slot in enumerate(slots):
+            child = self._children[first + i]
+            if isinstance(child, ModelItem):
+                child._row = child_slot
+        return slot
+
+    def _releaseSlot(self, pos):
+        # Called before the child at position pos is removed
+        if self._rows is None:
+            self._rows = _RowIndex([1] * len(self._children))
+        self._rows.release(self._slot(pos))
+
+    def _compactRows(self):
+        # Called after a child has been removed.  Rebuilds the _RowIndex
+        # once most of its slots are empty, with an empty slot in front of
+        # every child.
+        if self._rows is not None and self._rows.sparse():
+            self._rows = _RowIndex([0, 1] * len(self._children))
+            for i, child in enumerate(self._children):
+                if isinstance(child, ModelItem):
+                    child._row = 2 * i + 1
+
     def rowCount(self):
-        return len(self._children)
+        return self.keyRowCount() + len(self._children)
 
     def childRowCount(self, pos):
         return self.childAt(pos).rowCount()
@@ -91,19 +397,54 @@ class ModelItem:
     def setData(self, value, role=Qt.DisplayRole, column=0):
         return False
 
-    def childAt(self, pos):
+    def childAt(self, row):
+        pos = row - self.keyRowCount()
         self._ensureLoaded(pos)
         return self._children[pos]
 
+    def dirty(self):
+        return False
+
+    def setDirty(self, dirty=True):
+        """
+        Mark the item as modified.  The modification is propagated to the
+        parent items up to the file or frame item the item belongs to.
+        """
+        if dirty and self._parent is not None:
+            self._parent.setDirty()
+
+    def _dataIndex(self):
+        # Position of the item in the list of files, frames or annotations
+        # of its parent
+        return self._position()
+
+    def dataPath(self):
+        """
+        Returns the list of positions which leads from the list of file
+        entries to the entry of this item, e.g. ``[file, frame, annotation]``.
+        """
+        path = []
+        item = self
+        while item._parent is not None:
+            path.append(item._dataIndex())
+            item = item._parent
+        path.reverse()
+        return path
+
+    def _record(self, op, *args):
+        if self._model is not None and self._model.journal() is not None:
+            self._model.journal().record(op, self, *args)
+
     def getPreviousSibling(self, step=1):
         # clip, instead of wrap around
-        if self._row - step < 0:
-            return self.getSibling(self._row)
+        row = self.row()
+        if row - step < 0:
+            return self.getSibling(row)
         else:
-            return self.getSibling(self._row-step)
+            return self.getSibling(row-step)
 
     def getNextSibling(self, step=1):
-        return self.getSibling(self._row+step)
+        return self.getSibling(self.row()+step)
 
     def getSibling(self, row):
         if self._parent is not None:
@@ -113,6 +454,12 @@ class ModelItem:
                 pass
         return None
 
+    def _detachFromModel(self):
+        # Called when the item is removed from the model
+        for item in self._children:
+            if isinstance(item, ModelItem):
+                item._detachFromModel()
+
     def _attachToModel(self, model):
         #assert self.model() is None
         #assert self.parent() is not None
@@ -128,7 +475,7 @@ class ModelItem:
             return QModelIndex()
         if column >= self._model.columnCount():
             return QModelIndex()
-        return self._model.createIndex(self._row, column, self._parent)
+        return self._model.createIndex(self.row(), column, self._parent)
 
     def addChildSorted(self, item, signalModel=True):
         self.insertChild(-1, item, signalModel=signalModel)
@@ -138,29 +485,35 @@ class ModelItem:
 
     def replaceChild(self, pos, item):
         item._parent = self
-        item._row    = pos
+        item._row    = self._slot(pos)
         self._children[pos] = item
         if self._model is not None:
             self._children[pos]._attachToModel(self._model)
 
     def insertChild(self, pos, item, signalModel=True):
+        # pos is the position among the children, the key/value rows
+        # are not counted
         if pos >= 0:
-            next_row = pos
+            next_pos = min(pos, len(self._children))
         else:
-            next_row = len(self._children)
+            next_pos = len(self._children)
         if self._model is not None and signalModel:
-            self._model.beginInsertRows(self.index(), next_row, next_row)
+            row = self.keyRowCount() + next_pos
+            self._model.beginInsertRows(self.index(), row, row)
 
+        if not self._children:
+            self._children = []
         item._parent = self
-        item._row    = next_row
-        self._children.insert(next_row, item)
+        item._row    = self._newSlot(next_pos)
+        self._children.insert(next_pos, item)
 
-        if pos >= 0:
-            for i, c in enumerate(self._children):
-                c._row = i
+        if self._countsComputed():
+            self._updateCounts(item._getCounts())
 
         if self._model is not None:
             item._attachToModel(self._model)
+            self.setDirty()
+            self._record('insert', item)
             if signalModel:
                 self._model.endInsertRows()
 
@@ -170,18 +523,31 @@ class ModelItem:
             #assert item.model() is None
             #assert item.parent() is None
 
-        next_row = len(self._children)
+        if len(items) == 0:
+            return
+        next_pos = len(self._children)
         if self._model is not None and signalModel:
-            self._model.beginInsertRows(self.index(), next_row, next_row + len(items) - 1)
+            row = self.keyRowCount() + next_pos
+            self._model.beginInsertRows(self.index(), row, row + len(items) - 1)
 
-        for i, item in enumerate(items):
+        if not self._children:
+            self._children = []
+        for item in items:
             item._parent = self
-            item._row = next_row + i
+            item._row = self._newSlot(len(self._children))
             self._children.append(item)
 
+        if self._countsComputed():
+            delta = Counter()
+            for item in items:
+                delta.update(item._getCounts())
+            self._updateCounts(delta)
+
         if self._model is not None:
             for item in items:
                 item._attachToModel(self._model)
+                self._record('insert', item)
+            self.setDirty()
             if signalModel:
                 self._model.endInsertRows()
 
@@ -194,32 +560,58 @@ class ModelItem:
     def deleteChild(self, arg):
         # Grandchildren are considered deleted automatically
         if isinstance(arg, ModelItem):
-            return self.deleteChild(self._children.index(arg))
+            pos = arg._position()
+            if arg._parent is not self or pos >= len(self._children) or self._children[pos] is not arg:
+                raise ValueError("item is not a child of this item")
         else:
-            if arg < 0 or arg >= len(self._children):
+            pos = arg - self.keyRowCount()
+            if pos < 0 or pos >= len(self._children):
                 raise IndexError("child index out of range")
-            self._ensureLoaded(arg)
-
-            if self._model is not None:
-                self._model.beginRemoveRows(self.index(), arg, arg)
+            self._ensureLoaded(pos)
 
-            del self._children[arg]
+        if self._model is not None:
+            self._record('remove', self._children[pos])
+            row = self.keyRowCount() + pos
+            self._model.beginRemoveRows(self.index(), row, row)
 
-            # Update cached row numbers
-            for i, c in enumerate(self._children):
-                c._row = i
+        if self._countsComputed():
+            self._updateCounts(self._children[pos]._getCounts(), subtract=True)
+        self._children[pos]._detachFromModel()
+        self._releaseSlot(pos)
+        del self._children[pos]
+        self._compactRows()
 
-            if self._model is not None:
-                self._model.endRemoveRows()
+        if self._model is not None:
+            self.setDirty()
+            self._model.endRemoveRows()
 
     def deleteAllChildren(self):
-        self._ensureAllLoaded()
+        signal = self._model is not None and len(self._children) > 0
         if self._model is not None:
-            self._model.beginRemoveRows(self.index(), 0, len(self._children) - 1)
-
-        self._children = []
+            self._record('clear')
+        if signal:
+            first = self.keyRowCount()
+            self._model.beginRemoveRows(self.index(), first, first + len(self._children) - 1)
+
+        # the children which have not been loaded yet are dropped as they are
+        if self._countsComputed():
+            delta = Counter()
+            for child in self._children:
+                if isinstance(child, ModelItem):
+                    delta.update(child._getCounts())
+                else:
+                    self._rawChildCounts(child, delta)
+            self._updateCounts(delta, subtract=True)
+        for child in self._children:
+            if isinstance(child, ModelItem):
+                child._detachFromModel()
+        self._children = ()
+        self._unloaded = 0
+        self._rows = None
 
         if self._model is not None:
+            self.setDirty()
+        if signal:
             self._model.endRemoveRows()
 
     def getColor(self):
@@ -227,21 +619,108 @@ class ModelItem:
 
 
 class RootModelItem(ModelItem):
+    __slots__ = ('_pending', '_dirty')
+
+    # number of file entries pulled from a generator per fetchMore()
+    fetch_batch_size = 1000
+
     def __init__(self, model, files):
         ModelItem.__init__(self)
         self._model = model
-        self._toload = []
-        for f in files:
-            self._toload.append(f)
-            self._children.append(f)
-        self._loaded = False
+        self._pending = None
+        self._dirty = False
+        if isinstance(files, (list, tuple)):
+            self._appendUnloaded(files)
+        else:
+            # files is an iterator (e.g. from the StreamingJsonContainer),
+            # its entries are appended on demand in fetchMore()
+            self._pending = iter(files)
 
     def _load(self, index):
-        self._toload.remove(self._children[index])
         fi = FileModelItem.create(self._children[index])
         self.replaceChild(index, fi)
-        if len(self._toload) == 0:
-            self._loaded = True
+
+    def canFetchMore(self):
+        return self._pending is not None
+
+    def fetchMore(self, count=None):
+        """
+        Append up to ``count`` raw file entries from the pending iterator.
+        """
+        if self._pending is None:
+            return
+        entries = []
+        for f in self._pending:
+            entries.append(f)
+            if len(entries) >= (count or self.fetch_batch_size):
+                break
+        else:
+            self._pending = None
+        self.appendEntries(entries)
+
+    def appendEntries(self, entries):
+        """
+        Append raw file entries, e.g. the ones parsed by a loader thread.
+        The views are notified with a single insertion of rows.
+        """
+        if len(entries) == 0:
+            return
+
+        next_row = len(self._children)
+        if self._model is not None:
+            # fetching is part of loading, not a modification
+            self._model._fetching = True
+            self._model.beginInsertRows(QModelIndex(), next_row, next_row + len(entries) - 1)
+        self._appendUnloaded(entries)
+        if self._model is not None:
+            self._model.endInsertRows()
+            self._model._fetching = False
+
+    def _fetchAll(self):
+        while self._pending is not None:
+            self.fetchMore()
+
+    def dirty(self):
+        return self._dirty
+
+    def setDirty(self, dirty=True):
+        """
+        Mark the list of file items as modified, i.e. files were added or
+        removed.  ``setDirty(False)`` marks all file items as unmodified.
+        """
+        self._dirty = dirty
+        if not dirty:
+            for child in self._children:
+                if isinstance(child, ModelItem):
+                    child.setDirty(False)
+
+    def dirtyRows(self):
+        """
+        Returns the rows of the file items which have been modified since
+        the annotations were loaded or last saved, or None if file items
+        have been added or removed in the meantime.
+        """
+        if self._dirty:
+            return None
+        return [row for row, child in enumerate(self._children)
+                if isinstance(child, ModelItem) and child.dirty()]
+
+    def _ensureAllLoaded(self):
+        self._fetchAll()
+        return ModelItem._ensureAllLoaded(self)
+
+    def deleteAllChildren(self):
+        # the pending entries have not been inserted into the model yet
+        self._pending = None
+        ModelItem.deleteAllChildren(self)
+
+    def hasChildren(self):
+        return ModelItem.hasChildren(self) or self.canFetchMore()
+
+    def childAt(self, pos):
+        while pos >= len(self._children) and self.canFetchMore():
+            self.fetchMore()
+        return ModelItem.childAt(self, pos)
 
     def childHasChildren(self, pos):
         if isinstance(self._children[pos], ModelItem):
@@ -277,56 +756,225 @@ class RootModelItem(ModelItem):
         diff2 = time.time() - start2
         LOG.debug("Creation of ModelItems: %.2fs, addition to model: %.2fs" % (diff1, diff2))
 
+    def _rawChildCounts(self, entry, counts=None):
+        return _entryCounts(entry, 'files', counts, self._countValues())
+
     def numFiles(self):
-        return len(self.children())
+        """
+        The number of files.  Entries which are still pending in the
+        iterator the model was created from are not counted.
+        """
+        return self._getCounts()['files']
+
+    def numFrames(self):
+        return self._getCounts()['frames']
 
     def numAnnotations(self):
-        count = 0
-        for ann in self._model.iterator(AnnotationModelItem):
-            count += 1
-        return count
+        return self._getCounts()['annotations']
 
     def getAnnotations(self):
-        return [child.getAnnotations() for child in self.children()
-                if hasattr(child, 'getAnnotations')]
+        """
+        Returns a copy of the file entries of the model.
+        """
+        return [copy.deepcopy(_rawEntry(entry)) for entry in self.fileEntries()]
+
+    def fileEntries(self):
+        """
+        Returns the file entries of the model for saving them, without
+        copying them.  Unmodified file items share their entries with the
+        model, and the entries of files which have not been loaded are
+        returned as they were read (e.g. with the lazy SqliteRows of the
+        SqliteContainer).  The entries must not be modified.
+        """
+        self._fetchAll()
+        return [child._serialize() if isinstance(child, ModelItem) else child
+                for child in self._children]
+
+
+def _entryCounts(entry, count_key, counts=None, count_values=None):
+    """
+    Returns the counts (see ModelItem.counts()) of a raw file, frame or
+    annotation entry, counting the entry itself as ``count_key``.  The
+    counts are added to ``counts``, if given.  The values of the keys in
+    ``count_values`` are counted, by default the ones of
+    ``KeyValueModelItem.count_values``.
+    """
+    if counts is None:
+        counts = Counter()
+    if count_values is None:
+        count_values = KeyValueModelItem.count_values
+    counts[count_key] += 1
+    for flag in KeyValueModelItem.count_flags:
+        if entry.get(flag):
+            counts[flag] += 1
+    for key in count_values:
+        if key in entry:
+            _countValue(counts, key, entry[key])
+    for key in ('frames', 'annotations'):
+        children = entry.get(key, ())
+        # lazily read children (e.g. SqliteRows) may be counted without
+        # reading them
+        if hasattr(children, 'entryCounts'):
+            child_counts = children.entryCounts(KeyValueModelItem.count_flags, count_values)
+            if child_counts is not None:
+                counts.update(child_counts)
+                continue
+        for child in children:
+            _entryCounts(child, key, counts, count_values)
+    return counts
+
+
+def _countValue(counts, key, value, n=1):
+    # Count the (key, value) pair, unhashable values are not counted
+    try:
+        counts[(key, value)] += n
+    except TypeError:
+        pass
 
 
-class KeyValueModelItem(ModelItem, MutableMapping):
+def _matches(entry, conditions):
+    # Whether the item or raw entry has the (key, value) pairs of conditions
+    for key, value in conditions:
+        if key in KeyValueModelItem.count_flags:
+            if bool(entry.get(key)) != bool(value):
+                return False
+        elif entry.get(key) != value:
+            return False
+    return True
+
+
+def _mayMatch(counts, conditions, count_values):
+    # Whether a subtree with the given counts can contain items matching
+    # conditions
+    for key, value in conditions:
+        if key in KeyValueModelItem.count_flags:
+            if value and counts[key] == 0:
+                return False
+        elif key in count_values:
+            try:
+                if counts[(key, value)] == 0:
+                    return False
+            except TypeError:
+                pass
+    return True
+
+
+def _rawEntry(entry):
+    """
+    Returns a file entry as read by a container, such that it can be passed
+    to any container for saving.  Lazily read sequences (such as the
+    SqliteRows of the SqliteContainer) are converted into lists.
+    """
+    for key in ('annotations', 'frames'):
+        if key in entry and not isinstance(entry[key], list):
+            entry = dict(entry)
+            entry[key] = list(entry[key])
+    return entry
+
+
+class KeyValueModelItem(ModelItem):
+    # The mapping methods are implemented here instead of deriving from
+    # MutableMapping, which has no __slots__ on python 2 and would give every
+    # item a __dict__
+    __slots__ = ('_dict', '_shared', '_hidden', '_key_rows', '_seen')
+
+    # keys which are not shown as key/value rows, shared by all items
+    hidden_keys = frozenset([None, 'class', 'unlabeled', 'unconfirmed'])
+    # keys whose (true) values are counted in counts()
+    count_flags = ('unlabeled', 'unconfirmed')
+    # keys whose values are counted in counts() as (key, value) pairs, by
+    # default; see AnnotationModel.countValues()
+    count_values = ('class', )
+
     def __init__(self, hidden=None, properties=None):
         ModelItem.__init__(self)
-        self._dict = {}
-        self._items = {}
-        self._hidden = set(hidden or [])
-        self._hidden.update({None, 'class', 'unlabeled', 'unconfirmed'})
+        if hidden:
+            self._hidden = self.hidden_keys.union(hidden)
+        else:
+            self._hidden = self.hidden_keys
+        # The properties are shared with the caller (usually the raw entry
+        # read by the container) until they are modified for the first time
+        if properties is None:
+            self._dict = {}
+            self._shared = False
+        elif isinstance(properties, dict):
+            self._dict = properties
+            self._shared = True
+        else:
+            self._dict = dict(properties)
+            self._shared = False
+        # the KeyValueRowModelItems, created when they are accessed
+        self._key_rows = None
         self._seen = False
 
-        # dummy key/value so that pyqt does not convert the dict
-        # into a QVariantMap while communicating with the Views
-        self._dict[None] = None
-        if properties is not None:
-            self._dict.update(properties)
-            items_to_add = []
-            for key in self._dict.keys():
-                if key not in self._hidden:
-                    item = KeyValueRowModelItem(key)
-                    self._items[key] = item
-                    items_to_add.append(item)
-            items_to_add.sort(key=lambda x: x.key())
-            self.appendChildren(items_to_add, False)
+    def _ownDict(self):
+        # Returns the properties for modification
+        if self._shared:
+            self._dict = dict(self._dict)
+            self._shared = False
+        return self._dict
+
+    def _storeValue(self, key, value):
+        self._ownDict()[key] = value
+
+    def _removeValue(self, key):
+        # Removes key and returns its value
+        return self._ownDict().pop(key)
+
+    def keyRowCount(self):
+        count = len(self)
+        for key in self._hidden:
+            if key in self._dict:
+                count -= 1
+        return count
 
-    def addChildSorted(self, item, signalModel=True):
-        if isinstance(item, KeyValueRowModelItem):
-            next_row = 0
-            for child in self._children:
-                if not isinstance(child, KeyValueRowModelItem) or child.key() > item.key():
-                    break
-                next_row += 1
+    def _keyRowPosition(self, key):
+        # Row of the key/value row of key, the rows are sorted by key
+        return sum(1 for k in self if k not in self._hidden and k < key)
+
+    def _keyRows(self):
+        if self._key_rows is None:
+            keys = sorted(k for k in self if k not in self._hidden)
+            self._key_rows = [self._createKeyRow(key) for key in keys]
+        return self._key_rows
 
-            self.insertChild(next_row, item, signalModel)
+    def _createKeyRow(self, key):
+        item = KeyValueRowModelItem(key)
+        item._parent = self
+        item._model = self._model
+        return item
+
+    def childAt(self, row):
+        if 0 <= row < self.keyRowCount():
+            return self._keyRows()[row]
+        return ModelItem.childAt(self, row)
+
+    def _attachToModel(self, model):
+        ModelItem._attachToModel(self, model)
+        if self._key_rows is not None:
+            for item in self._key_rows:
+                item._model = model
+
+    def deleteChild(self, arg):
+        if isinstance(arg, KeyValueRowModelItem):
+            if arg._parent is not self or arg.key() not in self:
+                raise ValueError("item is not a child of this item")
+            del self[arg.key()]
+        elif not isinstance(arg, ModelItem) and 0 <= arg < self.keyRowCount():
+            del self[self._keyRows()[arg].key()]
         else:
-            self.appendChild(item, signalModel)
+            ModelItem.deleteChild(self, arg)
 
-    # Methods for MutableMapping
+    def data(self, role=Qt.DisplayRole, column=0):
+        if role == DataRole:
+            # dummy key/value so that pyqt does not convert the dict
+            # into a QVariantMap while communicating with the Views
+            res = {None: None}
+            res.update((key, self[key]) for key in self)
+            return res
+        return ModelItem.data(self, role, column)
+
+    # Mapping methods
     def __len__(self):
         return len(self._dict)
 
@@ -336,34 +984,119 @@ class KeyValueModelItem(ModelItem, MutableMapping):
     def __getitem__(self, key):
         return self._dict[key]
 
+    def __contains__(self, key):
+        return key in self._dict
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def pop(self, key, *default):
+        if key not in self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = self[key]
+        del self[key]
+        return value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
     def _emitDataChanged(self, key=None):
         if self.model() is not None:
-            if key is not None and key in self._items:
-                index_tl = self._items[key].index()
-                index_br = self._items[key].index(1)
+            if key is not None and key in self and key not in self._hidden:
+                row = self._keyRowPosition(key)
+                index_tl = self.model().createIndex(row, 0, self)
+                index_br = self.model().createIndex(row, 1, self)
             else:
                 index_tl = self.index()
                 index_br = self.index(1)
-            self.model().dataChanged.emit(index_tl, index_br)
+            self.model().emitDataChanged(index_tl, index_br)
+
+    def _ownCounts(self):
+        counts = ModelItem._ownCounts(self)
+        for flag in self.count_flags:
+            if self._dict.get(flag):
+                counts[flag] += 1
+        for key in self._countValues():
+            if key in self:
+                _countValue(counts, key, self[key])
+        return counts
+
+    def _flagChanged(self, key, old_value, existed=True):
+        # Update the counts after the value of key changed from old_value
+        count_values = self._countValues()
+        if (key not in self.count_flags and key not in count_values) \
+                or not self._countsComputed():
+            return
+        delta = Counter()
+        if key in self.count_flags and bool(old_value) != bool(self._dict.get(key)):
+            delta[key] = -1 if old_value else 1
+        if key in count_values:
+            if existed:
+                _countValue(delta, key, old_value, -1)
+            if key in self:
+                _countValue(delta, key, self[key])
+        self._updateCounts(delta)
 
     def __setitem__(self, key, value, signalModel=True):
-        if key not in self._dict:
-            self._dict[key] = value
-            if key not in self._hidden:
-                self._items[key] = KeyValueRowModelItem(key)
-                self.addChildSorted(self._items[key], signalModel=signalModel)
+        if key not in self:
+            visible = key not in self._hidden
+            signal = visible and signalModel and self._model is not None
+            if visible:
+                row = self._keyRowPosition(key)
+            if signal:
+                self._model.beginInsertRows(self.index(), row, row)
+            self._storeValue(key, value)
+            if visible and self._key_rows is not None:
+                self._key_rows.insert(row, self._createKeyRow(key))
+            if signal:
+                self._model.endInsertRows()
+            self.setDirty()
+            self._record('set', key, value)
+            self._flagChanged(key, None, existed=False)
             if signalModel:
                 self._emitDataChanged(key)
-        elif self._dict[key] != value:
-            self._dict[key] = value
+        elif self[key] != value:
+            old_value = self[key]
+            self._storeValue(key, value)
+            self.setDirty()
+            self._record('set', key, value)
+            self._flagChanged(key, old_value)
             # TODO: Emit for hidden key/values?
             if signalModel:
                 self._emitDataChanged(key)
 
     def __delitem__(self, key):
-        del self._dict[key]
-        if key in self._items:
-            self.deleteChild(self._items[key])
+        if key not in self:
+            raise KeyError(key)
+        visible = key not in self._hidden
+        signal = visible and self._model is not None
+        if visible:
+            row = self._keyRowPosition(key)
+        if signal:
+            self._model.beginRemoveRows(self.index(), row, row)
+        old_value = self._removeValue(key)
+        if visible and self._key_rows is not None:
+            del self._key_rows[row]
+        if signal:
+            self._model.endRemoveRows()
+        self.setDirty()
+        self._record('delete', key)
+        self._flagChanged(key, old_value)
 
     def update(self, kvs):
         for key, value in kvs.items():
@@ -371,23 +1104,32 @@ class KeyValueModelItem(ModelItem, MutableMapping):
         self._emitDataChanged()
 
     def has_key(self, key):
-        return key in self._dict
+        return key in self
 
     def clear(self):
-        if len(self._dict) > 0:
-            MutableMapping.clear(self)
+        for key in self.keys():
+            del self[key]
 
     def getAnnotations(self):
-        res = copy.deepcopy(self._dict)
-        if None in res: del res[None]
-        return res
+        return copy.deepcopy(self._dict)
+
+    def _serialize(self):
+        # Returns the entry of the item for saving, which may be shared
+        # with the item
+        return self.getAnnotations()
 
     def isUnlabeled(self):
         return 'unlabeled' in self._dict and self._dict['unlabeled']
 
     def setUnlabeled(self, val):
         if val:
-            self._dict['unlabeled'] = val
+            if self._dict.get('unlabeled') != val:
+                existed = 'unlabeled' in self._dict
+                old_value = self._dict.get('unlabeled')
+                self._storeValue('unlabeled', val)
+                self.setDirty()
+                self._record('set', 'unlabeled', val)
+                self._flagChanged('unlabeled', old_value, existed)
         else:
             if 'unlabeled' in self._dict:
                 del self['unlabeled']
@@ -398,7 +1140,13 @@ class KeyValueModelItem(ModelItem, MutableMapping):
 
     def setUnconfirmed(self, val):
         if val:
-            self._dict['unconfirmed'] = val
+            if self._dict.get('unconfirmed') != val:
+                existed = 'unconfirmed' in self._dict
+                old_value = self._dict.get('unconfirmed')
+                self._storeValue('unconfirmed', val)
+                self.setDirty()
+                self._record('set', 'unconfirmed', val)
+                self._flagChanged('unconfirmed', old_value, existed)
         else:
             if 'unconfirmed' in self._dict:
                 del self['unconfirmed']
@@ -406,9 +1154,25 @@ class KeyValueModelItem(ModelItem, MutableMapping):
 
 
 class FileModelItem(KeyValueModelItem):
+    __slots__ = ('_dirty', '_raw')
+
+    hidden_keys = KeyValueModelItem.hidden_keys | frozenset(['filename'])
+    count_key = 'files'
+
     def __init__(self, fileinfo, hidden=None):
-        if not hidden: hidden = ['filename']
         KeyValueModelItem.__init__(self, hidden=hidden, properties=fileinfo)
+        self._dirty = False
+        # The file entry as returned by _serialize(), reused as long as the
+        # item is not modified.  Set by the subclasses.
+        self._raw = None
+
+    def dirty(self):
+        return self._dirty
+
+    def setDirty(self, dirty=True):
+        self._dirty = dirty
+        if dirty:
+            self._raw = None
 
     def data(self, role=Qt.DisplayRole, column=0):
         if role == Qt.DisplayRole:
@@ -416,7 +1180,7 @@ class FileModelItem(KeyValueModelItem):
                 return ('* ' if not self._seen else '') + os.path.basename(self['filename'])
             elif column == 1 and self.isUnlabeled():
                 return '[unlabeled]'
-        return ModelItem.data(self, role, column)
+        return KeyValueModelItem.data(self, role, column)
 
     def getColor(self):
         if self.isUnlabeled():
@@ -432,81 +1196,184 @@ class FileModelItem(KeyValueModelItem):
 
 
 class ImageModelItem(ModelItem):
+    # no slots of its own, it is combined with the other item classes
+    __slots__ = ()
+
     def __init__(self, annotations):
         ModelItem.__init__(self)
-        items_to_add = [AnnotationModelItem(ann) for ann in annotations]
-        self.appendChildren(items_to_add, False)
+        # the slot is declared by the subclasses, see spatialIndex()
+        self._spatial_index = None
+        # the annotation items are created from the raw annotations on demand
+        self._appendUnloaded(annotations)
+
+    def _detachFromModel(self):
+        self._spatial_index = None
+        ModelItem._detachFromModel(self)
+
+    def _load(self, index):
+        ann = AnnotationModelItem(self._children[index])
+        self.replaceChild(index, ann)
 
     def addAnnotation(self, ann, signalModel=True):
         self.addChildSorted(AnnotationModelItem(ann), signalModel=signalModel)
 
+    def replaceAnnotations(self, annotations):
+        """
+        Replaces all annotations of the image by ``annotations``.  The views
+        are notified with one removal and one insertion of rows.
+        """
+        self.deleteAllChildren()
+        self.appendChildren([AnnotationModelItem(ann) for ann in annotations])
+
+    def _serializedAnnotations(self):
+        # Not yet loaded annotations are returned as they were read
+        return [child.getAnnotations() if isinstance(child, ModelItem) else child
+                for child in self._children]
+
+    def annotationEntries(self):
+        """
+        Returns the annotations of the image without copying or loading
+        them, i.e. the AnnotationModelItems of the loaded annotations and
+        the raw entries of the others.  The entries must not be modified.
+        """
+        return list(self._children)
+
     def annotations(self):
+        self._ensureAllLoaded()
         for child in self._children:
             if isinstance(child, AnnotationModelItem):
                 yield child
 
+    def spatialIndex(self):
+        """
+        Returns the :class:`~sloth.annotations.geometry.SpatialIndex` over
+        the bounding boxes of the annotations of the image.  It is created
+        on first use and kept up to date with the modifications of the
+        annotations while the image is part of a model.
+        """
+        if self._spatial_index is None:
+            index = SpatialIndex()
+            for ann in self.annotations():
+                box = ann.boundingBox()
+                if box is not None:
+                    index.insert(ann, box)
+            if self._model is None:
+                return index
+            self._spatial_index = index
+        return self._spatial_index
+
+    def _updateSpatialIndex(self, ann, box):
+        if self._spatial_index is not None:
+            if box is None:
+                self._spatial_index.remove(ann)
+            else:
+                self._spatial_index.insert(ann, box)
+
+    def intersectingAnnotations(self, x, y, width=0, height=0):
+        """
+        Returns the annotation items whose bounding boxes intersect the
+        given rect, in the order of the annotations.
+        """
+        anns = self.spatialIndex().intersecting((x, y, width, height))
+        return sorted(anns, key=lambda ann: ann._position())
+
+    def annotationsAt(self, x, y):
+        return self.intersectingAnnotations(x, y)
+
     def confirmAll(self):
-        for ann in self.annotations():
-            ann.setUnconfirmed(False)
+        if self._model is None:
+            for ann in self.annotations():
+                ann.setUnconfirmed(False)
+            return
+        with self._model.batch():
+            for ann in self.annotations():
+                ann.setUnconfirmed(False)
 
 
 class ImageFileModelItem(FileModelItem, ImageModelItem):
-    def __init__(self, fileinfo):
-        self._annotation_data = fileinfo.get("annotations", [])
-        if "annotations" in fileinfo:
-            del fileinfo["annotations"]
-        FileModelItem.__init__(self, fileinfo)
-        ImageModelItem.__init__(self, [])
-        self._toload = []
-        for ann in self._annotation_data:
-            self._children.append(ann)
-            self._toload.append(ann)
-        self._loaded = False        
+    __slots__ = ('_spatial_index', )
 
-    def _load(self, index):
-        self._toload.remove(self._children[index])
-        ann = AnnotationModelItem(self._children[index])
-        self.replaceChild(index, ann)
-        if len(self._toload) == 0:
-            self._loaded = True
-
-    def data(self, role=Qt.DisplayRole, column=0):
-        if role == DataRole:
-            return self._dict
-        return FileModelItem.data(self, role, column)
+    def __init__(self, fileinfo):
+        annotations = fileinfo.get("annotations", [])
+        properties = dict((key, value) for key, value in fileinfo.items()
+                          if key != "annotations")
+        FileModelItem.__init__(self, properties)
+        ImageModelItem.__init__(self, annotations)
+        self._raw = _rawEntry(fileinfo)
 
     def getAnnotations(self):
-        self._ensureAllLoaded()
-        fi = KeyValueModelItem.getAnnotations(self)
-        fi['annotations'] = [child.getAnnotations() for child in self.children()
-                             if hasattr(child, 'getAnnotations')]
-        return fi
+        return copy.deepcopy(self._serialize())
+
+    def _serialize(self):
+        if self._raw is None:
+            fi = KeyValueModelItem.getAnnotations(self)
+            fi['annotations'] = self._serializedAnnotations()
+            self._raw = fi
+        return self._raw
 
 
 class VideoFileModelItem(FileModelItem):
+    __slots__ = ()
+
     def __init__(self, fileinfo):
         frameinfos = fileinfo.get("frames", [])
-        if "frames" in fileinfo:
-            del fileinfo["frames"]
-        FileModelItem.__init__(self, fileinfo)
+        properties = dict((key, value) for key, value in fileinfo.items()
+                          if key != "frames")
+        FileModelItem.__init__(self, properties)
+
+        # the frame items are created from the raw frames on demand
+        self._appendUnloaded(frameinfos)
+        self._raw = _rawEntry(fileinfo)
 
-        items_to_add = [FrameModelItem(frameinfo) for frameinfo in frameinfos]
-        self.appendChildren(items_to_add, False)
+    def _load(self, index):
+        frame = FrameModelItem(self._children[index])
+        self.replaceChild(index, frame)
+
+    def _rawChildCounts(self, entry, counts=None):
+        return _entryCounts(entry, 'frames', counts, self._countValues())
+
+    def setDirty(self, dirty=True):
+        FileModelItem.setDirty(self, dirty)
+        if not dirty:
+            for child in self._children:
+                if isinstance(child, FrameModelItem):
+                    child.setDirty(False)
 
     def getAnnotations(self):
-        self._ensureAllLoaded()
-        fi = KeyValueModelItem.getAnnotations(self)
-        fi['frames'] = [child.getAnnotations() for child in self.children()]
-        return fi
+        return copy.deepcopy(self._serialize())
+
+    def _serialize(self):
+        if self._raw is None:
+            fi = KeyValueModelItem.getAnnotations(self)
+            fi['frames'] = [child._serialize() if isinstance(child, ModelItem) else child
+                            for child in self._children]
+            self._raw = fi
+        return self._raw
 
 
 class FrameModelItem(ImageModelItem, KeyValueModelItem):
+    __slots__ = ('_dirty', '_raw', '_spatial_index')
+
+    count_key = 'frames'
+
     def __init__(self, frameinfo):
         annotations = frameinfo.get("annotations", [])
-        if "annotations" in frameinfo:
-            del frameinfo["annotations"]
-        KeyValueModelItem.__init__(self, properties=frameinfo)
+        properties = dict((key, value) for key, value in frameinfo.items()
+                          if key != "annotations")
+        KeyValueModelItem.__init__(self, properties=properties)
         ImageModelItem.__init__(self, annotations)
+        self._dirty = False
+        self._raw = frameinfo
+
+    def dirty(self):
+        return self._dirty
+
+    def setDirty(self, dirty=True):
+        self._dirty = dirty
+        if dirty:
+            self._raw = None
+            if self._parent is not None:
+                self._parent.setDirty()
 
     def framenum(self):
         return int(self.get('num', -1))
@@ -520,7 +1387,7 @@ class FrameModelItem(ImageModelItem, KeyValueModelItem):
                 return "%d / %.3f" % (self.framenum(), self.timestamp())
             elif column == 1 and self.isUnlabeled():
                 return '[unlabeled]'
-        return ImageModelItem.data(self, role, column)
+        return KeyValueModelItem.data(self, role, column)
 
     def getColor(self):
         if self.isUnlabeled():
@@ -528,15 +1395,162 @@ class FrameModelItem(ImageModelItem, KeyValueModelItem):
         return None
 
     def getAnnotations(self):
-        fi = KeyValueModelItem.getAnnotations(self)
-        fi['annotations'] = [child.getAnnotations() for child in self.children()
-                             if hasattr(child, 'getAnnotations')]
-        return fi
+        return copy.deepcopy(self._serialize())
+
+    def _serialize(self):
+        if self._raw is None:
+            fi = KeyValueModelItem.getAnnotations(self)
+            fi['annotations'] = self._serializedAnnotations()
+            self._raw = fi
+        return self._raw
 
 
 class AnnotationModelItem(KeyValueModelItem):
+    """
+    While the item is part of an AnnotationModel, its geometric attributes
+    (see :mod:`sloth.annotations.geometry`) are kept in the GeometryStore
+    of the model instead of its dict.
+    """
+    __slots__ = ('_geometry', '_geometry_row')
+
+    count_key = 'annotations'
+
     def __init__(self, annotation):
         KeyValueModelItem.__init__(self, properties=annotation)
+        self._geometry = None
+        self._geometry_row = -1
+
+    def _attachToModel(self, model):
+        KeyValueModelItem._attachToModel(self, model)
+        if self._geometry is None and model is not None:
+            self._storeGeometry(model.geometry())
+        self._geometryChanged()
+
+    def _detachFromModel(self):
+        if isinstance(self._parent, ImageModelItem):
+            self._parent._updateSpatialIndex(self, None)
+        self._restoreGeometry()
+
+    def _geometryChanged(self):
+        # keep the spatial index of the image up to date
+        if isinstance(self._parent, ImageModelItem):
+            self._parent._updateSpatialIndex(self, self.boundingBox())
+
+    def _storeGeometry(self, store):
+        table = store.table(self._dict.get('class'))
+        row = table.allocate(self)
+        self._geometry, self._geometry_row = table, row
+        for key in GEOMETRIC_KEYS:
+            if key in self._dict and table.set(row, key, self._dict[key]) \
+                    and not self._shared:
+                del self._dict[key]
+
+    def _restoreGeometry(self):
+        # Move the geometric attributes back into the dict
+        if self._geometry is None:
+            return
+        values = self._geometry.values(self._geometry_row)
+        self._ownDict().update(values)
+        self._geometry.release(self._geometry_row)
+        self._geometry, self._geometry_row = None, -1
+
+    def geometryTable(self):
+        """
+        Returns the GeometryTable the geometric attributes of the item are
+        stored in and the row of the item in it, or ``(None, -1)``.
+        """
+        return self._geometry, self._geometry_row
+
+    def _stored(self, key):
+        return self._geometry is not None and key in GEOMETRIC_KEYS \
+            and self._geometry.has(self._geometry_row, key)
+
+    def _ownDict(self):
+        if self._shared and self._geometry is not None:
+            # the shared dict may still contain outdated geometric values
+            stored = self._geometry.keys(self._geometry_row)
+            self._dict = dict((key, value) for key, value in self._dict.items()
+                              if key not in stored)
+            self._shared = False
+        return KeyValueModelItem._ownDict(self)
+
+    def _storeValue(self, key, value):
+        if self._geometry is not None and key in GEOMETRIC_KEYS:
+            if self._geometry.set(self._geometry_row, key, value):
+                if not self._shared:
+                    self._dict.pop(key, None)
+            else:
+                self._ownDict()[key] = value
+            self._geometryChanged()
+        else:
+            old_class = self._dict.get('class')
+            KeyValueModelItem._storeValue(self, key, value)
+            if key == 'class' and self._geometry is not None and value != old_class:
+                self._restoreGeometry()
+                self._storeGeometry(self._model.geometry())
+
+    def _removeValue(self, key):
+        if self._stored(key):
+            value = self._geometry.get(self._geometry_row, key)
+            self._ownDict()
+            self._geometry.delete(self._geometry_row, key)
+            self._geometryChanged()
+            return value
+        return KeyValueModelItem._removeValue(self, key)
+
+    def __len__(self):
+        if self._geometry is None:
+            return len(self._dict)
+        return len(self._dict) + sum(1 for key in self._geometry.keys(self._geometry_row)
+                                     if key not in self._dict)
+
+    def __iter__(self):
+        for key in self._dict:
+            yield key
+        if self._geometry is not None:
+            for key in self._geometry.keys(self._geometry_row):
+                if key not in self._dict:
+                    yield key
+
+    def __getitem__(self, key):
+        if self._stored(key):
+            return self._geometry.get(self._geometry_row, key)
+        return self._dict[key]
+
+    def __contains__(self, key):
+        return key in self._dict or self._stored(key)
+
+    def getAnnotations(self):
+        res = KeyValueModelItem.getAnnotations(self)
+        if self._geometry is not None:
+            res.update(self._geometry.values(self._geometry_row))
+        return res
+
+    def boundingBox(self):
+        """
+        Returns the bounding box of the geometry of the annotation as
+        ``(x, y, width, height)``, see
+        :meth:`~sloth.annotations.geometry.GeometryTable.boundingBoxes`, or
+        None if it has no geometry.
+        """
+        if self._geometry is not None:
+            return self._geometry.boundingBox(self._geometry_row)
+        table = GeometryTable(None, capacity=1)
+        row = table.allocate(None)
+        for key in GEOMETRIC_KEYS:
+            if key in self._dict:
+                table.set(row, key, self._dict[key])
+        return table.boundingBox(row)
+
+    def vertices(self, xkey='xn', ykey='yn'):
+        """
+        Returns the vertices of the polygon given by ``xkey`` and ``ykey``
+        as array of shape (n, 2).  Raises KeyError if a key is missing.
+        """
+        xn, yn = [self._geometry.vertices(self._geometry_row, key) if self._stored(key)
+                  else parseVertices(self._dict[key]) for key in (xkey, ykey)]
+        n = min(len(xn), len(yn))
+        return np.column_stack((xn[:n], yn[:n]))
 
     # Delegated from QAbstractItemModel
     def data(self, role=Qt.DisplayRole, column=0):
@@ -551,9 +1565,7 @@ class AnnotationModelItem(KeyValueModelItem):
                 return '[unconfirmed]'
             else:
                 return ""
-        elif role == DataRole:
-            return self._annotation
-        return ModelItem.data(self, role, column)
+        return KeyValueModelItem.data(self, role, column)
 
     def getColor(self):
         if self.isUnconfirmed():
@@ -562,6 +1574,8 @@ class AnnotationModelItem(KeyValueModelItem):
 
 
 class KeyValueRowModelItem(ModelItem):
+    __slots__ = ('_key', '_read_only')
+
     def __init__(self, key, read_only=True):
         ModelItem.__init__(self)
         self._key = key
@@ -570,6 +1584,9 @@ class KeyValueRowModelItem(ModelItem):
     def key(self):
         return self._key
 
+    def row(self):
+        return self._parent._keyRowPosition(self._key)
+
     def data(self, role=Qt.DisplayRole, column=0):
         if role == Qt.DisplayRole:
             if column == 0:
@@ -603,12 +1620,24 @@ class AnnotationModel(QAbstractItemModel):
     # signals
     dirtyChanged = pyqtSignal(bool, name='dirtyChanged')
 
-    def __init__(self, annotations, parent=None):
+    def __init__(self, annotations, parent=None, count_values=None):
         QAbstractItemModel.__init__(self, parent)
 
         start = time.time()
+        if count_values is None:
+            count_values = KeyValueModelItem.count_values
+        self._count_values = tuple(count_values)
         self._annotations = annotations
         self._dirty = False
+        self._fetching = False
+        self._journal = None
+        self._geometry = GeometryStore()
+        # state of the current batch(), see _deferSignal()
+        self._batch_depth = 0
+        self._batch_persistent = None
+        self._batch_changed = {}
+        self._batch_modified = False
+        self._loading = False
         self._root = RootModelItem(self, annotations)
         diff = time.time() - start
         LOG.info("Created AnnotationModel in %.2fs" % (diff, ))
@@ -680,6 +1709,15 @@ class AnnotationModel(QAbstractItemModel):
         parent = self.parentFromIndex(index)
         return parent.childFlags(index.row(), index.column())
 
+    def canFetchMore(self, index=QModelIndex()):
+        if index.isValid():
+            return False
+        return self._root.canFetchMore()
+
+    def fetchMore(self, index=QModelIndex()):
+        if not index.isValid():
+            self._root.fetchMore()
+
     def headerData(self, section, orientation, role):
         if orientation == Qt.Horizontal and role == Qt.DisplayRole:
             if section == 0:
@@ -696,13 +1734,161 @@ class AnnotationModel(QAbstractItemModel):
         return self._dirty
 
     def setDirty(self, dirty=True):
+        if not dirty:
+            # all items are in sync with the label file again
+            self._root.setDirty(False)
         if dirty != self._dirty:
             LOG.debug("Setting model state to dirty")
             self._dirty = dirty
             self.dirtyChanged.emit(self._dirty)
 
+    def loading(self):
+        """
+        Whether file entries are still being added to the model by a loader
+        running in the background.
+        """
+        return self._loading
+
+    def setLoading(self, loading):
+        self._loading = loading
+
+    def journal(self):
+        return self._journal
+
+    def geometry(self):
+        """
+        The GeometryStore which holds the geometric attributes of the
+        annotation items, see :mod:`sloth.annotations.geometry`.
+        """
+        return self._geometry
+
+    def setJournal(self, journal):
+        """
+        Set the journal to which all modifications of the model items are
+        recorded, see :class:`sloth.annotations.container.JournalContainer`.
+        """
+        self._journal = journal
+
     def onDataChanged(self, *args):
-        self.setDirty()
+        if not self._fetching:
+            self.setDirty()
+
+    @contextmanager
+    def batch(self):
+        """
+        Context manager for bulk modifications of the model.  The row and
+        data change signals of all modifications inside the block are
+        deferred until the block is left.  Then a single ``layoutChanged``
+        is emitted if rows were inserted or removed, otherwise one
+        ``dataChanged`` per parent, spanning all changed rows.  Batches
+        can be nested, the signals are emitted when the outermost one ends::
+
+            with model.batch():
+                for ann in annotations:
+                    image_item.addAnnotation(ann)
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self._endBatch()
+
+    def inBatch(self):
+        return self._batch_depth > 0
+
+    def _deferSignal(self, structural):
+        # Returns whether the signal has to be held back because of a
+        # running batch.  The persistent indexes are recorded before the
+        # first change of the structure, so they can be mapped to the new
+        # rows when the batch ends.
+        if self._batch_depth == 0:
+            return False
+        if not self._fetching:
+            self._batch_modified = True
+        if structural and self._batch_persistent is None:
+            self.layoutAboutToBeChanged.emit()
+            self._batch_persistent = [(index, self.itemFromIndex(index), index.column())
+                                      for index in self.persistentIndexList()]
+        return True
+
+    def beginInsertRows(self, parent, first, last):
+        if not self._deferSignal(True):
+            QAbstractItemModel.beginInsertRows(self, parent, first, last)
+
+    def endInsertRows(self):
+        if self._batch_depth == 0:
+            QAbstractItemModel.endInsertRows(self)
+
+    def beginRemoveRows(self, parent, first, last):
+        if not self._deferSignal(True):
+            QAbstractItemModel.beginRemoveRows(self, parent, first, last)
+
+    def endRemoveRows(self):
+        if self._batch_depth == 0:
+            QAbstractItemModel.endRemoveRows(self)
+
+    def emitDataChanged(self, index_from, index_to):
+        """
+        Emits ``dataChanged``, or merges the range into the pending range of
+        the same parent while a batch is running.
+        """
+        if not index_from.isValid() or not self._deferSignal(False):
+            self.dataChanged.emit(index_from, index_to)
+            return
+        parent = index_from.internalPointer()
+        changed = self._batch_changed.get(id(parent))
+        if changed is None:
+            self._batch_changed[id(parent)] = [parent, index_from.row(), index_to.row(),
+                                               index_from.column(), index_to.column()]
+        else:
+            changed[1] = min(changed[1], index_from.row())
+            changed[2] = max(changed[2], index_to.row())
+            changed[3] = min(changed[3], index_from.column())
+            changed[4] = max(changed[4], index_to.column())
+
+    def _containsItem(self, item):
+        # Whether item is (still) part of the tree
+        while item is not self._root:
+            parent = item.parent()
+            if parent is None:
+                return False
+            if isinstance(item, KeyValueRowModelItem):
+                if not any(row is item for row in parent._key_rows or ()):
+                    return False
+            else:
+                pos = item._position()
+                if pos >= len(parent._children) or parent._children[pos] is not item:
+                    return False
+            item = parent
+        return True
+
+    def _endBatch(self):
+        persistent, self._batch_persistent = self._batch_persistent, None
+        changed, self._batch_changed = self._batch_changed, {}
+        modified, self._batch_modified = self._batch_modified, False
+
+        if persistent is not None:
+            # The structure changed, this invalidates all row ranges, the
+            # views have to query the model again anyway
+            old_indexes, new_indexes = [], []
+            for index, item, column in persistent:
+                old_indexes.append(index)
+                if item is not self._root and self._containsItem(item):
+                    new_indexes.append(item.index(column))
+                else:
+                    new_indexes.append(QModelIndex())
+            self.changePersistentIndexList(old_indexes, new_indexes)
+            self.layoutChanged.emit()
+        else:
+            for parent, first, last, first_column, last_column in changed.values():
+                if parent is not self._root and not self._containsItem(parent):
+                    continue
+                self.dataChanged.emit(self.createIndex(first, first_column, parent),
+                                      self.createIndex(last, last_column, parent))
+        if modified:
+            self.setDirty()
 
     def itemFromIndex(self, index):
         index = QModelIndex(index)  # explicitly convert from QPersistentModelIndex
@@ -716,8 +1902,68 @@ class AnnotationModel(QAbstractItemModel):
             return index.internalPointer()
         return self._root
 
+    def countValues(self):
+        """
+        The keys whose values are counted in the counts() of the items as
+        ``(key, value)`` pairs, as passed to the constructor (see
+        config.INDEXED_ATTRIBUTES).
+        """
+        return self._count_values
+
+    def select(self, conditions=None, _class=None, start=None):
+        """
+        Returns the items in the subtree of ``start`` (by default the whole
+        model) which are instances of ``_class`` and whose attributes have
+        the values given by the dict ``conditions``, e.g.::
+
+            model.select({'class': 'face', 'unconfirmed': True}, AnnotationModelItem)
+
+        The flags ``unlabeled`` and ``unconfirmed`` are compared as booleans.
+        Subtrees without matches are skipped using their counts() for the
+        keys in ``KeyValueModelItem.count_flags`` and :meth:`countValues`.
+        Files, frames and annotations which have not been loaded yet are
+        matched on their raw entries, only the matching annotations and the
+        files and frames which may contain matches are turned into model
+        items.
+        """
+        conditions = list((conditions or {}).items())
+        if start is None:
+            start = self._root
+            self._root._fetchAll()
+        result = []
+        self._select(start, conditions, _class, result)
+        return result
+
+    def _select(self, item, conditions, _class, result):
+        if item._children and not _mayMatch(item._getCounts(), conditions, self._count_values):
+            return
+        if (_class is None or isinstance(item, _class)) and \
+                (not conditions or isinstance(item, KeyValueModelItem)) and \
+                _matches(item, conditions):
+            result.append(item)
+
+        # the raw children of images are annotations, they are matched
+        # without loading them
+        raw_annotations = isinstance(item, ImageModelItem)
+        match_raw = _class is None or issubclass(AnnotationModelItem, _class)
+        offset = item.keyRowCount()
+        for pos in range(len(item._children)):
+            child = item._children[pos]
+            if not isinstance(child, ModelItem):
+                if raw_annotations:
+                    if match_raw and _matches(child, conditions):
+                        result.append(item.childAt(offset + pos))
+                    continue
+                # raw files and frames are only loaded if their subtree
+                # may contain matches
+                if not _mayMatch(item._rawChildCounts(child), conditions, self._count_values):
+                    continue
+                item._ensureLoaded(pos)
+                child = item._children[pos]
+            self._select(child, conditions, _class, result)
+
     def iterator(self, _class=None, predicate=None, start=None, maxlevels=10000):
-        # Visit all nodes
+        # Visit all nodes, except for the key/value rows
         level = 0
         item = start if start is not None else self.root()
         while item is not None:
@@ -727,9 +1973,10 @@ class AnnotationModel(QAbstractItemModel):
                     yield item
 
             # Get next item
-            if item.rowCount() > 0 and level < maxlevels:
+            first = item.keyRowCount()
+            if item.rowCount() > first and level < maxlevels:
                 level += 1
-                item = item.childAt(0)
+                item = item.childAt(first)
             else:
                 next_sibling = item.getNextSibling()
                 if next_sibling is not None:
@@ -810,6 +2057,7 @@ class AnnotationTreeView(QTreeView):
 
     def setModel(self, model):
         QTreeView.setModel(self, model)
+        model.layoutChanged.connect(self.resizeColumns)
         self.resizeColumns()
 
     def rowsInserted(self, index, start, end):
@@ -850,38 +2098,49 @@ class CopyAnnotations(QObject):
 
     def copy(self):
         current = self._labeltool.currentImage()
+        if self._overlap_threshold is not None:
+            # the rects of the annotations in current, including the ones
+            # copied already
+            index = SpatialIndex()
+            annotations = self.getAnnotationsFiltered(current)
+            for annotation, rect in zip(annotations, self.getRects(annotations)):
+                if not np.isnan(rect).any():
+                    index.insert(annotation, rect)
 
         prev = current.getPreviousSibling()
         num_back = self._frame_range
 
-        while num_back > 0 and prev is not None:
-            for annotation in self.getAnnotationsFiltered(prev):
-                LOG.debug("num_back: %d, annotation: %s", num_back, str(annotation))
-                # check for overlap with annotations in current
-                if self._overlap_threshold is not None:
-                    r1 = self.getRect(annotation)
-                    if r1 is not None:
-                        cont = False
-                        for curr_ann in self.getAnnotationsFiltered(current):
-                            r2 = self.getRect(curr_ann)
-                            if r2 is not None:
-                                o = self.overlap(r1, r2)
-                                LOG.debug("overlap between %s and %s: %f", str(r1), str(r2), o)
-                                if o > self._overlap_threshold:
-                                    cont = True
-                                    break
-                        if cont:
-                            continue # do not copy
-
-                # copy the annotation
-                current.addAnnotation(annotation)
+        while num_back > 0 and isinstance(prev, ImageModelItem) and prev is not current:
+            annotations = self.getAnnotationsFiltered(prev)
+            LOG.debug("num_back: %d, %d annotations", num_back, len(annotations))
+            if self._overlap_threshold is None:
+                copied = list(range(len(annotations)))
+            else:
+                # do not copy annotations which overlap with an annotation
+                # in current, including the ones copied from prev already
+                rects = self.getRects(annotations)
+                copied = []
+                for i, rect in enumerate(rects):
+                    if not np.isnan(rect).any():
+                        others = index.intersecting(rect)
+                        if others:
+                            boxes = np.array([index.box(other) for other in others])
+                            if (self.iou(rect[None, :], boxes) > self._overlap_threshold).any():
+                                continue
+                        index.insert(annotations[i], rect)
+                    copied.append(i)
+
+            # copy the annotations
+            with current.model().batch():
+                for i in copied:
+                    current.addAnnotation(annotations[i])
 
             prev = prev.getPreviousSibling()
             num_back -= 1
 
     def getAnnotationsFiltered(self, image_item):
         annotations = []
-        for annotation in image_item.getAnnotations()['annotations']:
+        for annotation in image_item.annotationEntries():
             # check class filter
             if self._class_filter is not None:
                 if annotation.get('class', None) not in self._class_filter:
@@ -896,20 +2155,33 @@ class CopyAnnotations(QObject):
                 return None
         return [annotation[self._prefix + key] for key in keys]
 
-    def overlap(self, r1, r2):
-        ia = float(self.area(self.intersect(r1, r2)))
-        union = self.area(r1) + self.area(r2) - ia
-        return ia / union
-
-    def intersect(self, r1, r2):
-        x = max(r1[0], r2[0])
-        y = max(r1[1], r2[1])
-        w = max(0, min(r1[0] + r1[2], r2[0] + r2[2]) - x)
-        h = max(0, min(r1[1] + r1[3], r2[1] + r2[3]) - y)
-        return (x, y, w, h)
-
-    def area(self, r):
-        return r[2]*r[3]
+    def getRects(self, annotations):
+        """
+        Returns the rects of the annotations as array of shape (n, 4), the
+        rows of annotations without a rect are NaN.
+        """
+        rects = np.empty((len(annotations), 4))
+        rects.fill(np.nan)
+        for i, annotation in enumerate(annotations):
+            rect = self.getRect(annotation)
+            if rect is not None:
+                rects[i] = rect
+        return rects
+
+    def iou(self, r1, r2):
+        """
+        Returns the matrix of the intersection over union of all pairs of
+        rects in the arrays ``r1`` and ``r2`` (see getRects()).  Pairs with
+        a NaN rect or an empty union have an overlap of 0.
+        """
+        x = np.maximum(r1[:, None, 0], r2[None, :, 0])
+        y = np.maximum(r1[:, None, 1], r2[None, :, 1])
+        w = np.maximum(0, np.minimum(r1[:, None, 0] + r1[:, None, 2], r2[None, :, 0] + r2[None, :, 2]) - x)
+        h = np.maximum(0, np.minimum(r1[:, None, 1] + r1[:, None, 3], r2[None, :, 1] + r2[None, :, 3]) - y)
+        intersection = w * h
+        union = (r1[:, 2] * r1[:, 3])[:, None] + (r2[:, 2] * r2[:, 3])[None, :] - intersection
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(union > 0, intersection / union, 0.)
 
 # interpolate annotations between two annotated images
 class InterpolateRange(QObject):
@@ -954,6 +2226,32 @@ class InterpolateRange(QObject):
                 return False
         return True
 
+    def interpolateValues(self, firstVals, lastVals, steps):
+        """
+        Returns the list of interpolated values for each of the ``steps``
+        in-between frames.  A custom interpolation function is called for
+        each value and step.  The default interpolation is computed for all
+        values at once, with arrays of the types of the values, so that the
+        results are the same as when calling it for each value.
+        """
+        if getattr(self._interp_func, '__func__', None) is not InterpolateRange.__dict__['interpolate']:
+            return [[self._interp_func(f, l, j+1, steps) for f, l in zip(firstVals, lastVals)]
+                    for j in range(steps)]
+
+        rows = [[None] * len(firstVals) for j in range(steps)]
+        groups = {}
+        for k, (f, l) in enumerate(zip(firstVals, lastVals)):
+            groups.setdefault((type(f), type(l)), []).append(k)
+        step = np.arange(1, steps + 1)[:, None]
+        for (ftype, ltype), ks in groups.items():
+            values = self.interpolate(np.array([firstVals[k] for k in ks], dtype=ftype)[None, :],
+                                      np.array([lastVals[k] for k in ks], dtype=ltype)[None, :],
+                                      step, steps)
+            for row, vals in zip(rows, values.tolist()):
+                for k, v in zip(ks, vals):
+                    row[k] = v
+        return rows
+
     def interpolateRange(self):
         last = self._lt.currentImage()
         first = None
@@ -964,88 +2262,97 @@ class InterpolateRange(QObject):
 
         # find first previous labeled frame as first
         # make list of frames toInterp(olate)
+        toInterp = []
         prev = last.getPreviousSibling()
-        toInterp = [prev]
-        steps = 1
-        while self.overwrite(prev):
-            steps += 1
-            prev = prev.getPreviousSibling()
-            # only one "roundtrip", as first frame in set wraps to last
-            if steps > len(self._lt.annotations())+1:
-                LOG.info("Couldn't find previous labeled frame")
-                return False
+        while isinstance(prev, ImageModelItem) and prev is not last and self.overwrite(prev):
             toInterp.append(prev)
+            # getPreviousSibling() returns the frame itself at the beginning
+            sibling = prev.getPreviousSibling()
+            prev = sibling if sibling is not prev else None
+        if not isinstance(prev, ImageModelItem) or prev is last:
+            LOG.info("Couldn't find previous labeled frame")
+            return False
 
         first = prev
         toInterp.reverse()
-        toInterp = toInterp[1:]
 
         # TODO: make fuzzy matcher to match annotation objects together...
-        fann = first.getAnnotations()['annotations']
-        lann = last.getAnnotations()['annotations']
+        fann = first.annotationEntries()
+        lann = last.annotationEntries()
         if len(fann) != len(lann): # TODO needed?
             LOG.error("Error: Annotation count differs in first and last labeled frames, aborting")
             return False
         steps = len(toInterp)
-        # create list of annotations to inject into each in-between frame
-        toInterpAnns = []
-        for i in toInterp:
-            toInterpAnns.append(copy.deepcopy(fann))
 
+        # The values of all numeric attributes and of all elements of the
+        # multi-value attributes are collected into one list each for the
+        # first and last frame, and interpolated for all frames at once
+        firstVals = []
+        lastVals = []
+        # (annotation index, attribute, slice of the values) for each attribute,
+        # the slice end is None for single values
+        fields = []
         for i in range(len(fann)):
             LOG.debug("trying annotation %s at idx %s"%(fann[i], i))
             # find which "last annotation" matches a certain first
             lannIdx = None
             for l in range(len(lann)):
-                if lann[l]['type'] == fann[i]['type'] and lann[l]['class'] == fann[i]['class']:
+                if lann[l].get('type') == fann[i].get('type') and lann[l].get('class') == fann[i].get('class'):
                     lannIdx = l
             if lannIdx == None:
                 LOG.error("Error: could not find matching label, skipping")
                 continue
 
             for attr in fann[i].keys():
-                firstV = None; lastV = None
-                if type(fann[i][attr]) in [type(float()), type(int())]:
-                    firstV = fann[i][attr]
-                    lastV = lann[lannIdx][attr]
-                    for j in range(len(toInterpAnns)):
-                        interp = self._interp_func(firstV, lastV, j+1, steps)
-                        toInterpAnns[j][i][attr] = interp
-
-                if type(fann[i][attr])==type(str()) and ";" in fann[i][attr]: # assume its a multi-value list?
-                    frawVals = fann[i][attr].split(";")
-                    lrawVals = lann[lannIdx][attr].split(";")
+                firstV = fann[i][attr]
+                lastV = lann[lannIdx].get(attr)
+                if type(firstV) in [type(float()), type(int())]:
+                    if type(lastV) not in [type(float()), type(int())]:
+                        LOG.error("Error: %s is not a number in the last frame, aborting" % attr)
+                        return False
+                    fields.append((i, attr, len(firstVals), None))
+                    firstVals.append(firstV)
+                    lastVals.append(lastV)
+
+                if type(firstV)==type(str()) and ";" in firstV: # assume its a multi-value list?
+                    frawVals = firstV.split(";")
+                    lrawVals = str(lastV).split(";")
                     if len(frawVals) != len(lrawVals):
                         LOG.error("Error: multi-value objects on first/last frame differ, aborting")
                         return False
 
-                    test = frawVals[0]
-                    vtype = getStrNumType(test)
-                    if not vtype:
+                    try:
+                        vtype = self.getStrNumType(frawVals[0])
+                        if not vtype:
+                            raise ValueError(frawVals[0])
+                        fVals = [vtype(v) for v in frawVals]
+                        lVals = [vtype(v) for v in lrawVals]
+                    except ValueError:
                         LOG.error("Error, unknown type in multi-value label field, neither int nor float, aborting")
                         return False
+                    fields.append((i, attr, len(firstVals), len(firstVals) + len(fVals)))
+                    firstVals.extend(fVals)
+                    lastVals.extend(lVals)
+
+        if steps == 0:
+            # the previous frame is labeled already
+            return True
 
-                    fVals = []
-                    lVals = []
-                    for v in range(len(frawVals)):
-                        fVals.append( vtype(frawVals[v]) )
-                        lVals.append( vtype(lrawVals[v]) )
-
-                    # write back to toInterpAnns
-                    for j in range(len(toInterpAnns)):
-                        resVal = ""
-                        for v in range(len(frawVals)):
-                            interp = self._interp_func(fVals[v], lVals[v], j+1, steps)
-                            resVal += "%s;"%interp
-                        resVal = resVal[:-1]
-                        toInterpAnns[j][i][attr] = resVal
-
-        for i in range(len(toInterp)):
-            # first clear existing annotations, as our overwrite check allowed us to
-            toInterp[i].deleteAllChildren()
-            # then add new ones
-            for ann in toInterpAnns[i]:
-                toInterp[i].addAnnotation(ann)
+        # one row of interpolated values per in-between frame
+        values = self.interpolateValues(firstVals, lastVals, steps)
+
+        templates = [dict(ann) for ann in fann]
+        with last.model().batch():
+            for j in range(steps):
+                row = values[j]
+                anns = [dict(ann) for ann in templates]
+                for i, attr, start, end in fields:
+                    if end is None:
+                        anns[i][attr] = row[start]
+                    else:
+                        anns[i][attr] = ";".join("%s" % v for v in row[start:end])
+                # replace the existing annotations, as our overwrite check allowed us to
+                toInterp[j].replaceAnnotations(anns)
 
         return True
 
@@ -110,8 +110,46 @@ CONTAINERS = (
     ('*.yaml',       'sloth.annotations.container.YamlContainer'),
     ('*.pickle',     'sloth.annotations.container.PickleContainer'),
     ('*.sloth-init', 'sloth.annotations.container.FileNameListContainer'),
+    ('*.sloth.db',   'sloth.annotations.container.SqliteContainer'),
 )
 
+# IMAGE_CACHE_SIZE
+#
+# Maximum memory in bytes used for keeping decoded images in memory.  Set
+# to 0 to disable caching and prefetching of images.
+IMAGE_CACHE_SIZE = 512 * 1024 * 1024
+
+# PREFETCH_COUNT
+#
+# Number of images before and after the current image that are loaded
+# into the image cache in the background.
+PREFETCH_COUNT = 2
+
+# TILED_IMAGE_MIN_SIZE
+#
+# Images with a width or height in pixels larger than this are displayed in
+# tiles, which are only converted for display when they become visible.
+TILED_IMAGE_MIN_SIZE = 8192
+
+# IMAGE_TILE_CACHE_SIZE
+#
+# Maximum memory in bytes used for keeping the converted tiles of a tiled
+# image.
+IMAGE_TILE_CACHE_SIZE = 128 * 1024 * 1024
+
+# BACKGROUND_LOADING_SLICE
+#
+# Time in milliseconds which the annotations are loaded in the background
+# at a time, before the GUI handles its pending events again.
+BACKGROUND_LOADING_SLICE = 8
+
+# INDEXED_ATTRIBUTES
+#
+# Attribute keys whose values are counted per subtree of the annotation
+# model, such that queries for these values (see AnnotationModel.select)
+# can skip the files and frames without matches.
+INDEXED_ATTRIBUTES = ('class', )
+
 # PLUGINS
 #
 # A list/tuple of classes implementing the sloth plugin interface.  The
@@ -132,79 +132,108 @@ class AppendFilesCommand(BaseCommand):
 
 class MergeFilesCommand(BaseCommand):
     """
-    Merge annotations of two label files and create a new one from it.
-    If both input files have annotations for the same frame number, the result
-    will contain the union of both annotations.
+    Merge annotations of two or more label files and create a new one from it.
+    If several input files have annotations for the same frame number, the
+    result will contain the union of their annotations.
 
     Output format will be determined by the file suffix of output.
     """
-    args = '<labelfile 1> <labelfile 2> <output>'
+    args = '<labelfile 1> <labelfile 2> [<labelfile 3> ...] <output>'
     help = __doc__.strip()
 
     def handle(self, *args, **options):
-        if len(args) != 3:
+        if len(args) < 3:
             raise CommandError("Usage: %s" % self.args)
 
-        input1, input2, output = args[:]
-        logger.info("merging %s and %s into %s" % (input1, input2, output))
-        logger.debug("loading annotations from %s" % input1)
-        container1 = self.labeltool._container_factory.create(input1)
-        an1 = container1.load(input1)
+        inputs, output = args[:-1], args[-1]
+        logger.info("merging %s into %s" % (", ".join(inputs), output))
+        annotations = []
+        for input in inputs:
+            logger.debug("loading annotations from %s" % input)
+            container = self.labeltool._container_factory.create(input)
+            annotations.append(container.load(input))
 
-        logger.debug("loading annotations from %s" % input2)
-        container2 = self.labeltool._container_factory.create(input2)
-        an2 = container2.load(input2)
-
-        logger.debug("merging annotations of %s and %s" % (input1, input2))
-        an3 = self.merge_annotations(an1, an2)
+        logger.debug("merging annotations of %s" % ", ".join(inputs))
+        merged = self.iter_merged_annotations(annotations)
 
         logger.debug("saving annotations to %s" % output)
         out_container = self.labeltool._container_factory.create(output)
-        out_container.save(an3, output)
+        # the first input is read while the output is written, unless the
+        # output has to be passed as list anyway
+        if not out_container.streaming or \
+                os.path.abspath(output) in [os.path.abspath(input) for input in inputs]:
+            merged = list(merged)
+        out_container.save(merged, output)
 
     def merge_annotations(self, an1, an2, match_key='filename'):
         """This merges all annotations from an2 into an1."""
+        return list(self.iter_merged_annotations([an1, an2], match_key))
+
+    def iter_merged_annotations(self, inputs, match_key='filename'):
+        """
+        Merge the items of several lists of annotations, and yield the merged
+        items.  Items are matched by their class and ``match_key``; the
+        values of earlier inputs take precedence.  The first input is
+        consumed while the result is yielded (so it can be a generator), all
+        others are held in an index in memory.
+        """
+        if len(inputs) == 0:
+            return
 
-        for item in an2:
-            matching_items = [it1 for it1 in an1 if
-                              it1['class'] == item['class'] and
-                              it1[match_key] == item[match_key]]
-
-            # If we can't find a match, we just append the item to an1.
-            if len(matching_items) == 0:
-                an1.append(item)
+        # merge all but the first input into an index
+        index = {}
+        rest = []
+        for an in inputs[1:]:
+            for item in an:
+                key = (item.get('class'), item.get(match_key))
+                if key in index:
+                    self.merge_item(index[key], item)
+                else:
+                    index[key] = item
+                    rest.append(item)
+
+        # stream the first input, merging the matching items into it
+        matched = set()
+        for item in inputs[0]:
+            key = (item.get('class'), item.get(match_key))
+            if key in index:
+                self.merge_item(item, index.pop(key))
+                matched.add(key)
+            elif key in matched:
+                # the first match has been merged already
+                logger.warning('Found multiple possible matches for %s', item.get(match_key))
+            yield item
+
+        # items without a match in the first input
+        for item in rest:
+            key = (item.get('class'), item.get(match_key))
+            if index.get(key) is item:
+                yield item
+
+    def merge_item(self, match_item, item):
+        """This merges the keys, frames and annotations of item into match_item."""
+        # Update the keys first.
+        for key, value in item.items():
+            if key == 'annotations':
+                continue
+            if match_item['class'] == 'video' and key == 'frames':
                 continue
+            if key in match_item and match_item[key] != value:
+                logger.warning('found matching key %s, but values differ: %s <-> %s',
+                               key, str(match_item[key]), str(value))
+                continue
+
+            match_item[key] = value
+
+        # Merge frames.
+        if match_item['class'] == 'video':
+            match_item['frames'] = self.merge_annotations(match_item['frames'], item['frames'], 'num')
+            match_item['frames'].sort(key=itemgetter('num'))
 
-            # We found at least one match, just take the first.
-            # But put out a warning if there were multiple possible matches.
-            if len(matching_items) > 1:
-                logger.warning('Found %d possible matches for %s',
-                               len(matching_items), item['filename'])
-            match_item = matching_items[0]
-
-            # Update the keys first.
-            for key, value in item.iteritems():
-                if key == 'annotations':
-                    continue
-                if match_item['class'] == 'video' and key == 'frames':
-                    continue
-                if key in match_item and match_item[key] != value:
-                    logger.warning('found matching key %s, but values differ: %s <-> %s',
-                                   key, str(value), str(value))
-                    continue
-
-                match_item[key] = value
-
-            # Merge frames.
-            if match_item['class'] == 'video':
-                match_item['frames'] = self.merge_annotations(match_item['frames'], item['frames'], 'num')
-                match_item['frames'].sort(key=itemgetter('num'))
-
-            # Merge annotations.
-            if 'annotations' in match_item:
-                match_item['annotations'].extend(item.get('annotations', []))
-
-        return an1
+        # Merge annotations.
+        if 'annotations' in match_item:
+            match_item['annotations'] = list(match_item['annotations'])
+            match_item['annotations'].extend(item.get('annotations', []))
 
 
 def _make_writeable(filename):
@@ -0,0 +1,127 @@
+"""
+Cache for decoded images.
+"""
+import threading
+from collections import OrderedDict
+import numpy as np
+import logging
+LOG = logging.getLogger(__name__)
+
+
+class ImageCache:
+    """
+    Thread-safe least-recently-used cache of decoded images with a memory
+    budget.  Images are numpy arrays, their size is taken from ``nbytes``.
+    The cached arrays are shared and made read-only.
+    Once the budget is exceeded, the least recently used images are evicted.
+    An image larger than the whole budget is not cached at all, unless it is
+    memory-mapped: such an image is counted as using the whole budget, so
+    that it is kept as the only cached image instead of being decoded again.
+    """
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._size = 0
+        self._images = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def maxSize(self):
+        return self._max_size
+
+    def size(self):
+        """The number of bytes of all cached images."""
+        with self._lock:
+            return self._size
+
+    def __len__(self):
+        with self._lock:
+            return len(self._images)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._images or key in self._loading
+
+    def get(self, key):
+        """
+        Returns the cached image for ``key``, or None if it is not cached.
+        """
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._touch(key)
+            return image
+
+    def put(self, key, image):
+        with self._lock:
+            self._insert(key, image)
+
+    def load(self, key, loader):
+        """
+        Returns the cached image for ``key``.  If it is not cached, it is
+        loaded by calling ``loader()`` and added to the cache.  If another
+        thread is loading the same image already, waits for it instead of
+        loading it twice.
+        """
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._touch(key)
+                return image
+            event = self._loading.get(key)
+            if event is None:
+                event = self._loading[key] = threading.Event()
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            event.wait()
+            image = self.get(key)
+            if image is not None:
+                return image
+            # loading failed in the other thread or the image has been
+            # evicted already, load it ourselves
+            return loader()
+
+        image = None
+        try:
+            image = loader()
+        finally:
+            with self._lock:
+                del self._loading[key]
+                if image is not None:
+                    self._insert(key, image)
+            event.set()
+        return image
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self._size = 0
+
+    def _touch(self, key):
+        image = self._images.pop(key)
+        self._images[key] = image
+
+    def _insert(self, key, image):
+        nbytes = self._imageSize(image)
+        if nbytes > self._max_size:
+            return
+        # the image is shared by all callers, so that none may modify it
+        if isinstance(image, np.ndarray):
+            image.setflags(write=False)
+        if key in self._images:
+            self._size -= self._imageSize(self._images.pop(key))
+        self._images[key] = image
+        self._size += nbytes
+        while self._size > self._max_size:
+            old_key, old_image = self._images.popitem(last=False)
+            self._size -= self._imageSize(old_image)
+            LOG.debug("Evicted image %s from cache" % (old_key, ))
+
+    def _imageSize(self, image):
+        nbytes = getattr(image, 'nbytes', 0)
+        if isinstance(image, np.memmap):
+            return min(nbytes, self._max_size)
+        return nbytes
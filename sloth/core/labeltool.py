@@ -3,6 +3,8 @@ This is the core labeltool module.
 """
 import os
 import sys
+import time
+from collections import deque
 from PyQt4.QtGui import *
 from PyQt4.QtCore import *
 from sloth.annotations.model import *
@@ -10,6 +12,7 @@ from sloth.annotations.container import AnnotationContainerFactory, AnnotationCo
 from sloth.conf import config
 from sloth.core.cli import LaxOptionParser, BaseCommand
 from sloth.core.utils import import_callable
+from sloth.core.imagecache import ImageCache
 from sloth import VERSION
 from sloth.core.commands import get_commands
 from sloth.gui import MainWindow
@@ -23,6 +26,85 @@ except ImportError:
     pass
 
 
+class ImagePrefetchTask(QRunnable):
+    """
+    Loads an image into the image cache in a worker thread.  The task is
+    skipped if the current image has changed since it was scheduled.
+    """
+
+    def __init__(self, labeltool, generation, cache, key, loader):
+        QRunnable.__init__(self)
+        self._labeltool = labeltool
+        self._generation = generation
+        self._cache = cache
+        self._key = key
+        self._loader = loader
+
+    def run(self):
+        if self._generation != self._labeltool._prefetch_generation:
+            return
+        try:
+            self._cache.load(self._key, self._loader)
+        except Exception as e:
+            LOG.warning("Prefetching image %s failed: %s" % (self._key, e))
+
+
+class AnnotationLoaderThread(QThread):
+    """
+    Parses a label file in a worker thread.  The file entries are handed
+    to the GUI thread in batches: ``entriesReady`` is emitted whenever new
+    entries can be taken with ``takeEntries()``.  The first entry is
+    passed on immediately, the following ones at most every
+    ``flush_interval`` seconds or when ``batch_size`` entries are ready.
+    """
+    entriesReady = pyqtSignal()
+
+    batch_size = 5000
+    flush_interval = 0.1
+
+    def __init__(self, container, fname, parent=None):
+        QThread.__init__(self, parent)
+        self._container = container
+        self._fname = fname
+        self._entries = deque()
+        self._canceled = False
+        self._error = None
+
+    def cancel(self):
+        self._canceled = True
+
+    def error(self):
+        """The exception raised while loading, if any."""
+        return self._error
+
+    def takeEntries(self):
+        entries = []
+        try:
+            while True:
+                entries.append(self._entries.popleft())
+        except IndexError:
+            return entries
+
+    def run(self):
+        try:
+            batch = []
+            next_flush = time.time()
+            for entry in self._container.load(self._fname):
+                if self._canceled:
+                    return
+                batch.append(entry)
+                if len(batch) >= self.batch_size or time.time() >= next_flush:
+                    self._entries.extend(batch)
+                    self.entriesReady.emit()
+                    batch = []
+                    next_flush = time.time() + self.flush_interval
+            self._entries.extend(batch)
+            self.entriesReady.emit()
+        except Exception as e:
+            LOG.error("Loading %s failed: %s" % (self._fname, e))
+            self._error = e
+
+
 class LabelTool(QObject):
     """
     This is the main label tool object.  It stores the state of the tool, i.e.
@@ -68,8 +150,15 @@ class LabelTool(QObject):
         self._container_factory = None
         self._container = AnnotationContainer()
         self._current_image = None
-        self._model = AnnotationModel([])
+        self._model = self._createModel([])
         self._mainwindow = None
+        self._prefetch_pool = QThreadPool(self)
+        self._prefetch_generation = 0
+        self._resetImageCache()
+        self._loader = None
+        self._loader_attached = False
+        self._loader_handle_errors = True
+        self._goto_first = False
 
     def main_help_text(self):
         """
@@ -158,10 +247,10 @@ class LabelTool(QObject):
             # check if args contain a labelfile filename to load
             if len(args) > 1:
                 try:
-                    self.loadAnnotations(args[1], handleErrors=False)
+                    self.loadAnnotations(args[1], handleErrors=False, background=True)
 
-                    # goto to first image
-                    self.gotoNext()
+                    # goto to first image, as soon as it is loaded
+                    self._goto_first = True
                 except Exception as e:
                     LOG.fatal("Error loading annotations: %s" % e)
                     if (int(options.verbosity)) > 1:
@@ -206,6 +295,7 @@ class LabelTool(QObject):
 
         # Instatiate container factory
         self._container_factory = AnnotationContainerFactory(config.CONTAINERS)
+        self._resetImageCache()
 
     def loadPlugins(self, plugins):
         self._plugins = []
@@ -220,14 +310,39 @@ class LabelTool(QObject):
     ###
     ### Annoation file handling
     ###___________________________________________________________________________________________
-    def loadAnnotations(self, fname, handleErrors=True):
+    def loadAnnotations(self, fname, handleErrors=True, background=False):
+        """
+        Load the annotations from the label file ``fname``.  With
+        ``background=True`` the file is parsed in a worker thread, see
+        :class:`AnnotationLoaderThread`.  The model is set up (and
+        ``annotationsLoaded`` emitted) right away then, and the files are
+        added to it as they are parsed.  Only streaming containers (see
+        :class:`~sloth.annotations.container.StreamingJsonContainer`)
+        yield files while parsing, the others parse the whole file first.
+        With ``handleErrors=False``, errors of the loader are raised when
+        the loader finishes.
+        """
         fname = str(fname)  # convert from QString
+        self.closeAnnotations()
 
         try:
             self._container = self._container_factory.create(fname)
-            self._model = AnnotationModel(self._container.load(fname))
-            msg = "Successfully loaded %s (%d files, %d annotations)" % \
-                  (fname, self._model.root().numFiles(), self._model.root().numAnnotations())
+            self._resetImageCache()
+            if background:
+                self._model = self._createModel([])
+                self._model.setLoading(True)
+                self._loader = AnnotationLoaderThread(self._container, fname, self)
+                self._loader_attached = False
+                self._loader_handle_errors = handleErrors
+                self._loader.entriesReady.connect(self._addLoadedEntries)
+                self._loader.finished.connect(self._onLoadingFinished)
+                self._loader.start()
+                msg = "Loading %s..." % fname
+            else:
+                self._model = self._createModel(self._container.load(fname))
+                self._container.attachModel(self._model)
+                msg = "Successfully loaded %s (%d files, %d annotations)" % \
+                      (fname, self._model.root().numFiles(), self._model.root().numAnnotations())
         except Exception as e:
             if handleErrors:
                 msg = "Error: Loading failed (%s)" % str(e)
@@ -237,22 +352,100 @@ class LabelTool(QObject):
         self.statusMessage.emit(msg)
         self.annotationsLoaded.emit()
 
+    def _addLoadedEntries(self):
+        # Called in the GUI thread whenever the loader has parsed new entries
+        if self._loader is None:
+            return
+        entries = self._loader.takeEntries()
+        if len(entries) == 0:
+            return
+        if not self._loader_attached:
+            # the container knows the filename once it started loading
+            self._container.attachModel(self._model)
+            self._loader_attached = True
+        self._model.root().appendEntries(entries)
+        if self._goto_first and self._current_image is None:
+            self._goto_first = False
+            self.gotoNext()
+
+    def _onLoadingFinished(self):
+        loader = self._loader
+        if loader is None or not loader.isFinished():
+            # signal of a canceled loader
+            return
+        self._addLoadedEntries()
+        self._loader = None
+        self._goto_first = False
+        self._model.setLoading(False)
+        if loader.error() is not None:
+            # drop the partially loaded file, so that saving does not
+            # overwrite it with the files loaded so far
+            if self._loader_attached:
+                self._container.detachModel(self._model)
+            self._container = AnnotationContainer()
+            self.statusMessage.emit("Error: Loading failed (%s)" % str(loader.error()))
+            if not self._loader_handle_errors:
+                raise loader.error()
+            return
+
+        if not self._loader_attached:
+            self._container.attachModel(self._model)
+        msg = "Successfully loaded %s (%d files, %d annotations)" % \
+              (self._container.filename(), self._model.root().numFiles(),
+               self._model.root().numAnnotations())
+        self.statusMessage.emit(msg)
+
+    def _stopLoading(self):
+        # Cancel a running loader, its signals are ignored.  The GUI does
+        # not wait for it, a container which is not streaming only checks
+        # for the cancellation after parsing the whole file.
+        if self._loader is not None:
+            loader = self._loader
+            loader.cancel()
+            loader.entriesReady.disconnect(self._addLoadedEntries)
+            loader.finished.disconnect(self._onLoadingFinished)
+            loader.finished.connect(loader.deleteLater)
+            if loader.isFinished():
+                loader.deleteLater()
+            self._loader = None
+            self._model.setLoading(False)
+        self._goto_first = False
+
+    def _finishLoading(self):
+        # Wait for a running loader and add all of its entries to the model
+        if self._loader is not None:
+            self._loader.wait()
+            self._onLoadingFinished()
+
     def annotations(self):
         if self._model is None:
             return None
+        self._finishLoading()
         return self._model.root().getAnnotations()
 
     def saveAnnotations(self, fname):
         success = False
+        self._finishLoading()
         try:
             # create new container if the filename is different
+            attach = False
+            old_container = self._container
             if fname != self._container.filename():
                 self._container = self._container_factory.create(fname)
-
-            # Get annotations dict
-            ann = self._model.root().getAnnotations()
-
-            self._container.save(ann, fname)
+                attach = True
+
+            # Get annotations dict.  Unmodified file items are passed as
+            # they were loaded, and the container is told which ones changed.
+            changed = self._model.root().dirtyRows()
+            ann = self._model.root().fileEntries()
+
+            self._container.save(ann, fname, changed)
+            if attach:
+                # the modifications are saved to the new file only
+                old_container.detachModel(self._model)
+                self._container.attachModel(self._model)
+                # image filenames are relative to the new label file
+                self._resetImageCache()
             #self._model.writeback() # write back changes that are cached in the model itself, e.g. mask updates
             msg = "Successfully saved %s (%d files, %d annotations)" % \
                   (fname, self._model.root().numFiles(), self._model.root().numAnnotations())
@@ -264,8 +457,22 @@ class LabelTool(QObject):
         self.statusMessage.emit(msg)
         return success
 
+    def _createModel(self, annotations):
+        return AnnotationModel(annotations, count_values=config.INDEXED_ATTRIBUTES)
+
+    def closeAnnotations(self):
+        """
+        Close the current annotations without saving them.  The container
+        discards the modifications since they were last saved, e.g. the
+        records of a :class:`~sloth.annotations.container.JournalContainer`
+        journal, so they don't come back when the file is loaded again.
+        """
+        self._stopLoading()
+        self._container.detachModel(self._model)
+
     def clearAnnotations(self):
-        self._model = AnnotationModel([])
+        self.closeAnnotations()
+        self._model = self._createModel([])
         #self._model.setBasedir("")
         self.statusMessage.emit('')
         self.annotationsLoaded.emit()
@@ -335,13 +542,47 @@ class LabelTool(QObject):
         if image != self._current_image:
             self._current_image = image
             self.currentImageChanged.emit()
+            self.prefetchImages(image)
+
+    def _resetImageCache(self):
+        # Replaces the image cache by an empty one, e.g. when the image
+        # filenames refer to another directory.  Prefetch tasks which have
+        # not started yet are skipped.
+        self._prefetch_generation += 1
+        self._image_cache = ImageCache(config.IMAGE_CACHE_SIZE)
 
     def getImage(self, item):
+        key, loader = self._imageLoader(item)
+        return self._image_cache.load(key, loader)
+
+    def _imageLoader(self, item):
+        # Returns the cache key and a function loading the image of the
+        # item, which can be called from another thread
+        container = self._container
         if item['class'] == 'frame':
-            video = item.parent()
-            return self._container.loadFrame(video['filename'], item['num'])
+            filename, num = item.parent()['filename'], item['num']
+            return (filename, num), lambda: container.loadFrame(filename, num)
         else:
-            return self._container.loadImage(item['filename'])
+            filename = item['filename']
+            return (filename, None), lambda: container.loadImage(filename)
+
+    def prefetchImages(self, image):
+        """
+        Load the images of the ``PREFETCH_COUNT`` next and previous siblings
+        of ``image`` into the image cache in the background.  Prefetching
+        for a former current image is cancelled.
+        """
+        self._prefetch_generation += 1
+        if self._image_cache.maxSize() <= 0:
+            return
+        for step in range(1, config.PREFETCH_COUNT + 1):
+            for sibling in (image.getNextSibling(step), image.getPreviousSibling(step)):
+                if not isinstance(sibling, ImageModelItem):
+                    continue
+                key, loader = self._imageLoader(sibling)
+                if key not in self._image_cache:
+                    self._prefetch_pool.start(ImagePrefetchTask(
+                        self, self._prefetch_generation, self._image_cache, key, loader))
 
     def getAnnotationFilePatterns(self):
         return self._container_factory.patterns()
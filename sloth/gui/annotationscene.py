@@ -2,12 +2,17 @@
 from sloth.items import *
 from sloth.core.exceptions import InvalidArgumentException
 from sloth.annotations.model import AnnotationModelItem
+from sloth.gui.imageitem import TiledImageItem
 from sloth.utils import toQImage
 from sloth.conf import config
 import logging
 import functools
 LOG = logging.getLogger(__name__)
 
+# the paint methods which are restored when the corner enumeration is removed
+_polygon_item_paint = PolygonItem.paint
+_rect_item_paint = RectItem.paint
+
 
 class AnnotationScene(QGraphicsScene):
     mousePositionChanged = pyqtSignal(float, float)
@@ -20,6 +25,13 @@ class AnnotationScene(QGraphicsScene):
         self._scene_item = None
         self._message = ""
         self._labeltool = labeltool
+        # graphics items of each annotation, by id() of the model item
+        self._items_by_model_item = {}
+        # items removed from the scene which can be rebound to other model
+        # items of the same label class, and the classes of the items in
+        # the scene
+        self._item_pool = {}
+        self._item_classes = {}
 
         self._itemfactory = Factory(items)
         self._inserterfactory = Factory(inserters)
@@ -47,6 +59,7 @@ class AnnotationScene(QGraphicsScene):
             self._model.rowsAboutToBeRemoved.disconnect(self.rowsAboutToBeRemoved)
             self._model.rowsRemoved.disconnect(self.rowsRemoved)
             self._model.modelReset.disconnect(self.reset)
+            self._model.layoutChanged.disconnect(self.layoutChanged)
 
         self._model = model
 
@@ -57,6 +70,7 @@ class AnnotationScene(QGraphicsScene):
             self._model.rowsAboutToBeRemoved.connect(self.rowsAboutToBeRemoved)
             self._model.rowsRemoved.connect(self.rowsRemoved)
             self._model.modelReset.connect(self.reset)
+            self._model.layoutChanged.connect(self.layoutChanged)
 
         # reset caches, invalidate root
         self.reset()
@@ -76,30 +90,39 @@ class AnnotationScene(QGraphicsScene):
             self.clear()
             self._image_item = None
             self._image      = None
-            self._pixmap     = None
         else:
             self.clear()
             self._image_item = current_image
             current_image._seen = True
             assert self._image_item.model() == self._model
             self._image      = self._labeltool.getImage(self._image_item)
-            self._pixmap     = QPixmap(toQImage(self._image))
-            self._scene_item = QGraphicsPixmapItem(self._pixmap)
+            self._scene_item = self._createImageItem(self._image)
             self._scene_item.setZValue(-1)
-            self.setSceneRect(0, 0, self._pixmap.width(), self._pixmap.height())
+            self.setSceneRect(self._scene_item.boundingRect())
             self.addItem(self._scene_item)
 
-            self.insertItems(0, len(self._image_item.children())-1)
+            self.insertItems(0, self._image_item.rowCount()-1)
             self.update()
 
+    def image(self):
+        """The image currently displayed by the scene."""
+        return self._image
+
+    def _createImageItem(self, image):
+        # images too large for a single pixmap are displayed in tiles
+        if image is not None and max(image.shape[:2]) > config.TILED_IMAGE_MIN_SIZE:
+            return TiledImageItem(image, config.IMAGE_TILE_CACHE_SIZE)
+        return QGraphicsPixmapItem(QPixmap(toQImage(image)))
+
     def insertItems(self, first, last):
         if self._image_item is None:
             return
 
         assert self._model is not None
 
-        # create a graphics item for each model index
-        for row in range(first, last+1):
+        # create a graphics item for each model index, the key/value rows
+        # are skipped without creating their model items
+        for row in range(max(first, self._image_item.keyRowCount()), last+1):
             child = self._image_item.childAt(row)
             if not isinstance(child, AnnotationModelItem):
                 continue
@@ -108,12 +131,44 @@ class AnnotationScene(QGraphicsScene):
             except KeyError:
                 LOG.debug('Could not find key class in annotation item. Skipping this item. Please check your label file.')
                 continue
-            item = self._itemfactory.create(label_class, child)
+            item = self._createItem(label_class, child)
             if item is not None:
                 self.addItem(item)
+                self._registerItem(item)
             else:
                 LOG.debug("Could not find item for annotation with class '%s'" % label_class)
 
+    # maximum number of unused items kept per label class
+    max_pooled_items = 1000
+
+    def _createItem(self, label_class, model_item):
+        pool = self._item_pool.get(label_class)
+        if pool:
+            item = pool.pop()
+            item.rebind(model_item)
+        else:
+            item = self._itemfactory.create(label_class, model_item)
+            if item is None or not hasattr(item, 'rebind'):
+                return item
+        self._item_classes[id(item)] = label_class
+        return item
+
+    def _releaseItem(self, item):
+        # remove a top level item from the scene, and keep it for reuse
+        self.removeItem(item)
+        label_class = self._item_classes.pop(id(item), None)
+        if label_class is not None:
+            pool = self._item_pool.setdefault(label_class, [])
+            if len(pool) < self.max_pooled_items:
+                pool.append(item)
+
+    def _registerItem(self, item):
+        # register the item and its child items under their model items
+        if hasattr(item, 'modelItem') and item.modelItem() is not None:
+            self._items_by_model_item.setdefault(id(item.modelItem()), []).append(item)
+        for child in item.childItems():
+            self._registerItem(child)
+
     def deleteSelectedItems(self):
         # some (graphics) items may share the same model item
         # therefore we need to determine the unique set of model items first
@@ -160,6 +215,8 @@ class AnnotationScene(QGraphicsScene):
         self.clear()
         self.setCurrentImage(None)
         self.clearMessage()
+        # the pooled items may refer to the model items of another model
+        self._item_pool = {}
 
     def clear(self):
         # do not use QGraphicsScene.clear(self) so that the underlying
@@ -167,8 +224,9 @@ class AnnotationScene(QGraphicsScene):
         # reference to the item somewhere else (e.g. in an inserter)
         for item in self.items():
             if item.parentItem() is None:
-                self.removeItem(item)
+                self._releaseItem(item)
         self._scene_item = None
+        self._items_by_model_item = {}
 
     def addItem(self, item):
         QGraphicsScene.addItem(self, item)
@@ -236,7 +294,7 @@ class AnnotationScene(QGraphicsScene):
         block = self.blockSignals(True)
         selected_items = set()
         for model_item in model_items:
-            for item in self.itemsFromIndex(model_item.index()):
+            for item in self.itemsFromModelItem(model_item):
                 selected_items.add(item)
         for item in self.items():
             item.setSelected(False)
@@ -323,12 +381,22 @@ class AnnotationScene(QGraphicsScene):
     # this is the implemenation of the scene as a view of the model
     #
     def dataChanged(self, indexFrom, indexTo):
-        if self._image_item is None or self._image_item.index() != indexFrom.parent().parent():
+        if self._image_item is None:
             return
 
-        item = self.itemFromIndex(indexFrom.parent())
-        if item is not None:
-            item.dataChanged()
+        image_index = self._image_item.index()
+        parent = indexFrom.parent()
+        if parent == image_index:
+            # the annotations themselves changed, e.g. their flags
+            first = max(indexFrom.row(), self._image_item.keyRowCount())
+            for row in range(first, indexTo.row() + 1):
+                for item in self.itemsFromModelItem(self._image_item.childAt(row)):
+                    if hasattr(item, 'onDataChanged'):
+                        item.onDataChanged(indexFrom, indexTo)
+        elif parent.parent() == image_index:
+            # key/value rows of an annotation changed
+            for item in self.itemsFromIndex(parent):
+                item.dataChanged()
 
     def rowsInserted(self, index, first, last):
         if self._image_item is None or self._image_item.index() != index:
@@ -340,34 +408,59 @@ class AnnotationScene(QGraphicsScene):
         if self._image_item is None or self._image_item.index() != index:
             return
 
-        for row in range(first, last+1):
-            items = self.itemsFromIndex(index.child(row, 0))
+        for row in range(max(first, self._image_item.keyRowCount()), last+1):
+            model_item = self._image_item.childAt(row)
+            items = self._items_by_model_item.pop(id(model_item), [])
             for item in items:
                 # if the item has a parent item, do not delete it
                 # we assume, that the parent shares the same model index
                 # and thus removing the parent will also remove the child
                 if item.parentItem() is not None:
                     continue
-                self.removeItem(item)
+                self._releaseItem(item)
 
     def rowsRemoved(self, index, first, last):
         pass
 
-    def itemFromIndex(self, index):
+    def layoutChanged(self):
+        # emitted after a batch of modifications, see AnnotationModel.batch()
         for item in self.items():
-            # some graphics items will not have an index method,
-            # we just skip these
-            if hasattr(item, 'index') and item.index() == index:
-                return item
+            if item.parentItem() is None and item is not self._scene_item:
+                self._releaseItem(item)
+        self._items_by_model_item = {}
+        if self._image_item is not None:
+            self.insertItems(0, self._image_item.rowCount() - 1)
+
+    def itemFromIndex(self, index):
+        items = self.itemsFromIndex(index)
+        if len(items) > 0:
+            return items[0]
         return None
 
     def itemsFromIndex(self, index):
+        if self._model is None or not index.isValid():
+            return []
+        return self.itemsFromModelItem(self._model.itemFromIndex(index))
+
+    def itemsFromModelItem(self, model_item):
+        """
+        Returns the graphics items which display the given model item.
+        """
+        return list(self._items_by_model_item.get(id(model_item), []))
+
+    def annotationItemsIn(self, rect):
+        """
+        Returns the graphics items of the annotations whose bounding boxes
+        intersect ``rect`` (in scene coordinates).  The query is answered by
+        the spatial index of the current image instead of testing the
+        shapes of all items of the scene.
+        """
+        if self._image_item is None:
+            return []
         items = []
-        for item in self.items():
-            # some graphics items will not have an index method,
-            # we just skip these
-            if hasattr(item, 'index') and item.index() == index:
-                items.append(item)
+        for model_item in self._image_item.intersectingAnnotations(
+                rect.x(), rect.y(), rect.width(), rect.height()):
+            items.extend(self.itemsFromModelItem(model_item))
         return items
 
     #
@@ -417,7 +510,7 @@ class AnnotationScene(QGraphicsScene):
     # enumerate polygon annotation corners and rectangle annotation corners
     def enumerateCorners(self):
         # calculate font size
-        fontsize = (self._pixmap.width()+self._pixmap.height())/150
+        fontsize = (self.sceneRect().width()+self.sceneRect().height())/150
 
         # decorate the paint() method with our enumerating paint
         self.enumeratePolygonItems(fontsize)
@@ -459,36 +552,8 @@ class AnnotationScene(QGraphicsScene):
         self.reset()
 
     def removePolygonEnumeration(self):
-        oldpaint = PolygonItem.paint
-
-        def paint(self, painter, option, widget=None):
-            BaseItem.paint(self, painter, option, widget)
-
-            pen = self.pen()
-            if self.isSelected():
-                pen.setStyle(Qt.DashLine)
-            painter.setPen(pen)
-
-            for k in range(-1, len(self._polygon)-1):
-                p1 = self._polygon[k]
-                p2 = self._polygon[k+1]
-                painter.drawLine(p1, p2)
-
-        functools.update_wrapper(paint, oldpaint)
-        PolygonItem.paint = paint
+        PolygonItem.paint = _polygon_item_paint
 
     def removeRectEnumeration(self):
-        oldpaint = RectItem.paint
-
-        def paint(self, painter, option, widget=None):
-            BaseItem.paint(self, painter, option, widget)
-
-            pen = self.pen()
-            if self.isSelected():
-                pen.setStyle(Qt.DashLine)
-            painter.setPen(pen)
-            painter.drawRect(self.boundingRect())
-
-        functools.update_wrapper(paint, oldpaint)
-        RectItem.paint = paint
+        RectItem.paint = _rect_item_paint
 
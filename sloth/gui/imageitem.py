@@ -0,0 +1,150 @@
+"""
+Display of large images in tiles.
+"""
+import math
+import tempfile
+from collections import OrderedDict
+import numpy as np
+from PyQt4.QtCore import QRectF
+from PyQt4.QtGui import QGraphicsItem, QPixmap, QStyleOptionGraphicsItem
+from sloth.utils import toQImage
+import logging
+LOG = logging.getLogger(__name__)
+
+
+class TiledImageItem(QGraphicsItem):
+    """
+    Graphics item displaying an image which is too large to be converted
+    into one pixmap.  The image is split into tiles, and only the tiles
+    visible in the view are converted into pixmaps when they are painted,
+    at the resolution matching the scale of the view.  The converted tiles
+    are kept in a least-recently-used cache of ``cache_size`` bytes.
+
+    The smaller resolutions are computed by averaging 2x2 pixels of the
+    next larger resolution.  They are stored in temporary files and filled
+    in per tile when a tile is painted for the first time, so that zooming
+    out reads every pixel of the image only once.
+
+    The image can be any numpy array supported by
+    :func:`sloth.utils.toQImage`.  If it is memory-mapped (e.g. a ``.npy``
+    file loaded with ``mmap_mode``), only the pixels of the painted tiles
+    are read from disk.
+    """
+
+    tile_size = 512
+
+    def __init__(self, image, cache_size=128 * 1024 * 1024, parent=None):
+        QGraphicsItem.__init__(self, parent)
+        # needed for the exposed rect of the paint option
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+
+        self._image = image
+        self._height, self._width = image.shape[:2]
+        self._cache_size = cache_size
+        self._cache_used = 0
+        self._tiles = OrderedDict()
+
+        # the resolution pyramid, each level half the size of the previous
+        # one.  The smaller levels are memory-mapped temporary files, and
+        # _done marks their tiles which have been computed already.
+        self._levels = [image]
+        self._done = [None]
+        while max(self._levels[-1].shape[:2]) > self.tile_size:
+            h, w = self._levels[-1].shape[:2]
+            shape = ((h + 1) // 2, (w + 1) // 2) + image.shape[2:]
+            self._levels.append(np.memmap(tempfile.TemporaryFile(), dtype=image.dtype,
+                                          mode='w+', shape=shape))
+            self._done.append(np.zeros(self._tileCount(shape), dtype=bool))
+
+    def image(self):
+        return self._image
+
+    def levelCount(self):
+        """
+        Returns the number of resolution levels of the image.
+        """
+        return len(self._levels)
+
+    def boundingRect(self):
+        return QRectF(0, 0, self._width, self._height)
+
+    def paint(self, painter, option, widget=None):
+        lod = QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+        # use the smallest level which still has at least the resolution
+        # of the screen
+        level = 0
+        if 0 < lod < 1:
+            level = min(int(math.floor(math.log(1. / lod, 2))), len(self._levels) - 1)
+
+        rect = option.exposedRect & self.boundingRect()
+        if rect.isEmpty():
+            return
+
+        scale = 2 ** level
+        size = self.tile_size * scale
+        for ty in range(int(rect.top() // size), int(math.ceil(rect.bottom() / size))):
+            for tx in range(int(rect.left() // size), int(math.ceil(rect.right() / size))):
+                pixmap = self._tile(level, tx, ty)
+                if pixmap.isNull():
+                    continue
+                x, y = tx * size, ty * size
+                # the last pixel of an odd sized level covers one pixel
+                # more than the image, clip it in both rects so that the
+                # tile is not stretched
+                width = min(pixmap.width() * scale, self._width - x)
+                height = min(pixmap.height() * scale, self._height - y)
+                painter.drawPixmap(QRectF(x, y, width, height), pixmap,
+                                   QRectF(0, 0, float(width) / scale, float(height) / scale))
+
+    def _tile(self, level, tx, ty):
+        key = (level, tx, ty)
+        pixmap = self._tiles.pop(key, None)
+        if pixmap is None:
+            data = np.ascontiguousarray(self._tileData(level, tx, ty))
+            pixmap = QPixmap.fromImage(toQImage(data))
+            self._cache_used += self._pixmapSize(pixmap)
+        self._tiles[key] = pixmap
+
+        while self._cache_used > self._cache_size and len(self._tiles) > 1:
+            old_key, old_pixmap = self._tiles.popitem(last=False)
+            self._cache_used -= self._pixmapSize(old_pixmap)
+        return pixmap
+
+    def _tileData(self, level, tx, ty):
+        # Returns the pixels of a tile, computing them from the 2x2 tiles
+        # of the next larger level first if needed
+        n = self.tile_size
+        data = self._levels[level][ty*n:(ty+1)*n, tx*n:(tx+1)*n]
+        if level == 0 or self._done[level][ty, tx]:
+            return data
+
+        larger = self._levels[level - 1]
+        if level > 1:
+            rows, cols = self._done[level - 1].shape
+            for y in range(2*ty, min(2*ty + 2, rows)):
+                for x in range(2*tx, min(2*tx + 2, cols)):
+                    self._tileData(level - 1, x, y)
+        data[...] = _downsample(larger[2*ty*n:2*(ty+1)*n, 2*tx*n:2*(tx+1)*n], data.dtype)
+        self._done[level][ty, tx] = True
+        return data
+
+    def _tileCount(self, shape):
+        n = self.tile_size
+        return (-(-shape[0] // n), -(-shape[1] // n))
+
+    def _pixmapSize(self, pixmap):
+        return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+
+def _downsample(data, dtype):
+    # Halves the resolution of an image by averaging blocks of 2x2 pixels,
+    # repeating the last row and column for odd sizes
+    h, w = data.shape[:2]
+    pad = [(0, h % 2), (0, w % 2)] + [(0, 0)] * (data.ndim - 2)
+    if h % 2 or w % 2:
+        data = np.pad(data, pad, mode='edge')
+    blocks = data.reshape((data.shape[0] // 2, 2, data.shape[1] // 2, 2) + data.shape[2:])
+    mean = blocks.mean(axis=(1, 3))
+    if np.issubdtype(dtype, np.integer):
+        mean = np.rint(mean)
+    return mean.astype(dtype)
@@ -1,5 +1,5 @@
 #!/usr/bin/python
-import logging, os
+import logging, os, time
 import functools
 import fnmatch
 from PyQt4.QtGui import QMainWindow, QSizePolicy, QWidget, QVBoxLayout, QAction,\
@@ -23,44 +23,147 @@ GUIDIR=os.path.join(os.path.dirname(__file__))
 LOG=logging.getLogger(__name__)
 
 class BackgroundLoader(QObject):
+    """
+    Creates the model items of the annotations while the GUI is idle.  On
+    every call of load() as many items as fit into the time slice of
+    ``config.BACKGROUND_LOADING_SLICE`` milliseconds are loaded.  The files
+    are processed starting at the current image, in the order the images
+    are usually labeled, so the next images are loaded first.
+    """
     finished = pyqtSignal()
+    # emitted with True when all files are loaded, but the model is still
+    # receiving files from the loader thread, and with False when there is
+    # work again
+    waiting = pyqtSignal(bool)
 
-    def __init__(self, model, statusbar, progress):
+    # minimum time in seconds between two updates of the progress bar
+    progress_interval = 0.2
+
+    def __init__(self, model, statusbar, progress, current=None):
         QObject.__init__(self)
         self._max_levels = 3
         self._model = model
+        self._current = current
+        self._slice = config.BACKGROUND_LOADING_SLICE / 1000.
         self._statusbar = statusbar
         self._message_displayed = False
         self._progress = progress
         self._progress.setMinimum(0)
-        self._progress.setMaximum(1000 * self._max_levels)
         self._progress.setMaximumWidth(150)
+        self._last_progress = 0
+
+        # file items which are loaded already, and the row to continue at.
+        # The row is adjusted when files are inserted or removed.
+        self._done = set()
+        self._row = 0
+        self._anchor = None
+        self._items = None
+        self._waiting = False
+        self._model.rowsInserted.connect(self._rowsInserted)
+        self._model.rowsAboutToBeRemoved.connect(self._rowsAboutToBeRemoved)
+
+    def stop(self):
+        self._model.rowsInserted.disconnect(self._rowsInserted)
+        self._model.rowsAboutToBeRemoved.disconnect(self._rowsAboutToBeRemoved)
+
+    def _rowsInserted(self, parent, first, last):
+        if not parent.isValid() and first < self._row:
+            self._row += last - first + 1
+
+    def _rowsAboutToBeRemoved(self, parent, first, last):
+        if parent.isValid():
+            return
+        root = self._model.root()
+        if last - first + 1 <= len(self._done):
+            for row in range(first, last + 1):
+                self._done.discard(root.childAt(row))
+        else:
+            self._done = set(item for item in self._done if not first <= item.row() <= last)
+        if self._anchor is not None and first <= self._anchor.row() <= last:
+            self._anchor = None
+        if self._row > last:
+            self._row -= last - first + 1
+        elif self._row > first:
+            self._row = first
+
+    def _fileItem(self, item):
+        # the file item which contains item
+        while item is not None and item.parent() is not None \
+                and item.parent() is not self._model.root():
+            item = item.parent()
+        if item is None or item.parent() is None:
+            return None
+        return item
 
-        self._level = 1
-        self._iterator = self._model.iterator(maxlevels=self._level)
-        self._pos = 0
-        self._rows = self._model.root().rowCount() + 1
-        self._next_rows = 0
+    def _walk(self, item, levels):
+        yield item
+        if levels > 1:
+            row = item.keyRowCount()
+            while row < item.rowCount():
+                for child in self._walk(item.childAt(row), levels - 1):
+                    yield child
+                row += 1
+
+    def _nextFile(self):
+        # Continue with the file of the current image, if the user moved on
+        if self._current is not None:
+            anchor = self._fileItem(self._current())
+            if anchor is not None and anchor is not self._anchor:
+                self._anchor = anchor
+                self._row = anchor.row()
+        root = self._model.root()
+        rows = root.rowCount()
+        if len(self._done) >= rows:
+            # all files are loaded, e.g. while waiting for the loader thread
+            return None
+        for i in range(rows):
+            row = (self._row + i) % rows
+            item = root.childAt(row)
+            if item not in self._done:
+                self._done.add(item)
+                self._row = row + 1
+                return item
+        return None
+
+    def _updateProgress(self, force=False):
+        now = time.time()
+        if force or now - self._last_progress >= self.progress_interval:
+            self._progress.setMaximum(self._model.root().rowCount())
+            self._progress.setValue(len(self._done))
+            self._last_progress = now
+
+    def _setWaiting(self, waiting):
+        if waiting != self._waiting:
+            self._waiting = waiting
+            self.waiting.emit(waiting)
 
     def load(self):
         if not self._message_displayed:
             self._statusbar.showMessage("Loading annotations...", 5000)
             self._message_displayed = True
-        if self._level <= self._max_levels and self._rows > 0:
-            try:
-                item = next(self._iterator)
-                self._next_rows += item.rowCount()
-                self._pos += 1
-                self._progress.setValue(int((float(self._pos) / float(self._rows) + self._level - 1) * 1000))
-            except StopIteration:
-                self._level += 1
-                self._iterator = self._model.iterator(maxlevels=self._level)
-                self._pos = 0
-                self._rows = self._next_rows
-                self._next_rows = 1
-        else:
-            LOG.debug("Loading finished...")
-            self.finished.emit()
+
+        deadline = time.time() + self._slice
+        while True:
+            if self._items is None:
+                item = self._nextFile()
+                if item is None:
+                    self._updateProgress(force=True)
+                    if self._model.loading():
+                        self._setWaiting(True)
+                        return
+                    LOG.debug("Loading finished...")
+                    self.finished.emit()
+                    return
+                self._setWaiting(False)
+                self._items = self._walk(item, self._max_levels)
+            for item in self._items:
+                if time.time() >= deadline:
+                    break
+            else:
+                self._items = None
+            if time.time() >= deadline:
+                break
+        self._updateProgress()
 
 class MainWindow(QMainWindow):
     def __init__(self, labeltool, parent=None):
@@ -94,9 +197,11 @@ class MainWindow(QMainWindow):
 
     def startBackgroundLoading(self):
         self.stopBackgroundLoading(forced=True)
-        self.loader = BackgroundLoader(self.labeltool.model(), self.statusBar(), self.sb_progress)
+        self.loader = BackgroundLoader(self.labeltool.model(), self.statusBar(), self.sb_progress,
+                                       self.labeltool.currentImage)
         self.idletimer.timeout.connect(self.loader.load)
         self.loader.finished.connect(self.stopBackgroundLoading)
+        self.loader.waiting.connect(self.onBackgroundLoaderWaiting)
         self.statusBar().addWidget(self.sb_progress)
         self.sb_progress.show()
         self.idletimer.start()
@@ -105,11 +210,17 @@ class MainWindow(QMainWindow):
         if not forced:
             self.statusBar().showMessage("Background loading finished", 5000)
         self.idletimer.stop()
+        self.idletimer.setInterval(0)
         if self.loader is not None:
             self.idletimer.timeout.disconnect(self.loader.load)
+            self.loader.stop()
             self.statusBar().removeWidget(self.sb_progress)
             self.loader = None
 
+    def onBackgroundLoaderWaiting(self, waiting):
+        # do not poll for new files of the loader thread on every idle tick
+        self.idletimer.setInterval(100 if waiting else 0)
+
     def onAnnotationsLoaded(self):
         self.labeltool.model().dirtyChanged.connect(self.onModelDirtyChanged)
         self.onModelDirtyChanged(self.labeltool.model().dirty())
@@ -127,7 +238,7 @@ class MainWindow(QMainWindow):
         self.onFitToWindowModeChanged()
         self.treeview.scrollTo(new_image.index())
 
-        img = self.labeltool.getImage(new_image)
+        img = self.scene.image()
 
         if img == None:
             self.controls.setFilename("")
@@ -401,7 +512,7 @@ class MainWindow(QMainWindow):
                 "%s - Load Annotations" % APP_NAME, path,
                 "%s annotation files (%s)" % (APP_NAME, format_str))
         if len(str(fname)) > 0:
-            self.labeltool.loadAnnotations(fname)
+            self.labeltool.loadAnnotations(fname, background=True)
 
     def fileSave(self):
         filename = self.labeltool.getCurrentFilename()
@@ -471,6 +582,7 @@ class MainWindow(QMainWindow):
     def closeEvent(self, event):
         if self.okToContinue():
             self.saveApplicationSettings()
+            self.labeltool.closeAnnotations()
         else:
             event.ignore()
 
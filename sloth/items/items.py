@@ -1,4 +1,5 @@
 import logging
+import numpy as np
 from PyQt4.Qt import *
 
 
@@ -62,6 +63,104 @@ class IgnorePrefix:
         return self.value
 
 
+class TextItem(QGraphicsItem):
+    """
+    Displays the label text of a visualization item.  The text is rendered
+    once into a pixmap that is shared via ``QPixmapCache`` by all items with
+    the same text, color and font, so that items with equal labels neither
+    lay out nor store their text twice.
+    """
+
+    def __init__(self, parent=None):
+        QGraphicsItem.__init__(self, parent)
+        self.setAcceptHoverEvents(False)
+        self.setFlags(QGraphicsItem.ItemIgnoresTransformations)
+        self._html = ""
+        self._color = QColor(Qt.black)
+        self._font = QFont()
+        self._background = None
+        self._pixmap = QPixmap()
+
+    def setHtml(self, html):
+        if html != self._html:
+            self._html = html
+            self._updatePixmap()
+
+    def html(self):
+        return self._html
+
+    def setDefaultTextColor(self, color):
+        color = QColor(color)
+        if color != self._color:
+            self._color = color
+            self._updatePixmap()
+
+    def defaultTextColor(self):
+        return self._color
+
+    def setFont(self, font):
+        self._font = QFont(font)
+        self._updatePixmap()
+
+    def font(self):
+        return self._font
+
+    def setBackgroundBrush(self, brush=None):
+        self._background = brush
+        self.update()
+
+    def _updatePixmap(self):
+        self.prepareGeometryChange()
+        if self._html:
+            self._pixmap = self.renderText(self._html, self._color, self._font)
+        else:
+            self._pixmap = QPixmap()
+
+    @staticmethod
+    def renderText(html, color, font):
+        """
+        Returns the pixmap of the given text, taken from the pixmap cache
+        if it has been rendered before.
+        """
+        key = "sloth-text:%s:%s:%s" % (color.name(), font.key(), html)
+        pixmap = QPixmapCache.find(key)
+        if pixmap is not None and not pixmap.isNull():
+            return pixmap
+
+        doc = QTextDocument()
+        doc.setDefaultFont(font)
+        doc.setHtml(html)
+        size = doc.size().toSize()
+        pixmap = QPixmap(size)
+        pixmap.fill(Qt.transparent)
+        painter = QPainter(pixmap)
+        context = QAbstractTextDocumentLayout.PaintContext()
+        context.palette.setColor(QPalette.Text, color)
+        doc.documentLayout().draw(painter, context)
+        painter.end()
+        QPixmapCache.insert(key, pixmap)
+        return pixmap
+
+    def boundingRect(self):
+        return QRectF(QPointF(0, 0), QSizeF(self._pixmap.size()))
+
+    def paint(self, painter, option, widget=None):
+        if self._pixmap.isNull():
+            return
+        # the text itself ignores transformations, so the level of detail
+        # is the one the parent item has just been painted with.  This
+        # works for any paint device, e.g. also when printing the scene.
+        parent = self.parentItem()
+        threshold = getattr(parent, 'textLevelOfDetail', 0)
+        if threshold > 0:
+            lod = parent.paintLevelOfDetail()
+            if lod is not None and lod < threshold:
+                return
+        if self._background is not None:
+            painter.fillRect(self.boundingRect(), self._background)
+        painter.drawPixmap(0, 0, self._pixmap)
+
+
 class BaseItem(QAbstractGraphicsShapeItem):
     """
     Base class for visualization items.
@@ -71,6 +170,12 @@ class BaseItem(QAbstractGraphicsShapeItem):
     hotkeys = {}
     defaultAutoTextKeys = []
 
+    # level of detail, i.e. zoom factor of the view, below which the label
+    # text is not drawn
+    textLevelOfDetail = 0.3
+    # items smaller than this many pixels on screen are drawn simplified
+    minimumDetailSize = 3
+
     def __init__(self, model_item=None, prefix="", parent=None):
         """
         Creates a visualization item.
@@ -81,21 +186,21 @@ class BaseItem(QAbstractGraphicsShapeItem):
                       QGraphicsItem.ItemSendsGeometryChanges |
                       QGraphicsItem.ItemSendsScenePositionChanges)
 
+        # the changes of the model item are passed on by the scene, see
+        # AnnotationScene.dataChanged()
         self._model_item = model_item
-        if self._model_item is not None:
-            self._model_item.model().dataChanged.connect(self.onDataChanged)
 
         # initialize members
         self._prefix = prefix
         self._auto_text_keys = self.defaultAutoTextKeys[:]
         self._text = ""
         self._text_bg_brush = None
-        self._text_item = QGraphicsTextItem(self)
-        self._text_item.setPos(0, 0)
-        self._text_item.setAcceptHoverEvents(False)
-        self._text_item.setFlags(QGraphicsItem.ItemIgnoresTransformations)
-        self._text_item.setHtml(self._compile_text())
+        # the text item is only created once there is text to display
+        self._text_item = None
+        self._updateText()
         self._valid = True
+        # the level of detail of the last paint, see paintLevelOfDetail()
+        self._paint_lod = None
 
         if len(self.cycleValuesOnKeypress) > 0:
             logging.warning("cycleValueOnKeypress is deprecated and will be removed in the future. " +
@@ -114,7 +219,10 @@ class BaseItem(QAbstractGraphicsShapeItem):
     def onDataChanged(self, indexFrom, indexTo):
         # FIXME why is this not updated, when changed graphically via attribute box ?
         #print "onDataChanged", self._model_item.index(), indexFrom, indexTo, indexFrom.parent()
-        if indexFrom == self._model_item.index():
+        # changes of several rows may be reported as one range
+        index = self._model_item.index()
+        if indexFrom.parent() == index.parent() and \
+                indexFrom.row() <= index.row() <= indexTo.row():
             self.changeColor()
             #print "hit"
             # self._text_item.setHtml(self._compile_text())
@@ -125,6 +233,18 @@ class BaseItem(QAbstractGraphicsShapeItem):
         """
         return self._model_item
 
+    def rebind(self, model_item):
+        """
+        Binds the item to another model item and updates it accordingly.
+        The scene reuses the items of the previous image this way, instead
+        of creating new items for the annotations of each image.
+        """
+        self._model_item = model_item
+        self._valid = True
+        self.setSelected(False)
+        self.changeColor()
+        self.dataChanged()
+
     def index(self):
         """
         Returns the index of this item.
@@ -140,14 +260,15 @@ class BaseItem(QAbstractGraphicsShapeItem):
     def setPen(self, pen):
         pen = QPen(pen)  # convert to pen if argument is a QColor
         QAbstractGraphicsShapeItem.setPen(self, pen)
-        self._text_item.setDefaultTextColor(pen.color())
+        if self._text_item is not None:
+            self._text_item.setDefaultTextColor(pen.color())
 
     def setText(self, text=""):
         """
         Sets a text to be displayed on this item.
         """
         self._text = text
-        self._text_item.setHtml(self._compile_text())
+        self._updateText()
 
     def text(self):
         return self._text
@@ -159,6 +280,8 @@ class BaseItem(QAbstractGraphicsShapeItem):
         (leave transparent).
         """
         self._text_bg_brush = brush
+        if self._text_item is not None:
+            self._text_item.setBackgroundBrush(brush)
 
     def textBackgroundBrush(self):
         """
@@ -172,7 +295,7 @@ class BaseItem(QAbstractGraphicsShapeItem):
         are displayed automatically as text.
         """
         self._auto_text_keys = keys or []
-        self._text_item.setHtml(self._compile_text())
+        self._updateText()
 
     def autoTextKeys(self):
         """
@@ -201,9 +324,19 @@ class BaseItem(QAbstractGraphicsShapeItem):
                     (key, self._model_item.get(key, "")))
         return '<br/>'.join(text_lines)
 
+    def _updateText(self):
+        html = self._compile_text()
+        if self._text_item is None:
+            if not html:
+                return
+            self._text_item = TextItem(self)
+            self._text_item.setDefaultTextColor(self.pen().color())
+            self._text_item.setBackgroundBrush(self._text_bg_brush)
+        self._text_item.setHtml(html)
+
     def dataChanged(self):
         self.dataChange()
-        self._text_item.setHtml(self._compile_text())
+        self._updateText()
         self.update()
 
     def dataChange(self):
@@ -222,7 +355,29 @@ class BaseItem(QAbstractGraphicsShapeItem):
         self.update()
 
     def paint(self, painter, option, widget=None):
-        pass
+        self._paint_lod = self.levelOfDetail(painter)
+
+    def paintLevelOfDetail(self):
+        """
+        Returns the level of detail the item has been painted with the last
+        time, or None if it has not been painted yet.  The label text uses it,
+        because it ignores the transformations itself.
+        """
+        return self._paint_lod
+
+    def levelOfDetail(self, painter):
+        """
+        Returns the scale at which the item is painted, i.e. how many pixels
+        on screen one unit of the item covers.
+        """
+        return QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+
+    def isSimplified(self, painter, size):
+        """
+        Returns whether an item of the given size is drawn simplified,
+        because it is smaller than ``minimumDetailSize`` pixels on screen.
+        """
+        return size * self.levelOfDetail(painter) < self.minimumDetailSize
 
     def itemChange(self, change, value):
         if change == QGraphicsItem.ItemPositionHasChanged:
@@ -327,6 +482,12 @@ class PointItem(BaseItem):
         BaseItem.paint(self, painter, option, widget)
 
         pen = self.pen()
+        if self.isSimplified(painter, 2 * self._radius):
+            pen.setCosmetic(True)
+            painter.setPen(pen)
+            painter.drawPoint(QPointF(0, 0))
+            return
+
         if self.isSelected():
             pen.setStyle(Qt.DashLine)
         painter.setPen(pen)
@@ -368,6 +529,10 @@ class RectItem(BaseItem):
         item.setBrush(self.brush())
         return item
 
+    def rebind(self, model_item):
+        self._resize = False
+        BaseItem.rebind(self, model_item)
+
     def _dataToRect(self, model_item):
         if model_item is None:
             return QRectF()
@@ -407,10 +572,17 @@ class RectItem(BaseItem):
         BaseItem.paint(self, painter, option, widget)
 
         pen = self.pen()
+        rect = self.boundingRect()
+        if self.isSimplified(painter, max(rect.width(), rect.height())):
+            pen.setCosmetic(True)
+            painter.setPen(pen)
+            painter.drawPoint(rect.center())
+            return
+
         if self.isSelected():
             pen.setStyle(Qt.DashLine)
         painter.setPen(pen)
-        painter.drawRect(self.boundingRect())
+        painter.drawRect(rect)
 
     def dataChange(self):
         rect = self._dataToRect(self._model_item)
@@ -510,7 +682,7 @@ class MultiPointItem(BaseItem):
             LOG.debug("MultiPointItem: Could not find expected key in item: "
                       + str(e) + ". Check your config!")
             self.setValid(False)
-            return QRectF()
+            return []
 
     def _updatePoints(self, points):
         if points == self._points:
@@ -518,9 +690,13 @@ class MultiPointItem(BaseItem):
 
         self.prepareGeometryChange()
         self._points = points
+        self._point_polygon = QPolygonF([QPointF(x, y) for x, y in
+                                         zip(points[::2], points[1::2])])
         self.setPos(QPointF(0, 0))
 
     def boundingRect(self):
+        if not self._points:
+            return QRectF()
         xmin = min(self._points[::2])
         xmax = max(self._points[::2])
         ymin = min(self._points[1::2])
@@ -531,16 +707,22 @@ class MultiPointItem(BaseItem):
         BaseItem.paint(self, painter, option, widget)
 
         pen = self.pen()
+        if self.isSimplified(painter, 2):
+            # draw all points at once
+            pen.setCosmetic(True)
+            painter.setPen(pen)
+            painter.drawPoints(self._point_polygon)
+            return
+
         if self.isSelected():
             pen.setStyle(Qt.DashLine)
         painter.setPen(pen)
-        for k in range(len(self._points)/2):
-            x, y = self._points[2*k:2*k+2]
-            painter.drawEllipse(QRectF(x-1, y-1, 2, 2))
+        for point in self._point_polygon:
+            painter.drawEllipse(point, 1, 1)
 
     def dataChange(self):
         points = self._dataToPoints(self._model_item)
-        self._updateRect(points)
+        self._updatePoints(points)
 
 
 class GroupItem(BaseItem):
@@ -558,6 +740,11 @@ class GroupItem(BaseItem):
             child = callable_(self._model_item, prefix, self)
             self._children.append(child)
 
+    def rebind(self, model_item):
+        BaseItem.rebind(self, model_item)
+        for child in self._children:
+            child.rebind(model_item)
+
     def setColor(self, *args, **kwargs):
         for c in self._children:
             c.setColor(*args, **kwargs)
@@ -732,6 +919,14 @@ class NPointFaceItem(GroupItem):
     def __init__(self, model_item=None, prefix="", parent=None):
         GroupItem.__init__(self, model_item, prefix, parent)
 
+    def rebind(self, model_item):
+        # the children depend on the points present in the model item
+        for child in self._children:
+            child.setParentItem(None)
+        self._children = []
+        BaseItem.rebind(self, model_item)
+        self.createChildren()
+
     def createChildren(self):
         for callable_, prefix in self.items:
             if prefix + 'x' in self._model_item and \
@@ -766,6 +961,7 @@ class PolygonItem(BaseItem):
         self.setFlags(QGraphicsItem.ItemIsSelectable |
                       QGraphicsItem.ItemSendsGeometryChanges |
                       QGraphicsItem.ItemSendsScenePositionChanges)
+        self._vertices = None
         self._polygon = None
 
         self._updatePolygon(self._dataToPolygon(self._model_item))
@@ -780,52 +976,68 @@ class PolygonItem(BaseItem):
 
     def _dataToPolygon(self, model_item):
         if model_item is None:
-            return QPolygonF()
+            return np.zeros((0, 2))
 
         try:
-            polygon = QPolygonF()
-            xn = [float(x) for x in model_item["xn"].split(";")]
-            yn = [float(y) for y in model_item["yn"].split(";")]
-            for x, y in zip(xn, yn):
-              polygon.append(QPointF(x, y))
-
-            return polygon
+            # the vertices are read from the geometry store of the model,
+            # without parsing the xn/yn strings
+            return model_item.vertices("xn", "yn")
 
         except KeyError as e:
             LOG.debug("PolygonItem: Could not find expected key in item: "
                       + str(e) + ". Check your config!")
             self.setValid(False)
-            return QPolygonF()
+            return np.zeros((0, 2))
 
-    def _updatePolygon(self, polygon):
-        if polygon == self._polygon:
+    def _updatePolygon(self, vertices):
+        vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+        if self._vertices is not None and np.array_equal(vertices, self._vertices):
             return
 
         self.prepareGeometryChange()
-        self._polygon = polygon
+        # the vertex buffer, and everything Qt asks for repeatedly derived
+        # from it once per change
+        self._vertices = vertices
+        self._polygon = QPolygonF([QPointF(x, y) for x, y in vertices.tolist()])
+        # the closed outline, drawn as one polyline
+        self._outline = QPolygonF(self._polygon)
+        self._shape = QPainterPath()
+        if len(vertices) > 0:
+            self._outline.append(self._polygon[0])
+            self._shape.addPolygon(self._outline)
+            (xmin, ymin), (xmax, ymax) = vertices.min(axis=0), vertices.max(axis=0)
+            self._bounding_rect = QRectF(xmin, ymin, xmax - xmin, ymax - ymin)
+        else:
+            self._bounding_rect = QRectF()
         self.setPos(QPointF(0, 0))
 
+    def vertices(self):
+        """
+        Returns the vertices of the polygon as array of shape (n, 2).
+        """
+        return self._vertices
+
     def boundingRect(self):
-        xn = [p.x() for p in self._polygon]
-        yn = [p.y() for p in self._polygon]
-        xmin = min(xn)
-        xmax = max(xn)
-        ymin = min(yn)
-        ymax = max(yn)
-        return QRectF(xmin, ymin, xmax - xmin, ymax - ymin)
+        return self._bounding_rect
+
+    def shape(self):
+        return self._shape
 
     def paint(self, painter, option, widget=None):
         BaseItem.paint(self, painter, option, widget)
 
         pen = self.pen()
+        rect = self.boundingRect()
+        if self.isSimplified(painter, max(rect.width(), rect.height())):
+            pen.setCosmetic(True)
+            painter.setPen(pen)
+            painter.drawPoint(rect.center())
+            return
+
         if self.isSelected():
             pen.setStyle(Qt.DashLine)
         painter.setPen(pen)
-
-        for k in range(-1, len(self._polygon)-1):
-            p1 = self._polygon[k]
-            p2 = self._polygon[k+1]
-            painter.drawLine(p1, p2)
+        painter.drawPolyline(self._outline)
 
     def dataChange(self):
         polygon = self._dataToPolygon(self._model_item)
@@ -0,0 +1,354 @@
+import os
+from sloth.annotations.model import *
+
+
+def someVideo(labeled):
+    frames = []
+    for i, x in enumerate(labeled):
+        frame = {'num': i, 'timestamp': i / 25., 'annotations': []}
+        if x is None:
+            frame['unlabeled'] = True
+        else:
+            frame['annotations'].append({'type': 'rect', 'class': 'rect', 'x': x, 'y': 5,
+                                         'xn': '%d;%d' % (x, x + 3)})
+        frames.append(frame)
+    return [{'class': 'video', 'filename': 'video.avi', 'frames': frames}]
+
+
+def frameItems(model):
+    video = model.root().childAt(0)
+    return [video.childAt(video.keyRowCount() + i) for i in range(len(video.children()))]
+
+
+class MockupLabelTool:
+    def __init__(self, current):
+        self._current = current
+
+    def currentImage(self):
+        return self._current
+
+    def mainWindow(self):
+        return None
+
+
+def test_InterpolateRange():
+    model = AnnotationModel(someVideo([0, None, None, 30]))
+    frames = frameItems(model)
+    assert InterpolateRange(MockupLabelTool(frames[3])).interpolateRange()
+
+    anns = [[ann.getAnnotations() for ann in frame.annotations()] for frame in frames]
+    assert [a[0]['x'] for a in anns] == [0, 10, 20, 30]
+    # the values keep the types of the integer division of the python version
+    assert [a[0]['xn'] for a in anns[1:3]] == ['%s;%s' % (30 / 3, 3 + 30 / 3),
+                                               '%s;%s' % (2 * (30 / 3), 3 + 2 * (30 / 3))]
+
+
+def test_InterpolateRange_custom_function():
+    model = AnnotationModel(someVideo([0, None, 30]))
+    frames = frameItems(model)
+    interp = InterpolateRange(MockupLabelTool(frames[2]))
+    calls = []
+
+    def nearest(p1, p2, step, steps):
+        calls.append((p1, p2, step, steps))
+        return p1 if step <= steps / 2. else p2
+    interp._interp_func = nearest
+
+    assert interp.interpolateRange()
+    assert (0, 30, 1, 1) in calls and (5, 5, 1, 1) in calls
+    ann = next(frames[1].annotations())
+    assert ann['x'] == 30 and ann['xn'] == '30;33'
+
+
+def test_InterpolateRange_adjacent_frames():
+    model = AnnotationModel(someVideo([0, 30]))
+    frames = frameItems(model)
+    assert InterpolateRange(MockupLabelTool(frames[1])).interpolateRange()
+    assert [next(frame.annotations())['x'] for frame in frames] == [0, 30]
+
+
+def someImages(n):
+    return [{'class': 'image', 'filename': 'image%d.png' % i,
+             'annotations': [{'class': 'rect', 'x': i, 'y': 2 * i, 'width': 10, 'height': 10}]}
+            for i in range(n)]
+
+
+def test_getAnnotations_copy():
+    model = AnnotationModel(someImages(2))
+    image = model.root().childAt(0)
+    entry = image.getAnnotations()
+    entry['annotations'].append({'class': 'point', 'x': 1, 'y': 1})
+    entry['annotations'][0]['x'] = 100
+
+    assert len(image.children()) == 1
+    assert image.getAnnotations() == someImages(2)[0]
+    assert model.root().getAnnotations() == someImages(2)
+    assert model.root().counts()['annotations'] == 2
+
+
+def test_fileEntries_lazy(tmpdir):
+    from sloth.annotations.container import SqliteContainer
+    filename = os.path.join(str(tmpdir), "test.sloth.db")
+    SqliteContainer().save(someImages(10), filename)
+    container = SqliteContainer()
+    entries = container.load(filename)
+
+    model = AnnotationModel(entries)
+    model.root().childAt(3).children()[0]['x'] = 100
+    changed = model.root().dirtyRows()
+    assert changed == [3]
+    container.save(model.root().fileEntries(), filename, changed)
+
+    # only the file item which has been modified was read from the database
+    assert [i for i, entry in enumerate(entries) if entry['annotations']._rows is not None] == [3]
+    expected = someImages(10)
+    expected[3]['annotations'][0]['x'] = 100
+    assert [dict(f, annotations=list(f['annotations']))
+            for f in SqliteContainer().load(filename)] == expected
+
+
+def test_counts_lazy(tmpdir):
+    from sloth.annotations.container import SqliteContainer
+    annotations = someImages(3) + someVideo([0, None, 30])
+    annotations[0]['annotations'][0]['unconfirmed'] = True
+    annotations[1]['unlabeled'] = False
+    filename = os.path.join(str(tmpdir), "test.sloth.db")
+    SqliteContainer().save(annotations, filename)
+    entries = SqliteContainer().load(filename)
+
+    model = AnnotationModel(entries)
+    counts = model.root().counts()
+    # the rows were counted by the database without reading them
+    assert [key for entry in entries for key in ('annotations', 'frames')
+            if key in entry and entry[key]._rows is not None] == []
+    assert counts == AnnotationModel(annotations).root().counts()
+    assert model.root().numAnnotations() == 5
+
+
+def test_JournalContainer_discard(tmpdir):
+    from sloth.annotations.container import JournalContainer
+    filename = os.path.join(str(tmpdir), "test.json")
+    JournalContainer().save(someImages(3), filename)
+
+    container = JournalContainer()
+    model = AnnotationModel(container.load(filename))
+    container.attachModel(model)
+    model.root().childAt(0)['filename'] = 'saved.png'
+    container.save(model.root().fileEntries(), filename)
+    model.root().childAt(1)['filename'] = 'discarded.png'
+    container.detachModel(model)
+    assert model.journal() is None
+
+    # only the saved modifications are replayed
+    expected = someImages(3)
+    expected[0]['filename'] = 'saved.png'
+    assert JournalContainer().load(filename) == expected
+
+
+def test_KeyValueModelItem_mapping():
+    entries = someImages(1)
+    entries[0]['annotations'][0]['id'] = 7
+    model = AnnotationModel(entries)
+    ann = model.root().childAt(0).children()[0]
+    assert not hasattr(ann, '__dict__')
+    assert sorted(ann.keys()) == ['class', 'height', 'id', 'width', 'x', 'y']
+    assert dict(ann.items()) == dict(ann) == entries[0]['annotations'][0]
+    assert ann.get('id') == 7 and ann.get('missing', 3) == 3
+    assert ann.pop('id') == 7 and ann.pop('id', None) is None
+    assert ann.setdefault('label', 'a') == 'a' and ann['label'] == 'a'
+    # the entry passed to the model is copied on write
+    assert entries[0]['annotations'][0]['id'] == 7
+    ann.clear()
+    assert len(ann) == 0 and ann.keys() == []
+
+
+def test_rows_after_insert_and_delete():
+    model = AnnotationModel(someVideo([None] * 10))
+    video = model.root().childAt(0)
+    first = video.keyRowCount()
+    frames = frameItems(model)
+    frames[2].delete()
+    video.deleteChild(first + 5)
+    frame = FrameModelItem({'num': 20, 'timestamp': 0.8, 'annotations': []})
+    video.insertChild(1, frame)
+    video.insertChild(2, FrameModelItem({'num': 21, 'timestamp': 0.84, 'annotations': []}))
+    video.appendChild(FrameModelItem({'num': 22, 'timestamp': 0.88, 'annotations': []}))
+
+    expected = [0, 20, 21, 1, 3, 4, 5, 7, 8, 9, 22]
+    assert [f.framenum() for f in video.children()] == expected
+    assert [f.row() - first for f in video.children()] == list(range(len(expected)))
+    assert [f.dataPath() for f in video.children()] == [[0, i] for i in range(len(expected))]
+
+
+def someLabeledImages():
+    return [{'class': 'image', 'filename': 'a.png',
+             'annotations': [{'class': 'rect', 'x': 1, 'y': 1, 'width': 2, 'height': 2},
+                             {'class': 'point', 'x': 5, 'y': 5, 'unconfirmed': True}]},
+            {'class': 'image', 'filename': 'b.png', 'unlabeled': True, 'annotations': []},
+            {'class': 'image', 'filename': 'c.png',
+             'annotations': [{'class': 'point', 'x': 3, 'y': 4}]}]
+
+
+def test_counts_after_edits():
+    model = AnnotationModel(someLabeledImages())
+    root = model.root()
+    counts = root.counts()
+    assert counts['files'] == 3 and counts['annotations'] == 3
+    assert counts['unconfirmed'] == 1 and counts['unlabeled'] == 1
+    assert counts[('class', 'point')] == 2
+
+    a, b, c = [root.childAt(i) for i in range(3)]
+    a.children()[0]['class'] = 'point'
+    a.children()[1].setUnconfirmed(False)
+    b.addAnnotation({'class': 'rect', 'x': 0, 'y': 0, 'width': 1, 'height': 1, 'unconfirmed': True})
+    b.setUnlabeled(False)
+    c.children()[0].delete()
+
+    counts = root.counts()
+    assert counts == AnnotationModel(root.getAnnotations()).root().counts()
+    assert counts['annotations'] == 3 and counts['unconfirmed'] == 1 and counts['unlabeled'] == 0
+    assert counts[('class', 'point')] == 2 and counts[('class', 'rect')] == 1
+    assert b.counts()['annotations'] == 1
+
+
+def test_batch_signals():
+    model = AnnotationModel(someLabeledImages())
+    image = model.root().childAt(0)
+    anns = image.children()
+    signals = []
+    model.dataChanged.connect(lambda tl, br: signals.append(('dataChanged', tl.row(), br.row())))
+    model.layoutChanged.connect(lambda: signals.append(('layoutChanged', )))
+    model.rowsInserted.connect(lambda parent, first, last: signals.append(('rowsInserted', )))
+
+    with model.batch():
+        anns[0]['x'] = 10
+        anns[0]['y'] = 20
+        anns[1]['x'] = 30
+        assert signals == []
+    # one dataChanged per parent, spanning the key/value rows x and y of
+    # the first annotation
+    assert sorted(signals) == [('dataChanged', 0, 0), ('dataChanged', 2, 3)]
+    assert model.dirty()
+
+    del signals[:]
+    with model.batch():
+        image.addAnnotation({'class': 'point', 'x': 1, 'y': 2})
+        with model.batch():
+            image.addAnnotation({'class': 'point', 'x': 3, 'y': 4})
+        assert signals == []
+    assert signals == [('layoutChanged', )]
+    assert len(image.children()) == 4
+
+
+def test_select():
+    model = AnnotationModel(someLabeledImages())
+    points = model.select({'class': 'point'}, AnnotationModelItem)
+    assert [(ann['x'], ann['y']) for ann in points] == [(5, 5), (3, 4)]
+    assert model.select({'unconfirmed': True}) == [points[0]]
+    assert [f['filename'] for f in model.select({'unlabeled': True})] == ['b.png']
+    assert model.select({'class': 'circle'}) == []
+    image = model.root().childAt(2)
+    assert model.select({'class': 'point'}, start=image) == [points[1]]
+
+
+def test_lazy_frames():
+    model = AnnotationModel(someVideo([0, None, 10, None, 20]))
+    video = model.root().childAt(0)
+    # the frames stay raw entries until they are accessed
+    assert video._unloaded == 5
+    counts = video.counts()
+    assert counts['frames'] == 5 and counts['annotations'] == 3 and counts['unlabeled'] == 2
+    assert video._unloaded == 5
+
+    frame = video.childAt(video.keyRowCount() + 2)
+    assert isinstance(frame, FrameModelItem) and frame.framenum() == 2
+    assert video._unloaded == 4
+    assert next(frame.annotations())['x'] == 10
+    assert video.getAnnotations() == someVideo([0, None, 10, None, 20])[0]
+
+
+def test_copy_on_write():
+    entries = someLabeledImages()
+    model = AnnotationModel(entries)
+    image = model.root().childAt(0)
+    ann, unmodified = image.children()
+    for item in (model.root(), image, ann):
+        assert not hasattr(item, '__dict__')
+
+    # the items share the raw entries until they are modified
+    assert unmodified._dict is entries[0]['annotations'][1]
+    ann['x'] = 100
+    image['filename'] = 'd.png'
+    assert entries == someLabeledImages()
+    assert unmodified._dict is entries[0]['annotations'][1]
+    assert ann['x'] == 100 and image['filename'] == 'd.png'
+
+
+def test_select_lazy():
+    entries = someVideo([0, None, 10, None]) + someLabeledImages()
+    entries[0]['frames'][2]['annotations'][0]['class'] = 'point'
+    model = AnnotationModel(entries)
+    root = model.root()
+
+    points = model.select({'class': 'point'})
+    assert [ann['x'] for ann in points] == [10, 5, 3]
+    # only the files and frames which contain points were loaded
+    video = root._children[0]
+    assert [isinstance(frame, ModelItem) for frame in video._children] == [False, False, True, False]
+    assert [isinstance(f, ModelItem) for f in root._children] == [True, True, False, True]
+
+
+def test_count_values():
+    model = AnnotationModel(someLabeledImages(), count_values=('class', 'x'))
+    assert model.countValues() == ('class', 'x')
+    assert model.root().counts()[('x', 5)] == 1
+    ann = model.root().childAt(2).children()[0]
+    ann['x'] = 5
+    assert model.root().counts()[('x', 5)] == 2
+    assert [a['y'] for a in model.select({'x': 5})] == [5, 4]
+    # other models keep the default
+    assert ('x', 5) not in AnnotationModel(someLabeledImages()).root().counts()
+
+
+def test_rows_repeated_inserts():
+    model = AnnotationModel(someImages(1))
+    image = model.root().childAt(0)
+    first = image.keyRowCount()
+    for i in range(200):
+        image.insertChild(0, AnnotationModelItem({'class': 'point', 'x': -i}))
+        image.insertChild(min(100, i), AnnotationModelItem({'class': 'point', 'x': 1000 + i}))
+    children = image.children()
+    assert len(children) == 401
+    assert [ann.row() - first for ann in children] == list(range(401))
+    assert [ann['x'] for ann in children[:3]] == [-199, -198, -197]
+
+    # the row index is compacted once most of its slots are empty
+    for ann in children[1:]:
+        ann.delete()
+    assert image.children() == [children[0]] and children[0].row() == first
+    assert image._rows.slotCount() <= 64 * 4
+
+
+def test_JournalContainer_compact_on_save(tmpdir):
+    from sloth.annotations.container import JournalContainer, JsonContainer
+    filename = os.path.join(str(tmpdir), "test.json")
+    JournalContainer().save(someImages(3), filename)
+
+    container = JournalContainer()
+    container.compact_size = 200
+    model = AnnotationModel(container.load(filename))
+    container.attachModel(model)
+    ann = model.root().childAt(0).children()[0]
+    ann['x'] = 1
+    container.save(model.root().fileEntries(), filename)
+    assert JsonContainer().load(filename) == someImages(3)
+
+    for i in range(10):
+        ann['x'] = i + 10
+    container.save(model.root().fileEntries(), filename)
+    # the journal grew too large, the edits were written into the snapshot
+    expected = someImages(3)
+    expected[0]['annotations'][0]['x'] = 19
+    assert JsonContainer().load(filename) == expected
+    assert os.path.getsize(filename + ".journal") < 100
+    assert JournalContainer().load(filename) == expected
@@ -112,3 +112,30 @@ def test_merge_command_same_file(tmpdir):
     assert len(merged_annotations) == 2
     assert len(merged_annotations[0]['annotations']) == 4
     assert len(merged_annotations[1]['annotations']) == 2
+
+
+def test_merge_command_multiple_inputs(tmpdir):
+    class LabelToolMockup:
+        container_config = (('*', 'sloth.annotations.container.StreamingJsonContainer'),)
+        _container_factory = AnnotationContainerFactory(container_config)
+
+    inputs = []
+    for i in range(3):
+        fname = str(tmpdir.join('input%d.json' % i))
+        json.dump([{'class': 'image', 'filename': 'shared.jpg', 'source%d' % i: True,
+                    'annotations': [{'class': 'point', 'x': i, 'y': i}]},
+                   {'class': 'image', 'filename': 'only%d.jpg' % i,
+                    'annotations': []}], open(fname, 'w'))
+        inputs.append(fname)
+
+    mc = MergeFilesCommand()
+    mc.labeltool = LabelToolMockup()
+    output_fname = str(tmpdir.join('output.json'))
+    mc.handle(*(inputs + [output_fname]))
+
+    merged_annotations = json.load(open(output_fname))
+    assert [it['filename'] for it in merged_annotations] == \
+        ['shared.jpg', 'only0.jpg', 'only1.jpg', 'only2.jpg']
+    shared = merged_annotations[0]
+    assert shared['source0'] and shared['source1'] and shared['source2']
+    assert [ann['x'] for ann in shared['annotations']] == [0, 1, 2]
@@ -64,3 +64,202 @@ def test_YamlContainer(tmpdir):
     filename = os.path.join(str(tmpdir), "test_YamlContainer.yaml")
     container = YamlContainer()
     common_container_test(filename, container)
+
+
+def test_StreamingJsonContainer(tmpdir):
+    filename = os.path.join(str(tmpdir), "test_StreamingJsonContainer.json")
+    container = StreamingJsonContainer()
+    common_container_test(filename, container)
+
+    # small chunks force values to be split across reads
+    container.chunk_size = 7
+    assert list(container.load(filename)) == someAnnotations()
+
+    # the output is readable by the non-streaming container
+    assert JsonContainer().load(filename) == someAnnotations()
+
+
+def test_StreamingJsonContainer_empty(tmpdir):
+    filename = os.path.join(str(tmpdir), "test_StreamingJsonContainer_empty.json")
+    container = StreamingJsonContainer()
+    container.save(iter([]), filename)
+    assert list(container.load(filename)) == []
+
+
+def test_SqliteContainer(tmpdir):
+    filename = os.path.join(str(tmpdir), "test_SqliteContainer.sloth.db")
+    container = SqliteContainer()
+    common_container_test(filename, container)
+
+    loaded = container.load(filename)
+    assert [dict(f, annotations=list(f['annotations'])) for f in loaded] == someAnnotations()
+
+
+def test_SqliteContainer_video(tmpdir):
+    filename = os.path.join(str(tmpdir), "test_SqliteContainer_video.sloth.db")
+    video = {'class': 'video', 'filename': 'video.avi',
+             'frames': [{'class': 'frame', 'num': i, 'timestamp': 0.1 * i,
+                         'annotations': someFileAnnotations(i)} for i in range(3)]}
+    container = SqliteContainer()
+    container.save([video], filename)
+
+    loaded = SqliteContainer().load(filename)
+    assert len(loaded) == 1
+    assert list(loaded[0]['frames']) == video['frames']
+
+
+def test_SqliteContainer_save_changes(tmpdir):
+    filename = os.path.join(str(tmpdir), "test_SqliteContainer_changes.sloth.db")
+    container = SqliteContainer()
+    container.save(someAnnotations(), filename)
+
+    # change one file item, drop another and reorder the rest
+    anns = someAnnotations()
+    anns[2]['annotations'].append({'type': 'point', 'x': 1, 'y': 2})
+    del anns[0]
+    anns.reverse()
+    container.save(anns, filename)
+
+    loaded = SqliteContainer().load(filename)
+    assert [dict(f, annotations=list(f['annotations'])) for f in loaded] == anns
+
+
+def test_SqliteContainer_save_unread(tmpdir):
+    filename = os.path.join(str(tmpdir), "test_SqliteContainer_unread.sloth.db")
+    container = SqliteContainer()
+    container.save(someAnnotations(), filename)
+
+    # drop a file item, rename and move another one, without reading rows
+    anns = container.load(filename)
+    del anns[1]
+    anns[2]['filename'] = 'renamed.png'
+    anns.insert(0, anns.pop())
+    container.save(anns, filename)
+    assert [f for f in anns if f['annotations']._rows is not None] == [anns[3]]
+
+    expected = someAnnotations()
+    del expected[1]
+    expected[2]['filename'] = 'renamed.png'
+    expected.insert(0, expected.pop())
+    loaded = SqliteContainer().load(filename)
+    assert [dict(f, annotations=list(f['annotations'])) for f in loaded] == expected
+
+
+def test_SqliteContainer_save_changed_positions(tmpdir):
+    filename = os.path.join(str(tmpdir), "test_SqliteContainer_changed.sloth.db")
+    container = SqliteContainer()
+    container.save(someAnnotations(), filename)
+
+    anns = someAnnotations()
+    anns[0]['annotations'] = []
+    anns[3]['annotations'] = []
+    container.save(anns, filename, changed=[3])
+
+    # only the file item at position 3 has been written
+    loaded = SqliteContainer().load(filename)
+    assert list(loaded[0]['annotations']) == someAnnotations()[0]['annotations']
+    assert list(loaded[3]['annotations']) == []
+
+
+def test_SqliteContainer_save_as(tmpdir):
+    filename = os.path.join(str(tmpdir), "test_SqliteContainer_save_as.sloth.db")
+    other = os.path.join(str(tmpdir), "test_SqliteContainer_other.sloth.db")
+    SqliteContainer().save(someAnnotations(), filename)
+    SqliteContainer().save(someAnnotations()[::-1], other)
+
+    # the rows not read yet still come from the database they were loaded from
+    container = SqliteContainer()
+    loaded = container.load(filename)
+    container.save(loaded[:1], other)
+    assert [list(f['annotations']) for f in loaded] == \
+        [f['annotations'] for f in someAnnotations()]
+
+
+def test_SqliteContainer_convert(tmpdir):
+    filename = os.path.join(str(tmpdir), "test_SqliteContainer_convert.sloth.db")
+    video = {'class': 'video', 'filename': 'video.avi',
+             'frames': [{'class': 'frame', 'num': i,
+                         'annotations': someFileAnnotations(i)} for i in range(2)]}
+    expected = someAnnotations() + [video]
+    SqliteContainer().save(expected, filename)
+
+    # the lazily read rows are written as lists by the other containers
+    for container, name in ((JsonContainer(), "test.json"),
+                            (StreamingJsonContainer(), "test_streaming.json"),
+                            (PickleContainer(), "test.pickle")):
+        target = os.path.join(str(tmpdir), name)
+        container.save(SqliteContainer().load(filename), target)
+        assert list(container.load(target)) == expected
+
+    # and back into the database they were read from
+    SqliteContainer().save(SqliteContainer().load(filename), filename)
+    assert plainEntries(SqliteContainer().load(filename)) == expected
+
+
+def test_JournalContainer(tmpdir):
+    filename = os.path.join(str(tmpdir), "test_JournalContainer.json")
+    common_container_test(filename, JournalContainer())
+    assert not os.path.exists(filename + ".journal")
+
+
+def test_JournalContainer_replay(tmpdir):
+    filename = os.path.join(str(tmpdir), "test_JournalContainer_replay.json")
+    JournalContainer().save(someAnnotations(), filename)
+    journal = AnnotationJournal(filename + ".journal", filename)
+    journal.reset()
+    records = [['set', [1, 0], 'x', 5],
+               ['delete', [1], 'type'],
+               ['insert', [2], 0, {'type': 'point', 'x': 1, 'y': 2}],
+               ['remove', [3], 1],
+               ['clear', [4]],
+               ['insert', [], 5, {'type': 'image', 'filename': 'new.png', 'annotations': []}],
+               ['remove', [], 0]]
+    with open(filename + ".journal", "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+        # incomplete last record, e.g. after a crash
+        f.write('["set", [0], "x"')
+
+    expected = someAnnotations()
+    expected[1]['annotations'][0]['x'] = 5
+    del expected[1]['type']
+    expected[2]['annotations'].insert(0, {'type': 'point', 'x': 1, 'y': 2})
+    del expected[3]['annotations'][1]
+    expected[4]['annotations'] = []
+    expected.append({'type': 'image', 'filename': 'new.png', 'annotations': []})
+    del expected[0]
+    assert JournalContainer().load(filename) == expected
+
+    # saving to another file writes a new snapshot without journal
+    filename2 = os.path.join(str(tmpdir), "test_JournalContainer_replay2.json")
+    container = JournalContainer()
+    container.save(container.load(filename), filename2)
+    assert JsonContainer().load(filename2) == expected
+    assert not os.path.exists(filename2 + ".journal")
+
+
+def test_JournalContainer_compact_on_load(tmpdir):
+    filename = os.path.join(str(tmpdir), "test_JournalContainer_compact.json")
+    JournalContainer().save(someAnnotations(), filename)
+    journal = AnnotationJournal(filename + ".journal", filename)
+    journal.reset()
+    with open(filename + ".journal", "a") as f:
+        f.write(json.dumps(['remove', [], 0]) + "\n")
+
+    container = JournalContainer()
+    container.compact_size = 10
+    assert container.load(filename) == someAnnotations()[1:]
+    # the replayed journal has been written into a new snapshot
+    assert JsonContainer().load(filename) == someAnnotations()[1:]
+    assert not os.path.exists(filename + ".journal")
+
+
+def test_JournalContainer_stale_journal(tmpdir):
+    filename = os.path.join(str(tmpdir), "test_JournalContainer_stale.json")
+    JournalContainer().save(someAnnotations(), filename)
+    with open(filename + ".journal", "w") as f:
+        f.write(json.dumps(['snapshot', 'not the digest of the snapshot']) + "\n")
+        f.write(json.dumps(['remove', [], 0]) + "\n")
+
+    assert JournalContainer().load(filename) == someAnnotations()
+    assert not os.path.exists(filename + ".journal")
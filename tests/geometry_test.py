@@ -0,0 +1,60 @@
+import numpy as np
+from sloth.annotations.geometry import GeometryTable, SpatialIndex
+
+
+def test_GeometryTable_values():
+    table = GeometryTable('rect')
+    row = table.allocate(None)
+    assert table.set(row, 'x', 1)
+    assert table.set(row, 'y', 2.5)
+    assert table.set(row, 'xn', '1.0;2.5')
+    # values which do not round-trip are left to the caller
+    assert not table.set(row, 'width', '3')
+    assert not table.set(row, 'yn', '1;2.50')
+    assert not table.set(row, 'label', 'abc')
+
+    assert table.values(row) == {'x': 1, 'y': 2.5, 'xn': '1.0;2.5'}
+    assert type(table.get(row, 'x')) is int
+    assert table.vertices(row, 'xn').tolist() == [1.0, 2.5]
+
+    table.release(row)
+    assert table.allocate(None) == row
+    assert table.values(row) == {}
+
+
+def test_GeometryTable_boundingBoxes():
+    table = GeometryTable('mixed', capacity=2)
+    rect, point, polygon, invalid = [table.allocate(None) for i in range(4)]
+    for key, value in zip(('x', 'y', 'width', 'height'), (1., 2., 3., 4.)):
+        table.set(rect, key, value)
+    table.set(point, 'x', 5.)
+    table.set(point, 'y', 6.)
+    table.set(polygon, 'xn', '1.0;4.0;2.0')
+    table.set(polygon, 'yn', '7.0;3.0;5.0')
+    table.set(invalid, 'x', 1.)
+
+    # rewrite the polygon until the vertex buffer is compacted
+    for i in range(200):
+        table.set(polygon, 'xn', ';'.join(str(float(i + j)) for j in range(3)))
+    table.set(polygon, 'xn', '1.0;4.0;2.0')
+
+    rows, boxes = table.boundingBoxes()
+    assert rows.tolist() == [rect, point, polygon]
+    assert np.allclose(boxes, [[1, 2, 3, 4], [5, 6, 0, 0], [1, 3, 3, 4]])
+
+
+def test_SpatialIndex():
+    index = SpatialIndex(cell_size=10, max_cells=4)
+    small, large, point = object(), object(), object()
+    index.insert(small, (12, 12, 5, 5))
+    index.insert(large, (0, 0, 100, 100))
+    index.insert(point, (50, 50, 0, 0))
+    assert set(map(id, index.intersecting((15, 15, 0, 0)))) == set([id(small), id(large)])
+    assert set(map(id, index.intersecting((40, 40, 10, 10)))) == set([id(large), id(point)])
+    assert index.intersecting((200, 200, 1, 1)) == []
+
+    index.insert(small, (60, 60, 2, 2))
+    assert set(map(id, index.intersecting((61, 61, 0, 0)))) == set([id(large), id(small)])
+    assert index.remove(large) and not index.remove(large)
+    assert index.intersecting((15, 15, 0, 0)) == []
+    assert len(index) == 2
@@ -0,0 +1,69 @@
+import threading
+import tempfile
+import numpy as np
+from sloth.core.imagecache import ImageCache
+
+
+def test_ImageCache_lru():
+    cache = ImageCache(300)
+    for i in range(3):
+        cache.put(i, np.zeros(100, dtype=np.uint8))
+    assert cache.size() == 300
+    assert len(cache) == 3
+
+    # the cached images are shared, so they are read-only
+    assert not cache.get(0).flags.writeable
+
+    # touch 0, so that 1 is the least recently used image
+    assert cache.get(0) is not None
+    cache.put(3, np.zeros(100, dtype=np.uint8))
+    assert cache.get(1) is None
+    assert all(cache.get(i) is not None for i in (0, 2, 3))
+    assert cache.size() == 300
+
+    # images larger than the budget are not cached
+    cache.put(4, np.zeros(400, dtype=np.uint8))
+    assert 4 not in cache
+    assert len(cache) == 3
+
+
+def test_ImageCache_load():
+    cache = ImageCache(1000)
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def loader():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return np.ones(10, dtype=np.uint8)
+
+    results = []
+    first = threading.Thread(target=lambda: results.append(cache.load('a', loader)))
+    first.start()
+    started.wait()
+    second = threading.Thread(target=lambda: results.append(cache.load('a', loader)))
+    second.start()
+    release.set()
+    first.join()
+    second.join()
+
+    # the second thread waited for the first one instead of loading again
+    assert len(calls) == 1
+    assert len(results) == 2
+    assert cache.load('a', loader) is results[0]
+    assert cache.load('b', lambda: None) is None
+    assert 'b' not in cache
+
+
+def test_ImageCache_memmap():
+    cache = ImageCache(300)
+    cache.put(0, np.zeros(100, dtype=np.uint8))
+
+    # memory-mapped images larger than the budget are kept alone
+    image = np.memmap(tempfile.TemporaryFile(), dtype=np.uint8, mode='w+', shape=(400, ))
+    cache.put(1, image)
+    assert cache.get(1) is image
+    assert 0 not in cache
+    assert cache.size() == 300